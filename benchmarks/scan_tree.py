@@ -0,0 +1,92 @@
+# Copyright 2021 Zegami Ltd
+
+"""Compare the parallel directory scanner with the old recursive walk.
+
+Builds a synthetic tree of empty image files, or reuses one at --root, and
+times each scan. Network mounts are where the parallel scan pays off, point
+--root at one, or use --latency to add a delay to every directory listing
+as a stand in. Run from the root of the repository:
+
+    python -m benchmarks.scan_tree --files 1000000 --latency 0.005
+"""
+
+from argparse import ArgumentParser
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from zeg import (
+    imagesets,
+    log,
+)
+
+
+def make_tree(root, count, per_directory=100, fan_out=100):
+    """Create count empty files spread over two levels of directories."""
+    for i in range(0, count, per_directory):
+        directory = os.path.join(
+            root, str(i // (per_directory * fan_out)), str(i // per_directory))
+        os.makedirs(directory, exist_ok=True)
+        for j in range(min(per_directory, count - i)):
+            open(os.path.join(directory, '{}.jpg'.format(j)), 'wb').close()
+
+
+def recursive_scan(path, allowed_ext, blacklist_ext):
+    """Scan as before, recursing with a second pass for sizes."""
+    def scan(path):
+        files = []
+        for entry in os.scandir(path):
+            whitelisted = entry.name.lower().endswith(allowed_ext)
+            if entry.name.lower().endswith(blacklist_ext):
+                whitelisted = False
+            if entry.is_file() and whitelisted:
+                files.append(entry.path)
+            if entry.is_dir():
+                files.extend(scan(entry.path))
+        return files
+    return [(path, os.path.getsize(path)) for path in scan(path)]
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--root', default=None)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    root = args.root
+    if root is None:
+        root = tempfile.mkdtemp()
+        print('Creating {} files in {}'.format(args.files, root))
+        make_tree(root, args.files)
+    scandir = os.scandir
+
+    def slow_scandir(path):
+        time.sleep(args.latency)
+        return scandir(path)
+
+    try:
+        with mock.patch('os.scandir', slow_scandir):
+            run(root)
+    finally:
+        if args.root is None:
+            shutil.rmtree(root)
+
+
+def run(root):
+    start = time.monotonic()
+    found = recursive_scan(
+        root, tuple(imagesets.MIMES.keys()), imagesets.BLACKLIST)
+    print('recursive: {:.2f}s, {} files'.format(
+        time.monotonic() - start, len(found)))
+
+    start = time.monotonic()
+    found = list(imagesets._iter_files([root], True, False, log.Logger()))
+    print(' parallel: {:.2f}s, {} files'.format(
+        time.monotonic() - start, len(found)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# Copyright 2021 Zegami Ltd
+
+"""Compare the threaded and async upload engines against a fake server.
+
+The server answers signed url, storage and images_bulk requests after a
+fixed delay, standing in for a high latency link. A share of storage
+requests can be failed with a 503 to see how retries cope. Run from the
+root of the repository:
+
+    python -m benchmarks.upload_engines --files 2000 --latency 0.05
+    python -m benchmarks.upload_engines --files 2000 --error-rate 0.05
+"""
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import random
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+
+from zeg import (
+    failures,
+    http,
+    imagesets,
+    log,
+    workloads,
+)
+
+
+def make_server(latency, error_rate=0.0):
+    """Start a fake api and storage server, giving (server, base url)."""
+    size = [0]
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            time.sleep(latency)
+            if 'signed_blob_url' in self.path:
+                ids = json.loads(body)['ids']
+                reply = {i: '{}/storage/{}'.format(base, i) for i in ids}
+            elif 'extend' in self.path:
+                with lock:
+                    size[0] += json.loads(body)['delta']
+                    reply = {'new_size': size[0]}
+            else:
+                reply = {}
+            self.reply(200, reply)
+
+        def do_PUT(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            time.sleep(latency)
+            if random.random() < error_rate:
+                return self.reply(503, None)
+            self.reply(201, None)
+
+        def reply(self, code, obj):
+            data = b'' if obj is None else json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        request_queue_size = 1024
+
+    server = Server(('127.0.0.1', 0), Handler)
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, base
+
+
+def make_files(directory, count, size):
+    paths = []
+    data = os.urandom(size)
+    for i in range(count):
+        path = os.path.join(directory, '{}.jpg'.format(i))
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+def run(engine, paths, base, transport=http.HTTP1):
+    configuration = {'id': 'benchmark', 'engine': engine}
+    work = [
+        workloads.WorkItem(i, path, None, os.path.getsize(path))
+        for i, path in enumerate(paths)
+    ]
+    failed = failures.FailedFiles()
+    start = time.monotonic()
+    session = http.make_session(base, None, transport=transport)
+    imagesets._upload_work(
+        log.Logger(), session, configuration, [work],
+        '{}/api/v1/project/p/signed_blob_url'.format(base),
+        '{}/api/v0/project/p/imagesets/benchmark/images_bulk'.format(base),
+        None, None, failed=failed,
+    )
+    return time.monotonic() - start, len(failed)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=64 * 1024)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument(
+        '--transport', choices=http.TRANSPORTS, default=http.HTTP1)
+    args = parser.parse_args()
+
+    server, base = make_server(args.latency, args.error_rate)
+    directory = tempfile.mkdtemp()
+    try:
+        paths = make_files(directory, args.files, args.size)
+        for engine in ('thread', 'async'):
+            elapsed, failed = run(engine, paths, base, args.transport)
+            print('{:>6}: {:.2f}s, {:.1f} images/s, {} failed'.format(
+                engine, elapsed, len(paths) / elapsed, failed))
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -41,8 +41,15 @@ setup(
         'PyYaml==5.4',
         'requests<3.0,>=2.15.0',
         'tqdm==4.43.0',
+        'urllib3>=1.26',
     ],
     extras_require={
+        'async': [
+            'aiohttp>=3.7.4',
+        ],
+        'http2': [
+            'httpx[http2]>=0.18',
+        ],
         'sql': [
             'pyodbc==4.0.30',
             'SQLAlchemy==1.3.15',
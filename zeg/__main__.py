@@ -15,6 +15,7 @@ from . import (
     collections,
     datasets,
     http,
+    http2,
     imagesets,
     projects,
     log,
@@ -124,6 +125,8 @@ def main():
             '--project',
             help='The id of the project.',
         )
+        if action in ('create', 'update'):
+            _add_upload_args(action_parser)
         _add_standard_args(action_parser)
 
     # login parser
@@ -145,7 +148,11 @@ def main():
 
     logger = log.Logger(args.verbose)
     token = auth.get_token(args)
-    session = http.make_session(args.url, token)
+    if args.transport == http.HTTP2 and not http2.have_httpx:
+        logger.error(
+            'The http2 transport requires httpx[http2], is it installed?')
+        sys.exit(1)
+    session = http.make_session(args.url, token, transport=args.transport)
 
     if args.action == 'login':
         auth.login(
@@ -176,6 +183,13 @@ def _add_standard_args(parser):
         default=None,
         help='Authentication token.',
     )
+    parser.add_argument(
+        '--transport',
+        choices=http.TRANSPORTS,
+        default=http.HTTP1,
+        help='How requests are sent, http2 shares a few connections between '
+             'many requests and requires httpx[http2].',
+    )
     parser.add_argument(
         '-u',
         '--url',
@@ -190,5 +204,94 @@ def _add_standard_args(parser):
     )
 
 
+def _add_upload_args(parser):
+    parser.add_argument(
+        '--bandwidth-control',
+        default=None,
+        metavar='PATH',
+        help='File holding the upload bandwidth cap, read again whenever it '
+             'changes so the cap can be adjusted during an upload.',
+    )
+    parser.add_argument(
+        '--blob-index',
+        action='store_true',
+        default=None,
+        help='Reuse blobs uploaded to the project by earlier runs when a '
+             'file has the same content.',
+    )
+    parser.add_argument(
+        '--block-concurrency',
+        type=int,
+        default=None,
+        help='Blocks of one large azure file to upload at once.',
+    )
+    parser.add_argument(
+        '--block-size',
+        type=int,
+        default=None,
+        help='Size in MB of the blocks large azure files are split into.',
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=None,
+        help='Fixed number of uploads at once, adapts to the link if unset.',
+    )
+    parser.add_argument(
+        '--dedupe',
+        choices=('reference', 'skip'),
+        default=None,
+        help='Upload files with the same content once, and either complete '
+             'the copies with the same blob or leave them out.',
+    )
+    parser.add_argument(
+        '--engine',
+        choices=('thread', 'async'),
+        default=None,
+        help='How imageset files are uploaded, async requires aiohttp.',
+    )
+    parser.add_argument(
+        '--inventory-cache',
+        action='store_true',
+        default=None,
+        help='Reuse directory listings from previous scans of the same paths.',
+    )
+    parser.add_argument(
+        '--max-bandwidth',
+        default=None,
+        metavar='RATE',
+        help='Most bytes a second to upload, like 5M.',
+    )
+    parser.add_argument(
+        '--rate-limit',
+        action='append',
+        default=None,
+        dest='rate_limits',
+        metavar='NAME=RATE',
+        help='Most api calls a second to an endpoint, like signed_blob_url '
+             'or images_bulk, to the api for other calls, or bytes a second '
+             'to storage, like storage=20M. Can be given more than once.',
+    )
+    parser.add_argument(
+        '--replay',
+        default=None,
+        metavar='MANIFEST',
+        help='Upload the files listed in a failure manifest into the slots '
+             'reserved for them.',
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=None,
+        help='Resume an interrupted imageset upload.',
+    )
+    parser.add_argument(
+        '--warm-connections',
+        action='store_true',
+        default=None,
+        help='Connect upload workers to the api and storage before uploading.',
+    )
+
+
 if __name__ == '__main__':
     sys.exit(main())
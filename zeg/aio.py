@@ -0,0 +1,463 @@
+# Copyright 2021 Zegami Ltd
+
+"""Asyncio engine for uploading imageset files.
+
+Drives the same chunks through signed url creation, storage upload and
+images_bulk completion as the threaded engine, but as coroutines on a
+single thread so many more uploads can be in flight at once.
+"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import time
+
+from azure.storage.blob import ContentSettings
+
+from . import (
+    azure_blobs,
+    blobs,
+    completions,
+    hedging,
+    http,
+    integrity,
+    limits,
+    metrics,
+    retries,
+)
+
+try:
+    import aiohttp
+    from azure.storage.blob.aio import ContainerClient
+except ImportError:
+    have_aiohttp = False
+else:
+    have_aiohttp = True
+
+# Most files to be uploading at once.
+CONCURRENCY = 256
+
+# Bytes read from a file at a time while uploading it.
+READ_SIZE = 1024 * 1024
+
+
+def upload_chunks(log, session, chunks, create_url, complete_url, mime,
+                  use_azure_client, imageset_id, journal=None,
+                  limiter=None, sizer=None, progress=None, blocks=None,
+                  committer=None, failed=None):
+    """Upload (chunk, size) of (slot, path, blob_id) work until done.
+
+    Files in flight are bounded by the limiter, a fixed limit of
+    CONCURRENCY when not given. Azure uploads are split by the blocks
+    policy if given. Uploaded images are completed through the committer,
+    or one made for the run. Progress is counted in a metrics.UploadMetrics
+    and files which fail are recorded in failed, a failures.FailedFiles.
+    """
+    if limiter is None:
+        limiter = limits.AdaptiveConcurrency(
+            CONCURRENCY, maximum=CONCURRENCY, adaptive=False)
+    if progress is None:
+        progress = metrics.UploadMetrics()
+    owns_committer = committer is None
+    if owns_committer:
+        committer = completions.Committer(
+            session, complete_url, log, journal, failed=failed)
+    try:
+        _run(_upload_chunks(
+            log, session, chunks, create_url, mime, use_azure_client,
+            imageset_id, journal, limiter, sizer, progress, blocks, committer,
+            failed,
+        ))
+    finally:
+        if owns_committer:
+            committer.close()
+
+
+def _run(coro):
+    """Run a coroutine on a new event loop, as asyncio.run from python 3.7."""
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+async def _upload_chunks(log, session, chunks, create_url, mime,
+                         use_azure_client, imageset_id, journal, limiter,
+                         sizer, progress, blocks, committer, failed):
+    connector = aiohttp.TCPConnector(limit=limiter.maximum)
+    async with aiohttp.ClientSession(connector=connector) as client:
+        engine = _Engine(
+            log, session, client, create_url, mime, use_azure_client,
+            imageset_id, journal, limiter, sizer, blocks, committer, progress,
+            failed,
+        )
+        # chunks are started as others finish so later ones are sized
+        # from the earlier ones, there is at least one file per slot
+        # making chunks may block on the scan or an extend call, so they
+        # are taken off the event loop
+        loop = asyncio.get_event_loop()
+        pending = set()
+        try:
+            while True:
+                next_chunk = await loop.run_in_executor(
+                    None, next, chunks, None)
+                if next_chunk is None:
+                    break
+                chunk, chunk_size = next_chunk
+                while len(pending) >= int(limiter.limit):
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                    _report(done)
+                pending.add(asyncio.ensure_future(
+                    engine.upload_chunk(chunk, chunk_size)))
+            if pending:
+                done, pending = await asyncio.wait(pending)
+                _report(done)
+        finally:
+            # a scan or extend error stops the run, uploads still under
+            # way are cancelled rather than left running
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            await engine.close()
+
+
+def _report(done):
+    # chunks record their own failures, anything raised here is a bug
+    for task in done:
+        task.result()
+
+
+class _Engine(object):
+    """Shared state for the coroutines of one upload run."""
+
+    def __init__(self, log, session, client, create_url, mime,
+                 use_azure_client, imageset_id, journal, limiter, sizer,
+                 blocks, committer, progress, failed):
+        self.log = log
+        self.auth = session.auth
+        self.client = client
+        self.create_url = create_url
+        self.mime = mime
+        self.use_azure_client = use_azure_client
+        self.imageset_id = imageset_id
+        self.journal = journal
+        self.limiter = limiter
+        self.sizer = sizer
+        self.blocks = blocks
+        self.committer = committer
+        self.progress = progress
+        self.failed = failed
+        self.timeouts = http.get_timeouts(session)
+        self.rate_limits = getattr(session, 'rate_limits', None)
+        self.bandwidth = getattr(session, 'bandwidth', None)
+        self.hedger = hedging.Hedger(workers=1)
+        self.slots = _Slots(limiter)
+        # aiohttp failures are retried like those of requests, drawing on
+        # the same budget
+        policy = getattr(session, 'retry_policy', None)
+        self.retry_policy = policy and retries.RetryPolicy(
+            attempts=policy.attempts,
+            backoff=policy.backoff,
+            statuses=policy.statuses,
+            errors=policy.errors + (
+                aiohttp.ClientConnectionError, asyncio.TimeoutError),
+            budget=policy.budget,
+        )
+        self.containers = collections.OrderedDict()
+
+    async def upload_chunk(self, chunk, chunk_size):
+        """Upload and complete a chunk, giving the number of images."""
+        started = time.monotonic()
+        try:
+            await self._upload_chunk(chunk)
+        except Exception as ex:
+            # the whole chunk is tried again at the end of the run
+            self.log.error(
+                "Upload of chunk at {slot} failed: {ex}",
+                slot=chunk[0].slot, ex=ex)
+            for item in chunk:
+                self.fail(item, ex)
+            return 0
+        if self.sizer is not None:
+            self.sizer.observe(chunk_size, time.monotonic() - started)
+        return len(chunk)
+
+    async def _upload_chunk(self, chunk):
+        start = chunk[0].slot
+        paths = [item.path for item in chunk]
+        known_ids = [item.blob_id for item in chunk]
+
+        try:
+            blob_ids = blobs.new_blob_ids(paths, self.imageset_id)
+            if all(known_ids):
+                signed_urls = {}
+            else:
+                signed_urls = await self.hedged(
+                    self.retrying, self.request_json, 'POST', self.create_url,
+                    json={"ids": blob_ids})
+        except Exception as ex:
+            self.log.error(
+                "Could not get signed urls for image uploads: {ex}", ex=ex)
+            self.progress.fail(len(paths))
+            for item in chunk:
+                self.fail(item, ex)
+            return
+
+        results = await asyncio.gather(*(
+            self.upload_file(item, item.blob_id or blob_ids[i], signed_urls)
+            for i, item in enumerate(chunk)
+        ))
+
+        # journalled once for the chunk rather than for every file
+        uploaded = [
+            (item.slot, image["blob_id"])
+            for item, image in zip(chunk, results)
+            if image is not None and item.blob_id is None
+        ]
+        if self.journal is not None and uploaded:
+            self.journal.uploaded(uploaded)
+        self.committer.add(start, list(results), chunk)
+
+    async def upload_file(self, item, blob_id, signed_urls):
+        """Upload a file to storage, giving its image info or None."""
+        path = item.path
+        needs_upload = item.blob_id is None
+        uploading = False
+        try:
+            file_mime = blobs.file_mime(path, self.mime)
+            info = {
+                "blob_id": blob_id,
+                "name": os.path.basename(path),
+                "size": os.path.getsize(path),
+                "mimetype": file_mime,
+            }
+            if not needs_upload:
+                self.progress.skip(info["size"])
+                return info
+            async with self.slots:
+                self.progress.start()
+                uploading = True
+                started = time.monotonic()
+                await self.put_blob(
+                    signed_urls[blob_id], blob_id, path, file_mime,
+                    info["size"])
+                self.limiter.success(time.monotonic() - started, info["size"])
+        except Exception as ex:
+            self.limiter.failure(ex)
+            self.log.error("File upload failed: {ex}", ex=ex)
+            if uploading:
+                self.progress.finish(ok=False)
+            else:
+                self.progress.fail()
+            self.fail(item, ex)
+            return None
+        self.progress.finish()
+        return info
+
+    def fail(self, item, ex):
+        # kept with its slot to be tried again at the end of the run
+        if self.failed is not None:
+            self.failed.add(item, ex)
+
+    async def put_blob(self, url, blob_id, path, file_mime, size):
+        with open(path, 'rb') as source:
+            f = self.progress.reader(source)
+            if self.bandwidth is not None:
+                # reads are held back to the cap as the file is sent
+                f = self.bandwidth.reader(f, awaitable=True)
+            if self.use_azure_client:
+                container = self.container(*blobs.parse_sas_url(url))
+                await self.pace(url, size)
+                await container.upload_blob(
+                    blob_id,
+                    f,
+                    content_settings=ContentSettings(content_type=file_mime),
+                    validate_content=True,
+                    **(self.blocks.upload_kwargs(size) if self.blocks else {})
+                )
+            else:
+                url = blobs.storage_url(url)
+                headers = {
+                    'Content-Type': file_mime,
+                    'Content-Length': str(size),
+                }
+                headers.update(http.get_platform_headers(url))
+
+                async def put():
+                    # each attempt reads and hashes the file from the start
+                    f.seek(0)
+                    md5 = hashlib.md5()
+                    await self.request_json(
+                        'PUT', url, data=_read(f, md5),
+                        headers=headers, md5=md5, size=size)
+
+                await self.retrying(put)
+
+    async def hedged(self, fn, *args, **kwargs):
+        """Await fn, and again alongside if slow, giving the first result.
+
+        Like hedging.Hedger.call, the copy that loses is cancelled.
+        """
+        async def timed():
+            started = time.monotonic()
+            result = await fn(*args, **kwargs)
+            self.hedger.observe(time.monotonic() - started)
+            return result
+
+        tasks = [asyncio.ensure_future(timed())]
+        delay = self.hedger.delay()
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedger.hedged += 1
+                tasks.append(asyncio.ensure_future(timed()))
+        try:
+            error = None
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except Exception as ex:
+                    error = ex
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def retrying(self, fn, *args, **kwargs):
+        """Await fn, trying again after failures the retry policy allows."""
+        attempt = 0
+        while True:
+            policy = self.retry_policy
+            if policy is not None and policy.budget is not None:
+                policy.budget.deposit()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as ex:
+                if self.retry_policy is None:
+                    raise
+                delay = self.retry_policy.delay(attempt, ex)
+                if delay is None:
+                    raise
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def container(self, account_url, container_name, sas_token):
+        """Get a container client, reused while the SAS token holds.
+
+        Clients share the engine's aiohttp session and its connections.
+        """
+        key = (account_url, container_name, sas_token)
+        container = self.containers.get(key)
+        if container is None:
+            container = ContainerClient(
+                account_url,
+                container_name,
+                credential=sas_token,
+                session=self.client,
+                session_owner=False,
+                **azure_blobs.timeout_kwargs(self.timeouts, self.blocks),
+                **(self.blocks.client_kwargs() if self.blocks else {})
+            )
+            self.containers[key] = container
+            if len(self.containers) > azure_blobs.MAX_CLIENTS:
+                self.containers.popitem(last=False)
+        else:
+            self.containers.move_to_end(key)
+        return container
+
+    async def close(self):
+        self.hedger.close()
+        # evicted clients are left for the garbage collector, they hold
+        # nothing beyond the shared session
+        for container in self.containers.values():
+            await container.close()
+        self.containers.clear()
+
+    async def pace(self, url, size=0):
+        """Wait until the rate limits allow a request, like http.pace."""
+        if self.rate_limits is not None:
+            delay = self.rate_limits.delay(url, size)
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def request_json(self, method, url, md5=None, size=0, **kwargs):
+        """Make a request, decoding the response like http.handle_response.
+
+        Uploads hashed into md5 are checked against what storage reports,
+        size is the bytes sent for the timeouts.
+        """
+        headers = kwargs.pop('headers', {})
+        auth = self.auth
+        if (isinstance(auth, http.TokenEndpointAuth)
+                and url.startswith(auth.endpoint)):
+            headers["Authorization"] = "Bearer {}".format(self.auth.token)
+        await self.pace(url, size)
+        connect, read = self.timeouts(size)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        async with self.client.request(
+                method, url, headers=headers, timeout=timeout,
+                **kwargs) as response:
+            content = await response.read()
+        result = http.handle_response(
+            _Response(response.status, content, response.headers))
+        if md5 is not None:
+            integrity.check(response.headers, md5)
+        return result
+
+
+async def _read(f, md5):
+    """Yield the content of a file, hashing it as it is read.
+
+    The file is read off the event loop, through a limits.ThrottledReader
+    keeping to its cap if it is one.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        if isinstance(f, limits.ThrottledReader):
+            data = await f.aread(READ_SIZE)
+        else:
+            data = await loop.run_in_executor(None, f.read, READ_SIZE)
+        if not data:
+            return
+        md5.update(data)
+        yield data
+
+
+class _Slots(object):
+    """Asyncio gate admitting as many uploads as the limiter allows."""
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: self.in_flight < int(self.limiter.limit))
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+
+class _Response(object):
+    """Enough of a requests response for http.handle_response."""
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
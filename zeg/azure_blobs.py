@@ -1,12 +1,32 @@
 # Copyright 2019 Zegami Ltd
 
-"""Generate sas tokens to download images from azure."""
+"""Generate sas tokens to download images from azure, and upload clients."""
 
 
+import collections
 from datetime import datetime, timedelta
 import os
+import threading
 
-from azure.storage.blob import generate_container_sas, ContainerSasPermissions
+from azure.storage.blob import (
+    ContainerClient,
+    ContainerSasPermissions,
+    generate_container_sas,
+)
+import requests
+
+from . import http
+
+# Most container clients kept, signed urls may come with a new token for
+# every chunk so old ones are dropped.
+MAX_CLIENTS = 64
+
+# Connections kept open to each storage account.
+POOL_SIZE = 256
+
+# Large files are sent as blocks of this many bytes, this many at once.
+BLOCK_SIZE = 16 * 1024 * 1024
+BLOCK_CONCURRENCY = 8
 
 
 def generate_signed_url(azure_container):
@@ -37,3 +57,101 @@ def generate_sas_with_sdk(connection_string, azure_container):
     return 'https://{}.blob.core.windows.net/{}/{{}}?{}'.format(
         account_name, azure_container, sas_token
     )
+
+
+class BlockPolicy(object):
+    """How files are split into blocks when uploading.
+
+    Files over threshold bytes have their blocks staged by concurrency
+    threads at once before the block list is committed, so a few huge files
+    at the end of a run do not leave the other workers idle. Clients send
+    blocks of block_size.
+    """
+
+    def __init__(self, threshold, block_size=BLOCK_SIZE,
+                 concurrency=BLOCK_CONCURRENCY):
+        """Initialise policy."""
+        self.threshold = threshold
+        self.block_size = block_size
+        self.concurrency = concurrency
+
+    def client_kwargs(self):
+        """Get keyword arguments for making a container client."""
+        return {'max_block_size': self.block_size}
+
+    def upload_kwargs(self, size):
+        """Get keyword arguments for upload_blob of a file of size bytes."""
+        if size > self.threshold:
+            return {'max_concurrency': self.concurrency}
+        return {}
+
+
+def timeout_kwargs(timeouts, blocks=None):
+    """Get keyword arguments giving a container client http.Timeouts.
+
+    Each request sends at most a block, or a whole file when there are no
+    blocks, so the read timeout is for a block.
+    """
+    connect, read = timeouts(blocks.block_size if blocks is not None else 0)
+    return {'connection_timeout': connect, 'read_timeout': read}
+
+
+class ContainerClients(object):
+    """Container clients for uploads, reused while their SAS token holds.
+
+    A client is made for each account url, container and SAS token, so a new
+    token gets a new client. Clients for the same account share a requests
+    session, keeping connections and TLS sessions warm across tokens.
+    Clients are safe to share between threads.
+    """
+
+    def __init__(self, max_clients=MAX_CLIENTS, pool_size=POOL_SIZE,
+                 blocks=None, timeouts=None):
+        """Initialise cache."""
+        self.max_clients = max_clients
+        self.pool_size = pool_size
+        self.blocks = blocks
+        self.timeouts = timeouts or http.DEFAULT_TIMEOUTS
+        self._clients = collections.OrderedDict()
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, account_url, container_name, sas_token):
+        """Get a client for the container using the SAS token."""
+        key = (account_url, container_name, sas_token)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+            client = ContainerClient(
+                account_url,
+                container_name,
+                credential=sas_token,
+                session=self._session(account_url),
+                session_owner=False,
+                **timeout_kwargs(self.timeouts, self.blocks),
+                **(self.blocks.client_kwargs() if self.blocks else {})
+            )
+            self._clients[key] = client
+            if len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+            return client
+
+    def close(self):
+        with self._lock:
+            self._clients.clear()
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def _session(self, account_url):
+        session = self._sessions.get(account_url)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._sessions[account_url] = session
+        return session
@@ -0,0 +1,121 @@
+# Copyright 2021 Zegami Ltd
+
+"""Local index of uploaded blobs by content, shared between runs."""
+
+import os
+import sqlite3
+import threading
+
+from . import auth
+
+INDEX_NAME = 'blobs.sqlite'
+
+# Uploaded blobs are written in batches of this many.
+FLUSH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    project TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    blob_id TEXT NOT NULL,
+    mimetype TEXT NOT NULL,
+    imageset TEXT NOT NULL,
+    PRIMARY KEY (project, digest)
+)
+"""
+
+
+def default_path():
+    """Get the index location in the users data directory."""
+    return os.path.join(auth._init_conf_location(), INDEX_NAME)
+
+
+class BlobIndex(object):
+    """Blobs already in a project's storage, by sha256 of their content.
+
+    Blobs are only looked up within the project they were uploaded to, and
+    must match in size as well as digest.
+
+    Blobs are kept under the imageset they were uploaded to, and go when
+    it is deleted. Before a blob is first given out, exists(imageset_id)
+    is asked whether its imageset is still there, once per imageset. It
+    answers True or False, or None when it cannot tell. Blobs of deleted
+    imagesets are dropped from the index, and blobs are only given out
+    when their imageset is known to exist. Without exists, every blob is.
+    """
+
+    def __init__(self, path, exists=None):
+        """Open or create the index."""
+        self.path = path
+        self.exists = exists
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._pending = {}
+        # whether each imageset asked about exists, for the whole run
+        self._imagesets = {}
+        with self._conn:
+            self._conn.execute(SCHEMA)
+
+    def lookup(self, project, digest, size):
+        """Get (blob_id, mimetype) of a stored copy of the content, or None."""
+        with self._lock:
+            row = self._pending.get((project, digest))
+            if row is None:
+                row = self._conn.execute(
+                    'SELECT size, blob_id, mimetype, imageset FROM blobs'
+                    ' WHERE project = ? AND digest = ?',
+                    (project, digest)).fetchone()
+        if row is None or row[0] != size:
+            return None
+        if not self._imageset_exists(row[3]):
+            return None
+        return row[1], row[2]
+
+    def record(self, project, digest, size, blob_id, mimetype, imageset):
+        """Remember a blob of imageset as holding the content with digest."""
+        with self._lock:
+            self._imagesets[imageset] = True
+            self._pending[(project, digest)] = (
+                size, blob_id, mimetype, imageset)
+            if len(self._pending) >= FLUSH_SIZE:
+                self._flush()
+
+    def _imageset_exists(self, imageset):
+        if self.exists is None:
+            return True
+        with self._lock:
+            known = imageset in self._imagesets
+            exists = self._imagesets.get(imageset)
+        if known:
+            return exists
+        # asked outside the lock, other lookups carry on meanwhile
+        exists = self.exists(imageset)
+        with self._lock:
+            self._imagesets[imageset] = exists
+            if exists is False:
+                self._drop(imageset)
+        return exists
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+    def _flush(self):
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO blobs'
+                ' (project, digest, size, blob_id, mimetype, imageset)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                [key + row for key, row in self._pending.items()])
+        self._pending = {}
+
+    def _drop(self, imageset):
+        self._pending = {
+            key: row for key, row in self._pending.items()
+            if row[3] != imageset
+        }
+        with self._conn:
+            self._conn.execute(
+                'DELETE FROM blobs WHERE imageset = ?', (imageset,))
@@ -0,0 +1,62 @@
+# Copyright 2021 Zegami Ltd
+
+"""Blob ids, content types and storage urls of uploaded images.
+
+Shared by the threaded and async upload engines.
+"""
+
+import os
+from urllib.parse import urlparse
+import uuid
+
+MIMES = {
+    ".bmp": "image/bmp",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".tif": "image/tiff",
+    ".tiff": "image/tiff",
+    ".dcm": "application/dicom",
+    # TODO add WSI mime types?
+}
+
+
+def new_blob_ids(paths, imageset_id):
+    """Get a new blob id for each path, under the imageset if given."""
+    if imageset_id:
+        return [
+            'imagesets/{}/{}'.format(imageset_id, uuid.uuid4())
+            for path in paths
+        ]
+    return [str(uuid.uuid4()) for path in paths]
+
+
+def file_mime(fpath, mime):
+    """Get the content type of a file, mime if given or by its extension."""
+    if mime is not None:
+        return mime
+    file_ext = os.path.splitext(fpath)[-1]
+    return MIMES.get(file_ext, MIMES['.jpg'])
+
+
+def parse_sas_url(url):
+    """Split a signed azure url into account url, container and SAS token."""
+    url_object = urlparse(url)
+    # get SAS token from url
+    sas_token = url_object.query
+    account_url = url_object.scheme + '://' + url_object.netloc
+    container_name = url_object.path.split('/')[1]
+    return account_url, container_name, sas_token
+
+
+def is_gcp_storage(url):
+    # TODO fetch project storage location to decide this
+    return url.startswith("/")
+
+
+def storage_url(url):
+    """Get the full url of a signed storage url."""
+    if is_gcp_storage(url):
+        return 'https://storage.googleapis.com{}'.format(url)
+    return url
@@ -83,11 +83,16 @@ def create(log, session, args):
             source_name = source['source_name']
             imageset_config = dict(source)
             imageset_config["file_config"] = {}
-            for property in ['paths', 'recursive', 'mime_type']:
+            for property in [
+                'paths', 'recursive', 'mime_type', 'include', 'exclude'
+            ]:
                 if property in source:
                     imageset_config["file_config"][property] = source[property]
             imageset_config["url"] = configuration["url"]
             imageset_config["project"] = configuration["project"]
+            for option in config.UPLOAD_OPTIONS:
+                if option in configuration:
+                    imageset_config[option] = configuration[option]
             imageset_config["dataset_id"] = coll["dataset_id"]
             imageset_config["collection_id"] = coll["id"]
             for coll_source in coll["image_sources"]:
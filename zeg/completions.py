@@ -0,0 +1,160 @@
+# Copyright 2021 Zegami Ltd
+
+"""Completing uploaded images on the imageset in as few calls as possible."""
+
+import threading
+
+from . import http
+
+# Most images to complete in one images_bulk call.
+BATCH_SIZE = 500
+
+# Longest an uploaded image waits to be completed, in seconds.
+FLUSH_WAIT = 2.0
+
+
+def completion_runs(results):
+    """Yield (index, images) for each consecutive run of uploaded images."""
+    run_start = None
+    for i, image in enumerate(results + [None]):
+        if image is not None and run_start is None:
+            run_start = i
+        elif image is None and run_start is not None:
+            yield run_start, results[run_start:i]
+            run_start = None
+
+
+class Committer(object):
+    """Background images_bulk calls for the results of many chunks.
+
+    Chunks hand over their results and carry on uploading. Runs of images
+    in consecutive slots are joined across chunks, whatever order the
+    chunks finish in, and sent when batch_size images are waiting or
+    flush_wait seconds have passed. Images are only marked complete in
+    the journal once their call succeeds. Duplicates of each image, from
+    a dedupe.Deduplicator, are completed along with it.
+
+    Images of a call which fails are recorded in failed, a
+    failures.FailedFiles, with their blobs so they are only completed
+    when tried again.
+    """
+
+    def __init__(self, session, complete_url, log, journal=None,
+                 batch_size=BATCH_SIZE, flush_wait=FLUSH_WAIT,
+                 duplicates=None, failed=None):
+        """Initialise committer and start its thread."""
+        self.session = session
+        self.complete_url = complete_url
+        self.log = log
+        self.journal = journal
+        self.duplicates = duplicates
+        self.failed = failed
+        self.batch_size = batch_size
+        self.flush_wait = flush_wait
+        # waiting runs by start slot, and the start of each by its end slot
+        self._runs = {}
+        self._starts = {}
+        self._waiting = 0
+        # work items of waiting images by slot, to record them as failed
+        self._items = {}
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._commit, daemon=True)
+        self._thread.start()
+
+    def add(self, start, results, items=None):
+        """Queue the images of a chunk starting at slot start.
+
+        Results hold None for files which failed, leaving a gap. Items are
+        the workloads.WorkItem of each result, needed to record failures.
+        """
+        with self._cond:
+            if items is not None and self.failed is not None:
+                for item, image in zip(items, results):
+                    if image is not None:
+                        self._items[item.slot] = item
+            for index, images in completion_runs(results):
+                self._add_run(start + index, images)
+                if self.duplicates is not None:
+                    for original, image in enumerate(images, start + index):
+                        copies = self.duplicates.completed(original, image)
+                        for item, copy in copies:
+                            if self.failed is not None:
+                                self._items[item.slot] = item
+                            self._add_run(item.slot, [copy])
+            if self._waiting >= self.batch_size:
+                self._cond.notify()
+
+    def close(self):
+        """Send everything still waiting and stop."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _add_run(self, start, images):
+        end = start + len(images)
+        self._waiting += len(images)
+        # join onto a run ending where this one starts
+        before = self._starts.pop(start, None)
+        if before is not None:
+            images = self._runs.pop(before) + images
+            start = before
+        # and onto one starting where this one ends
+        after = self._runs.pop(end, None)
+        if after is not None:
+            del self._starts[end + len(after)]
+            images = images + after
+            end += len(after)
+        self._runs[start] = images
+        self._starts[end] = start
+
+    def _commit(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed or self._waiting >= self.batch_size,
+                    timeout=self.flush_wait)
+                runs = sorted(self._runs.items())
+                closed = self._closed
+                self._runs = {}
+                self._starts = {}
+                self._waiting = 0
+            for start, images in runs:
+                for offset in range(0, len(images), self.batch_size):
+                    batch = images[offset:offset + self.batch_size]
+                    # nothing may stop the thread, or later chunks are
+                    # never completed
+                    try:
+                        self._post(start + offset, batch)
+                    except Exception as ex:
+                        self.log.error(
+                            "Failed to complete workload: {ex}", ex=ex)
+            if closed:
+                return
+
+    def _post(self, start, images):
+        url = self.complete_url + "?start={}".format(start)
+        slots = range(start, start + len(images))
+        try:
+            self.log.debug("POSTING TO: {url}", url=url)
+            http.post_json(self.session, url, {'images': images})
+        except Exception as ex:
+            self.log.error("Failed to complete workload: {ex}", ex=ex)
+            self._fail(slots, images, ex)
+            return
+        with self._cond:
+            for slot in slots:
+                self._items.pop(slot, None)
+        if self.journal is not None:
+            self.journal.complete(slots)
+
+    def _fail(self, slots, images, ex):
+        with self._cond:
+            items = [self._items.pop(slot, None) for slot in slots]
+        if self.failed is None:
+            return
+        for item, image in zip(items, images):
+            if item is not None:
+                # the file is in storage, a retry only completes it
+                self.failed.add(item._replace(blob_id=image['blob_id']), ex)
@@ -7,6 +7,23 @@ import sys
 import yaml
 import jsonschema
 
+# Command line options controlling how imageset files are uploaded.
+UPLOAD_OPTIONS = (
+    'bandwidth_control',
+    'blob_index',
+    'block_concurrency',
+    'block_size',
+    'concurrency',
+    'dedupe',
+    'engine',
+    'inventory_cache',
+    'max_bandwidth',
+    'rate_limits',
+    'replay',
+    'resume',
+    'warm_connections',
+)
+
 
 def parse_args(args, log):
     # check for config
@@ -17,6 +34,10 @@ def parse_args(args, log):
     for attr in ['id', 'project', 'url']:
         if attr in args:
             configuration[attr] = getattr(args, attr)
+    # options left unset, flags included, keep the configuration's value
+    for attr in UPLOAD_OPTIONS:
+        if getattr(args, attr, None) is not None:
+            configuration[attr] = getattr(args, attr)
     return configuration
 
 
@@ -0,0 +1,179 @@
+# Copyright 2021 Zegami Ltd
+
+"""Finding files with the same content so each is only uploaded once."""
+
+import concurrent.futures
+import hashlib
+import os
+import threading
+
+from . import (
+    paths,
+    workloads,
+)
+
+# Files hashed at once, hashlib releases the GIL on large reads.
+HASH_WORKERS = 8
+
+READ_SIZE = 1024 * 1024
+
+# Duplicates are completed with the blob of the first copy.
+REFERENCE = 'reference'
+# Duplicates are left out of the imageset.
+SKIP = 'skip'
+
+MODES = (REFERENCE, SKIP)
+
+
+def hash_file(path):
+    """Get the sha256 digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+class Deduplicator(object):
+    """Spot files whose content was already seen earlier in the run.
+
+    In skip mode duplicates are dropped from discovery batches before any
+    slot is reserved for them. In reference mode every file keeps its slot
+    but only the first copy is uploaded, the others are completed with its
+    blob once the committer sees it completed. A file which cannot be read
+    is passed on as unique so the upload reports the error.
+
+    With a blob_index.BlobIndex, reference mode also completes files whose
+    content an earlier run uploaded to the project with that blob, and
+    records the blob of every file completed for later runs as a blob of
+    imageset.
+    """
+
+    def __init__(self, mode, log, workers=HASH_WORKERS, index=None,
+                 project=None, imageset=None):
+        """Initialise deduplicator."""
+        self.mode = mode
+        self.log = log
+        self.workers = workers
+        self.index = index
+        self.project = project
+        self.imageset = imageset
+        self.duplicates = 0
+        self.duplicate_bytes = 0
+        self.reused = 0
+        self.reused_bytes = 0
+        # first slot or path by digest
+        self._originals = {}
+        # duplicates waiting on an original slot, or its completed blob
+        self._waiting = {}
+        self._blobs = {}
+        # digests of files being uploaded, to index once completed
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def unique(self, batches):
+        """Yield paths.PathTable batches without files seen before."""
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            for batch in batches:
+                kept = paths.PathTable()
+                digests = self._hash(executor, batch)
+                for (path, size), digest in zip(batch, digests):
+                    original = self._original(digest, path)
+                    if original == path:
+                        kept.append(path, size)
+                    else:
+                        self._count(size)
+                        self.log.debug(
+                            "Skipping {path}, same as {original}",
+                            path=path, original=original)
+                yield kept
+
+    def reference(self, segments, committer):
+        """Yield segments of work without duplicates, which wait on the first.
+
+        The committer completes waiting duplicates as the first copy is
+        completed, or straight away when it already has been.
+        """
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            for segment in segments:
+                kept = workloads.WorkTable()
+                items = [(item.path, item.size) for item in segment]
+                for item, digest in zip(segment, self._hash(executor, items)):
+                    original = self._original(digest, item.slot)
+                    if original == item.slot:
+                        known = self._lookup(digest, item.size)
+                        if known is None:
+                            if self.index is not None and digest is not None:
+                                with self._lock:
+                                    self._digests[item.slot] = digest
+                            kept.append(item)
+                        else:
+                            # stored by an earlier run, reference it instead
+                            self.reused += 1
+                            self.reused_bytes += item.size
+                            committer.add(
+                                item.slot, [_image(known, item)], [item])
+                        continue
+                    self._count(item.size)
+                    with self._lock:
+                        blob = self._blobs.get(original)
+                        if blob is None:
+                            self._waiting.setdefault(original, []).append(item)
+                    if blob is not None:
+                        committer.add(
+                            item.slot, [_image(blob, item)], [item])
+                yield kept
+
+    def completed(self, slot, image):
+        """Get (item, image) for duplicates of the file completed at slot."""
+        # only what a duplicate needs is kept, not the whole image
+        blob = (image['blob_id'], image['mimetype'])
+        with self._lock:
+            self._blobs[slot] = blob
+            waiting = self._waiting.pop(slot, [])
+            digest = self._digests.pop(slot, None)
+        if digest is not None:
+            self.index.record(
+                self.project, digest, image['size'], *blob, self.imageset)
+        return [(item, _image(blob, item)) for item in waiting]
+
+    def waiting(self):
+        """Get duplicates whose first copy was never completed."""
+        with self._lock:
+            return [item for items in self._waiting.values() for item in items]
+
+    def _original(self, digest, key):
+        # files which could not be hashed are their own original
+        if digest is None:
+            return key
+        return self._originals.setdefault(digest, key)
+
+    def _lookup(self, digest, size):
+        if self.index is None or digest is None:
+            return None
+        return self.index.lookup(self.project, digest, size)
+
+    def _hash(self, executor, files):
+        return executor.map(self._hash_one, [path for path, size in files])
+
+    def _hash_one(self, path):
+        try:
+            return hash_file(path)
+        except OSError as ex:
+            self.log.debug(
+                "Could not hash {path}: {ex}", path=path, ex=ex)
+            return None
+
+    def _count(self, size):
+        self.duplicates += 1
+        self.duplicate_bytes += size
+
+
+def _image(blob, item):
+    blob_id, mimetype = blob
+    return {
+        "blob_id": blob_id,
+        "name": os.path.basename(item.path),
+        "size": item.size,
+        "mimetype": mimetype,
+    }
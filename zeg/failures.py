@@ -0,0 +1,91 @@
+# Copyright 2021 Zegami Ltd
+
+"""Files which failed to upload, kept for a retry and a replay manifest."""
+
+import json
+import os
+import threading
+
+from . import auth, workloads
+
+MANIFEST_FORMAT = 'failed-{}.json'
+
+
+def default_path(imageset_id):
+    """Get the manifest location for an imageset in the users data dir."""
+    return os.path.join(
+        auth._init_conf_location(), MANIFEST_FORMAT.format(imageset_id))
+
+
+class FailedFiles(object):
+    """Failed files of an upload run, with the slots reserved for them.
+
+    The blob id is kept for files which were already in storage, a file
+    whose upload failed is given a new one when it is tried again.
+    """
+
+    def __init__(self):
+        """Initialise failed files."""
+        self._items = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, item, error):
+        """Record a workloads.WorkItem as failed with error."""
+        with self._lock:
+            self._items[item.slot] = item
+            self._errors[item.slot] = str(error)
+
+    def items(self):
+        """Get the failed WorkItems ordered by slot."""
+        with self._lock:
+            return [self._items[slot] for slot in sorted(self._items)]
+
+    def error(self, slot):
+        return self._errors.get(slot)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def write_manifest(path, imageset_id, failed):
+    """Save failed files so they can be replayed into their slots."""
+    manifest = {
+        'imageset_id': imageset_id,
+        'files': [
+            {
+                'slot': item.slot,
+                'path': item.path,
+                'blob_id': item.blob_id,
+                'size': item.size,
+                'error': failed.error(item.slot),
+            }
+            for item in failed.items()
+        ],
+    }
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_manifest(path, imageset_id):
+    """Load the WorkItems of a manifest written for imageset_id.
+
+    Raises ValueError when the manifest is for another imageset or is not
+    a manifest at all.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    try:
+        manifest_imageset_id = manifest['imageset_id']
+        work = sorted(
+            workloads.WorkItem(
+                entry['slot'], entry['path'], entry['blob_id'],
+                entry['size'])
+            for entry in manifest['files']
+        )
+    except (KeyError, TypeError) as ex:
+        raise ValueError('Manifest {} is malformed: {!r}'.format(path, ex))
+    if manifest_imageset_id != imageset_id:
+        raise ValueError('Manifest {} is for imageset {}, not {}'.format(
+            path, manifest_imageset_id, imageset_id))
+    return work
@@ -0,0 +1,154 @@
+# Copyright 2021 Zegami Ltd
+
+"""Resumable uploads of large files to google cloud storage signed urls."""
+
+import hashlib
+import threading
+import time
+
+import requests
+
+from . import (
+    http,
+    integrity,
+)
+
+# Files larger than this are sent through a resumable session.
+RESUMABLE_SIZE = 64 * 1024 * 1024
+
+# Bytes sent per request, storage requires a multiple of 256KB.
+CHUNK_SIZE = 32 * 256 * 1024
+
+# Times one file may be resumed after its connection drops.
+MAX_RESUMES = 5
+
+# Server errors worth resuming after, rather than failing the file.
+RESUME_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# Answers to starting a session meaning the url was not signed for it.
+REFUSED_STATUSES = (400, 403)
+
+
+class ResumableUploads(object):
+    """Upload large files in ranged chunks, resuming after failures.
+
+    The md5 of the file is taken from the chunks as they are read and
+    checked against the one storage reports at the end.
+
+    A session is started by posting to the signed url, which only works when
+    the url was signed for it. The first refusal is remembered and later
+    files go straight to a single put instead. Throttled starts are retried
+    with the session's retry_policy.
+    """
+
+    def __init__(self, threshold=RESUMABLE_SIZE, chunk_size=CHUNK_SIZE,
+                 max_resumes=MAX_RESUMES):
+        """Initialise uploader."""
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.max_resumes = max_resumes
+        self.supported = True
+        self._lock = threading.Lock()
+
+    def put_file(self, session, url, f, size, mimetype):
+        """Upload a file of size bytes like http.put_file."""
+        session_url = None
+        if size > self.threshold and self.supported:
+            session_url = self._start(session, url, mimetype)
+        if session_url is None:
+            return http.put_file(session, url, f, mimetype)
+        self._upload(session, session_url, f, size)
+
+    def _start(self, session, url, mimetype):
+        headers = {'Content-Type': mimetype, 'x-goog-resumable': 'start'}
+        policy = getattr(session, 'retry_policy', None)
+        attempt = 0
+        while True:
+            http.pace(session, url)
+            timeout = http.get_timeouts(session)()
+            with session.post(
+                    url, headers=headers, timeout=timeout) as response:
+                status = response.status_code
+                if status == 201 and 'Location' in response.headers:
+                    return response.headers['Location']
+                if status in REFUSED_STATUSES:
+                    with self._lock:
+                        self.supported = False
+                    return None
+                error = http.ClientError(response)
+            # throttling is waited out as the retry policy allows, other
+            # errors fail the file
+            delay = None
+            if policy is not None:
+                delay = policy.delay(attempt, error)
+            if delay is None:
+                raise error
+            attempt += 1
+            time.sleep(delay)
+
+    def _upload(self, session, session_url, f, size):
+        offset = 0
+        resumes = 0
+        finished = False
+        lost = False
+        md5 = hashlib.md5()
+        hashed = 0
+        while not finished:
+            try:
+                if lost:
+                    # carry on from whatever the server kept
+                    data = b''
+                else:
+                    f.seek(offset)
+                    data = f.read(self.chunk_size)
+                    # chunks sent again after a failure are only hashed once
+                    if offset + len(data) > hashed:
+                        md5.update(data[hashed - offset:])
+                        hashed = offset + len(data)
+                offset, finished = self._send(
+                    session, session_url, data, offset, size, md5)
+                lost = False
+            except (requests.ConnectionError, requests.Timeout,
+                    http.ClientError) as ex:
+                is_final = (
+                    isinstance(ex, http.ClientError)
+                    and ex.code not in RESUME_STATUSES)
+                if is_final or resumes >= self.max_resumes:
+                    raise
+                resumes += 1
+                lost = True
+
+    def _send(self, session, session_url, data, offset, size, md5):
+        """Send data from offset, giving the (offset, done) after it.
+
+        Sending no data asks how much the server has so far. Once done the
+        stored content is checked against md5.
+        """
+        if data:
+            content_range = 'bytes {}-{}/{}'.format(
+                offset, offset + len(data) - 1, size)
+        else:
+            content_range = 'bytes */{}'.format(size)
+        headers = {'Content-Range': content_range}
+        http.pace(session, session_url, len(data))
+        # storage answers 308 to mean incomplete, not to redirect
+        with session.put(session_url, data=data, headers=headers,
+                         timeout=http.get_timeouts(session)(len(data)),
+                         allow_redirects=False) as response:
+            offset, finished = _progress(response, size)
+            if finished:
+                integrity.check(response.headers, md5)
+            return offset, finished
+
+
+def _progress(response, size):
+    """Read (offset, done) from a resumable session response."""
+    if response.status_code in (200, 201):
+        return size, True
+    if response.status_code != 308:
+        raise http.ClientError(response)
+    # the range of bytes persisted so far, absent when there are none
+    persisted = response.headers.get('Range')
+    if not persisted:
+        return 0, False
+    return int(persisted.rsplit('-', 1)[1]) + 1, False
@@ -0,0 +1,136 @@
+# Copyright 2021 Zegami Ltd
+
+"""Sending slow requests again so a few stuck ones do not hold up a run."""
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+# Latencies kept to estimate when a call is slow.
+WINDOW = 200
+
+# Calls timed before any are hedged.
+MIN_SAMPLES = 20
+
+# A call slower than this share of recent calls gets a second copy.
+QUANTILE = 0.95
+
+# Chunks running this many times longer than they are sized to take are
+# uploaded again once the run is down to its last chunks.
+STRAGGLER_FACTOR = 3
+
+# Seconds between looks for stragglers.
+STRAGGLER_CHECK = 1.0
+
+
+class Hedger(object):
+    """Send a second copy of a slow idempotent call, taking the first answer.
+
+    The copy goes out once the call has taken longer than the quantile of
+    recent calls, so roughly one call in twenty is doubled and the slowest
+    ones stop setting the pace. An error is only raised once both copies
+    have failed.
+    """
+
+    def __init__(self, workers=8, quantile=QUANTILE, window=WINDOW,
+                 min_samples=MIN_SAMPLES):
+        """Initialise hedger."""
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.hedged = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def delay(self):
+        """Get how long a call may take before hedging, None if too few."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = int(self.quantile * len(latencies))
+        return latencies[min(len(latencies) - 1, index)]
+
+    def observe(self, seconds):
+        """Record a call taking seconds to succeed."""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def call(self, fn, *args, **kwargs):
+        """Call fn, calling it again if slow, giving the first result."""
+        futures = [self._executor.submit(self._timed, fn, *args, **kwargs)]
+        delay = self.delay()
+        if delay is not None:
+            done, _ = concurrent.futures.wait(futures, timeout=delay)
+            if not done:
+                with self._lock:
+                    self.hedged += 1
+                futures.append(self._executor.submit(
+                    self._timed, fn, *args, **kwargs))
+        error = None
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                return future.result()
+            except Exception as ex:
+                error = ex
+        raise error
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _timed(self, fn, *args, **kwargs):
+        started = time.monotonic()
+        result = fn(*args, **kwargs)
+        self.observe(time.monotonic() - started)
+        return result
+
+
+class Cancelled(Exception):
+    """A copy of a chunk stopped as the other copy completed it."""
+
+
+class Claim(object):
+    """Lets only the first of two copies of a chunk complete it.
+
+    Once it is taken the other copy stops at the next read of its files.
+    """
+
+    def __init__(self):
+        """Initialise claim."""
+        self._taken = False
+        self._lock = threading.Lock()
+
+    @property
+    def taken(self):
+        """Whether a copy has completed the chunk."""
+        return self._taken
+
+    def take(self):
+        """Take the claim, giving whether it was still free."""
+        with self._lock:
+            if self._taken:
+                return False
+            self._taken = True
+            return True
+
+    def reader(self, f):
+        """Wrap a file of the chunk to stop reading once the claim is taken."""
+        return ClaimedReader(f, self)
+
+
+class ClaimedReader(object):
+    """File wrapper raising Cancelled once its chunk's claim is taken."""
+
+    def __init__(self, f, claim):
+        """Initialise reader."""
+        self.f = f
+        self.claim = claim
+
+    def read(self, size=-1):
+        if self.claim.taken:
+            raise Cancelled('Chunk completed by another copy')
+        return self.f.read(size)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
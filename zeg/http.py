@@ -2,20 +2,49 @@
 
 """Tools for making http requests."""
 
+import time
+
 import requests.auth
-import urllib3.util.retry
+
+from . import (
+    http2,
+    integrity,
+    retries,
+)
 
 API_START_FORMAT = "{prefix}/api/v0/project/{project_id}/"
 
-# Max number of api requests to make at once.
+# Number of api requests to make at once, before adapting to the link.
 CONCURRENCY = 16
 
+# Most api requests to make at once however well the link copes.
+MAX_CONCURRENCY = 256
+
+# Connections a session keeps open to each host, enough for the threads
+# fetching signed urls and completing images to share.
+POOL_SIZE = 32
+
+# Ways of sending requests, HTTP/2 needs httpx[http2].
+HTTP1 = 'http1'
+HTTP2 = 'http2'
+TRANSPORTS = (HTTP1, HTTP2)
+
+# Seconds to wait for a connection, and for the response to a request.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+# Storage may take longer to answer after a large upload, allow a second
+# more for every this many bytes sent.
+READ_ALLOWANCE = 1024 * 1024
+
 
 class ClientError(Exception):
     """Failure when using http api."""
 
     def __init__(self, response, try_json=True):
         self.code = response.status_code
+        # kept for Retry-After
+        self.headers = getattr(response, 'headers', None) or {}
         if try_json:
             try:
                 body = response.json()
@@ -48,6 +77,59 @@ class TokenEndpointAuth(requests.auth.AuthBase):
         return request
 
 
+class Timeouts(object):
+    """Connect and read deadlines, the read deadline growing with payload size.
+
+    Without them a connection the server stops answering holds its worker
+    for the rest of the run.
+    """
+
+    def __init__(self, connect=CONNECT_TIMEOUT, read=READ_TIMEOUT,
+                 allowance=READ_ALLOWANCE):
+        """Initialise timeouts."""
+        self.connect = connect
+        self.read = read
+        self.allowance = allowance
+
+    def __call__(self, size=0):
+        """Get (connect, read) seconds for a request sending size bytes."""
+        return self.connect, self.read + size / self.allowance
+
+    def scaled(self, factor):
+        """Get timeouts factor times as long."""
+        return Timeouts(
+            self.connect * factor, self.read * factor, self.allowance / factor)
+
+
+DEFAULT_TIMEOUTS = Timeouts()
+
+
+def get_timeouts(session):
+    """Get the timeouts requests made with a session should use."""
+    return getattr(session, 'timeouts', None) or DEFAULT_TIMEOUTS
+
+
+def pace(session, url, size=0):
+    """Wait until the session's rate limits allow a request to url.
+
+    size is the bytes the request sends, see limits.RateLimits.
+    """
+    rate_limits = getattr(session, 'rate_limits', None)
+    if rate_limits is not None:
+        delay = rate_limits.delay(url, size)
+        if delay:
+            time.sleep(delay)
+
+
+def throttle(session, f):
+    """Wrap a file to upload so it is read within the session's bandwidth.
+
+    See limits.Bandwidth, the file is given back as is without a cap.
+    """
+    bandwidth = getattr(session, 'bandwidth', None)
+    return bandwidth.reader(f) if bandwidth is not None else f
+
+
 def get_api_url(url_prefix, project_id):
     """Get the formatted API prefix."""
     return API_START_FORMAT.format(
@@ -55,26 +137,38 @@ def get_api_url(url_prefix, project_id):
         project_id=project_id)
 
 
-def make_session(endpoint, token):
+def make_session(endpoint, token, pool_size=POOL_SIZE, transport=HTTP1):
     """
     Create a session object with optional auth handling and a retry backoff.
 
+    Api calls under endpoint are retried on server errors, apart from posts
+    which are not safe to send twice. Other requests, which go to storage,
+    are only retried on failing to connect. Uploads are retried
+    whole by put_file with the session's retry_policy. All retries are
+    drawn from one retries.RetryBudget. Upload workers use their own copies
+    of the session from a sessions.SessionPool.
+
+    With the HTTP2 transport requests go through http2.Http2Adapter,
+    sharing a few connections per host.
+
     See https://www.peterbe.com/plog/best-practice-with-retries-with-requests
     """
     session = requests.Session()
 
-    # Retry post requests as well as the usual methods.
-    retry_methods = urllib3.util.retry.Retry.DEFAULT_METHOD_WHITELIST.union(
-        ('POST', 'PUT'))
-    retry = urllib3.util.retry.Retry(
-        total=10,
-        backoff_factor=0.5,
-        status_forcelist=[(502, 503, 504, 408)],
-        method_whitelist=retry_methods
-    )
-    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
+    adapter = retries.RetryAdapter
+    if transport == HTTP2:
+        adapter = http2.Http2Adapter
+    budget = retries.RetryBudget()
+    storage = adapter(
+        max_retries=retries.storage_retry(budget), pool_maxsize=pool_size)
+    session.mount('http://', storage)
+    session.mount('https://', storage)
+    if endpoint:
+        api = adapter(
+            max_retries=retries.api_retry(budget), pool_maxsize=pool_size)
+        session.mount(endpoint.rstrip('/') + '/api/', api)
+    session.retry_policy = retries.RetryPolicy(budget=budget)
+    session.timeouts = Timeouts()
     if token is not None:
         session.auth = TokenEndpointAuth(endpoint, token)
     return session
@@ -98,41 +192,76 @@ def handle_response(response):
 
 def get(session, url):
     """Get a json response."""
-    with session.get(url) as response:
+    pace(session, url)
+    with session.get(url, timeout=get_timeouts(session)()) as response:
         return handle_response(response)
 
 
 def post_json(session, url, python_obj):
     """Send a json request and decode json response."""
-    with session.post(url, json=python_obj) as response:
+    pace(session, url)
+    timeout = get_timeouts(session)()
+    with session.post(url, json=python_obj, timeout=timeout) as response:
         return handle_response(response)
 
 
 def post_file(session, url, name, filelike, mime):
     """Send a data file."""
     details = (name, filelike, mime)
-    with session.post(url, files={'file': details}) as response:
+    pace(session, url)
+    timeout = get_timeouts(session)()
+    with session.post(
+            url, files={'file': details}, timeout=timeout) as response:
         return handle_response(response)
 
 
 def delete(session, url):
     """Delete a resource."""
-    with session.delete(url) as response:
+    pace(session, url)
+    with session.delete(url, timeout=get_timeouts(session)()) as response:
         return handle_response(response)
 
 
 def put_file(session, url, filelike, mimetype):
-    """Put binary content and decode json respose."""
+    """Put binary content and decode json respose.
+
+    The content is hashed as it is sent and checked against the md5 storage
+    reports, raising integrity.IntegrityError if they differ. Failures are
+    retried from the same file position with the session's retry_policy.
+    """
     headers = {'Content-Type': mimetype}
     headers.update(get_platform_headers(url))
-    with session.put(url, data=filelike, headers=headers) as response:
-        return handle_response(response)
+    policy = getattr(session, 'retry_policy', None)
+    start = filelike.tell() if policy is not None else None
+    attempt = 0
+    while True:
+        reader = integrity.HashingReader(filelike)
+        timeout = get_timeouts(session)(len(reader))
+        pace(session, url, len(reader))
+        try:
+            with session.put(
+                    url, data=reader, headers=headers,
+                    timeout=timeout) as response:
+                result = handle_response(response)
+                integrity.check(response.headers, reader.md5)
+                return result
+        except Exception as ex:
+            delay = policy.delay(attempt, ex) if policy is not None else None
+            if delay is None:
+                raise
+        attempt += 1
+        time.sleep(delay)
+        filelike.seek(start)
 
 
 def put_json(session, url, python_obj):
     headers = get_platform_headers(url)
     """Put json content and decode json response."""
-    with session.put(url, json=python_obj, headers=headers) as response:
+    pace(session, url)
+    timeout = get_timeouts(session)()
+    with session.put(
+            url, json=python_obj, headers=headers,
+            timeout=timeout) as response:
         return handle_response(response)
 
 
@@ -140,7 +269,10 @@ def put(session, url, data, content_type):
     """Put data and decode json response."""
     headers = {'Content-Type': content_type}
     headers.update(get_platform_headers(url))
-    with session.put(url, data=data, headers=headers) as response:
+    pace(session, url, len(data))
+    timeout = get_timeouts(session)(len(data))
+    with session.put(
+            url, data=data, headers=headers, timeout=timeout) as response:
         return handle_response(response)
 
 
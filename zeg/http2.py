@@ -0,0 +1,171 @@
+# Copyright 2021 Zegami Ltd
+
+"""An HTTP/2 transport for requests sessions, sending with httpx."""
+
+import time
+
+import requests
+import requests.adapters
+import requests.structures
+import requests.utils
+import urllib3
+import urllib3.exceptions
+import urllib3.util.retry
+
+from . import retries
+
+try:
+    import httpx
+    import h2  # noqa: F401
+except ImportError:
+    have_httpx = False
+else:
+    have_httpx = True
+
+# Headers about the connection rather than the request, not allowed over
+# HTTP/2 and the default over HTTP/1.1.
+CONNECTION_HEADERS = ('connection', 'keep-alive')
+
+# Bytes read from a file body at a time while sending it.
+READ_SIZE = 64 * 1024
+
+
+class Http2Adapter(requests.adapters.BaseAdapter):
+    """Transport adapter sending requests over HTTP/2 where the server has it.
+
+    Every request made through the adapter shares one httpx client, whose
+    connections each carry many requests at once, so a run with hundreds
+    of uploads in flight needs a connection or two per host rather than
+    one each. Servers without HTTP/2, and plain http, get HTTP/1.1.
+
+    Retries follow max_retries like the urllib3 retries of an HTTPAdapter,
+    and requests are added to its retries.RetryBudget like RetryAdapter.
+    Copies of a session made by sessions.SessionPool share the adapter and
+    so its connections.
+    """
+
+    def __init__(self, max_retries=None,
+                 pool_connections=requests.adapters.DEFAULT_POOLSIZE,
+                 pool_maxsize=requests.adapters.DEFAULT_POOLSIZE):
+        """Initialise adapter."""
+        super(Http2Adapter, self).__init__()
+        if not have_httpx:
+            raise RuntimeError('The http2 transport requires httpx[http2]')
+        self.max_retries = (
+            max_retries or urllib3.util.retry.Retry(0, read=False))
+        # only HTTP/1.1 hosts need more than one connection, as many as
+        # an HTTPAdapter would keep
+        self._client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=pool_connections * pool_maxsize,
+                max_keepalive_connections=pool_connections * pool_maxsize,
+            ),
+        )
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None,
+             proxies=None):
+        """Send a PreparedRequest, giving a requests.Response.
+
+        Connection settings like verify are taken from the client, proxies
+        from the environment.
+        """
+        budget = getattr(self.max_retries, 'budget', None)
+        if budget is not None:
+            budget.deposit()
+        retry = self.max_retries
+        while True:
+            try:
+                response = self._send(request, timeout)
+            except httpx.TransportError as ex:
+                error = _urllib3_error(ex, request.url)
+                try:
+                    retry = retry.increment(
+                        request.method, request.url, error=error)
+                except urllib3.exceptions.HTTPError:
+                    raise _requests_error(ex, request) from ex
+                time.sleep(retry.get_backoff_time())
+                continue
+            has_retry_after = 'Retry-After' in response.headers
+            if not retry.is_retry(
+                    request.method, response.status_code, has_retry_after):
+                return response
+            try:
+                retry = retry.increment(
+                    request.method, request.url, response=urllib3.HTTPResponse(
+                        headers=dict(response.headers),
+                        status=response.status_code, preload_content=False))
+            except urllib3.exceptions.MaxRetryError:
+                # give back the last response, as raise_on_status=False
+                return response
+            wait = None
+            if retry.respect_retry_after_header:
+                wait = retries.retry_after(response.headers)
+            time.sleep(retry.get_backoff_time() if wait is None else wait)
+
+    def close(self):
+        self._client.close()
+
+    def _send(self, request, timeout):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+        else:
+            connect = read = timeout
+        body = request.body
+        if hasattr(body, 'read'):
+            body = _chunks(body)
+        headers = {
+            name: value for name, value in request.headers.items()
+            if name.lower() not in CONNECTION_HEADERS
+        }
+        response = self._client.request(
+            request.method,
+            request.url,
+            content=body,
+            headers=headers,
+            timeout=httpx.Timeout(
+                connect=connect, read=read, write=read, pool=read),
+        )
+        return self._build_response(request, response)
+
+    def _build_response(self, request, raw):
+        response = requests.Response()
+        response.status_code = raw.status_code
+        response.headers = requests.structures.CaseInsensitiveDict(
+            raw.headers.multi_items())
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        response.reason = raw.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response._content = raw.content
+        response._content_consumed = True
+        return response
+
+
+def _chunks(f):
+    """Read a file body for sending, a piece at a time."""
+    while True:
+        data = f.read(READ_SIZE)
+        if not data:
+            return
+        yield data
+
+
+def _urllib3_error(ex, url):
+    """Get the urllib3 error urllib3 retries would see for an httpx error."""
+    if isinstance(ex, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return urllib3.exceptions.NewConnectionError(None, str(ex))
+    if isinstance(ex, httpx.TimeoutException):
+        return urllib3.exceptions.ReadTimeoutError(None, url, str(ex))
+    return urllib3.exceptions.ProtocolError(str(ex))
+
+
+def _requests_error(ex, request):
+    """Get the requests exception callers expect for an httpx error."""
+    if isinstance(ex, httpx.ConnectTimeout):
+        return requests.ConnectTimeout(ex, request=request)
+    if isinstance(ex, httpx.TimeoutException):
+        return requests.ReadTimeout(ex, request=request)
+    return requests.ConnectionError(ex, request=request)
@@ -3,9 +3,13 @@
 """Collection commands."""
 
 import concurrent.futures
+import heapq
 import os
+import queue
+import sys
+import threading
+import time
 import uuid
-from urllib.parse import urlparse
 
 from azure.storage.blob import (
     ContainerClient,
@@ -16,23 +20,31 @@ from tqdm import tqdm
 
 
 from . import (
+    aio,
     azure_blobs,
+    blob_index,
+    blobs,
+    completions,
     config,
+    dedupe,
+    failures,
+    gcs,
+    hedging,
     http,
+    inventory,
+    journals,
+    limits,
+    metrics,
+    paths as path_tables,
+    scanner,
+    sessions,
+    signing,
+    workloads,
 )
 
 
-MIMES = {
-    ".bmp": "image/bmp",
-    ".jpg": "image/jpeg",
-    ".jpeg": "image/jpeg",
-    ".png": "image/png",
-    ".gif": "image/gif",
-    ".tif": "image/tiff",
-    ".tiff": "image/tiff",
-    ".dcm": "application/dicom",
-    # TODO add WSI mime types?
-}
+# content types of images by file extension
+MIMES = blobs.MIMES
 
 BLACKLIST = (
     ".yaml",
@@ -48,10 +60,26 @@ BLACKLIST = (
     ".json"
 )
 
+# Files found by the scan are reserved on the imageset in batches of up to
+# this many, or whatever has been found this many seconds after the first.
+DISCOVERY_BATCH = 10000
+DISCOVERY_WAIT = 1.0
+
+# Most files the scan may get ahead of the uploads.
+DISCOVERY_QUEUE = 100000
+
 # When a file is larger than 256MB throw up a warning.
 # Collection processing may be unreliable when handling files larger than this.
+# Files larger than this going to azure are uploaded as parallel blocks.
 UPLOAD_WARNING_LIMIT = 268435456
 
+MB = 1024 * 1024
+
+# Uploads at once when failed files are tried again at the end of a run,
+# and how much longer their requests may take.
+RETRY_CONCURRENCY = 4
+RETRY_TIMEOUT_SCALE = 3
+
 
 def get(log, session, args):
     """Get an image set."""
@@ -62,47 +90,171 @@ def get(log, session, args):
     log.warn('Get imageset command coming soon.')
 
 
-def _get_chunk_upload_futures(
-    executor, paths, session, create_url,
-    complete_url, log, workload_size, offset, mime, use_azure_client,
-    imageset_id
+def _upload_chunks(
+    executor, chunks, session, create_url,
+    complete_url, log, mime, use_azure_client,
+    imageset_id, journal=None, limiter=None, sizer=None, containers=None,
+    resumable=None, prefetcher=None, committer=None, progress=None,
+    failed=None
 ):
-    """Return executable tasks with image uploads in batches.
+    """Run image uploads in batches, yielding the size of each finished.
 
     Instead of performing image uploads and updating the imageset
     one at a time, we reduce load on the API server by uploading
     many images and updating the api server in one go, consequently
-    making upload faster.
+    making upload faster. With a prefetcher, signed urls for a chunk are
+    requested as it is queued rather than when it starts, and with a
+    committer images_bulk calls are left to it. Files which fail are
+    recorded in failed, a failures.FailedFiles, if given.
+
+    Chunks are (chunk, size) from workloads.chunk_work and are submitted
+    only as earlier ones finish, keeping twice the limiter's worth queued,
+    so later chunks are sized from what the earlier ones took.
+
+    Once every chunk is submitted and workers fall idle, a chunk running
+    hedging.STRAGGLER_FACTOR times longer than the sizer aims for is
+    uploaded again alongside, and whichever copy finishes first completes
+    it.
     """
-    total_work = len(paths)
-    workloads = []
-    temp = []
-
-    i = 0
-    while i < total_work:
-        path = paths[i]
-        temp.append(path)
-        i += 1
-        if len(temp) == workload_size or i == total_work:
-            workload_info = {
-                "start": i - len(temp) + offset,
-                "count": len(temp),
-            }
-            workloads.append(executor.submit(
-                _upload_image_chunked,
-                temp,
-                session,
-                create_url,
-                complete_url,
-                log,
-                workload_info,
-                mime,
-                use_azure_client,
-                imageset_id,
-            ))
-            temp = []
-
-    return workloads
+    pending = set()
+    # the chunk of each future, and the two copies of chunks sent twice
+    submitted = {}
+    copies = {}
+
+    def submit(chunk, chunk_size, claim, progress):
+        future = _submit_chunk(
+            executor, chunk, chunk_size, session, create_url, complete_url,
+            log, mime, use_azure_client, imageset_id, journal, limiter,
+            sizer, containers, resumable, prefetcher, committer, progress,
+            failed, claim,
+        )
+        submitted[future] = (chunk, chunk_size, claim)
+        pending.add(future)
+        return future
+
+    def finish(done):
+        for future in done:
+            if future not in submitted:
+                # the other copy of its chunk finished first
+                continue
+            chunk, chunk_size, claim = submitted.pop(future)
+            other = copies.pop(future, None)
+            try:
+                count = future.result()
+            except Exception as ex:
+                if other is not None:
+                    # the other copy may still upload the chunk
+                    del copies[other]
+                    continue
+                # the whole chunk is tried again at the end of the run
+                log.error(
+                    "Upload of chunk at {slot} failed: {ex}",
+                    slot=chunk[0].slot, ex=ex)
+                if failed is not None:
+                    for item in chunk:
+                        failed.add(item, ex)
+                yield 0
+                continue
+            # the other copy of a chunk is no longer waited for
+            if other is not None:
+                del copies[other]
+                del submitted[other]
+                pending.discard(other)
+            yield count
+
+    for chunk, chunk_size in chunks:
+        window = 2 * int(limiter.limit) if limiter is not None else 2
+        while len(pending) >= window:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            pending.difference_update(done)
+            yield from finish(done)
+        submit(chunk, chunk_size, hedging.Claim(), progress)
+
+    running_since = {}
+    while pending:
+        done, _ = concurrent.futures.wait(
+            pending, timeout=hedging.STRAGGLER_CHECK,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        pending.difference_update(done)
+        yield from finish(done)
+        idle = limiter is None or len(pending) < int(limiter.limit)
+        if sizer is None or not idle:
+            continue
+        now = time.monotonic()
+        for future in list(pending):
+            if future in copies or not future.running():
+                continue
+            since = running_since.setdefault(future, now)
+            if now - since > hedging.STRAGGLER_FACTOR * sizer.target_seconds:
+                chunk, chunk_size, claim = submitted[future]
+                log.debug(
+                    "Uploading slow chunk at {start} again",
+                    start=chunk[0].slot)
+                # bytes and files are only counted by the first copy
+                copy = submit(chunk, chunk_size, claim, None)
+                copies[future] = copy
+                copies[copy] = future
+
+
+def _submit_chunk(
+    executor, chunk, chunk_size, session, create_url, complete_url, log,
+    mime, use_azure_client, imageset_id, journal, limiter, sizer, containers,
+    resumable, prefetcher, committer, progress, failed, claim=None
+):
+    workload_info = {
+        "start": chunk[0].slot,
+        "count": len(chunk),
+        "blob_ids": [item.blob_id for item in chunk],
+        "sizes": [item.size for item in chunk],
+        "claim": claim,
+    }
+    if prefetcher is not None and not all(workload_info["blob_ids"]):
+        workload_info["prefetch"] = prefetcher.fetch(
+            blobs.new_blob_ids(chunk, imageset_id))
+    return executor.submit(
+        _run_chunk,
+        limiter,
+        sizer,
+        chunk_size,
+        _upload_image_chunked,
+        [item.path for item in chunk],
+        session,
+        create_url,
+        complete_url,
+        log,
+        workload_info,
+        mime,
+        use_azure_client,
+        imageset_id,
+        journal,
+        limiter,
+        containers,
+        resumable,
+        committer,
+        progress,
+        failed,
+    )
+
+
+def _run_chunk(limiter, sizer, chunk_size, fn, paths, session, *args):
+    """Upload a chunk holding a limiter slot, giving the number of images.
+
+    The time taken is fed back to the sizer for later chunks. A worker
+    session is checked out of a sessions.SessionPool for the chunk.
+    """
+    if limiter is not None:
+        limiter.acquire()
+    try:
+        started = time.monotonic()
+        with sessions.checkout(session):
+            fn(paths, session, *args)
+        if sizer is not None:
+            sizer.observe(chunk_size, time.monotonic() - started)
+    finally:
+        if limiter is not None:
+            limiter.release()
+    return len(paths)
 
 
 def _finish_replace_empty_imageset(session, replace_empty_url):
@@ -111,35 +263,101 @@ def _finish_replace_empty_imageset(session, replace_empty_url):
     http.post_json(session, replace_empty_url, {})
 
 
-def _upload_image_chunked(paths, session, create_url, complete_url, log, workload_info, mime, use_azure_client=False, imageset_id=None):  # noqa: E501
-    results = []
-
-    # get all signed urls at once
+def _upload_image_chunked(paths, session, create_url, complete_url, log, workload_info, mime, use_azure_client=False, imageset_id=None, journal=None, limiter=None, containers=None, resumable=None, committer=None, progress=None, failed=None):  # noqa: E501
+    # One entry per path, left as None when the file fails to upload.
+    results = [None] * len(paths)
+    # Files already in storage from an interrupted run only need completing.
+    known_ids = workload_info.get("blob_ids") or [None] * len(paths)
+    sizes = workload_info.get("sizes") or [0] * len(paths)
+    # only the first copy of a chunk sent twice completes it
+    claim = workload_info.get("claim") or hedging.Claim()
+    failures_seen = []
+    # (slot, blob_id) of files stored, journalled once for the chunk
+    uploaded = []
+
+    def fail(position, ex, blob_id=None):
+        # kept with its slot to be tried again at the end of the run
+        failures_seen.append((workloads.WorkItem(
+            workload_info["start"] + position, paths[position], blob_id,
+            sizes[position]), ex))
+
+    def finish():
+        if not claim.take():
+            return False
+        if failed is not None:
+            for item, ex in failures_seen:
+                failed.add(item, ex)
+        return True
+
+    # get all signed urls at once, unless they were fetched while queued
+    prefetch = workload_info.get("prefetch")
     try:
-        if imageset_id:
-            id_set = {"ids": [f'imagesets/{imageset_id}/{str(uuid.uuid4())}' for path in paths]}
+        if prefetch is not None:
+            id_set = {"ids": prefetch.blob_ids}
+            signed_urls = prefetch.result()
         else:
-            id_set = {"ids": [str(uuid.uuid4()) for path in paths]}
-        signed_urls = http.post_json(session, create_url, id_set)
+            id_set = {"ids": blobs.new_blob_ids(paths, imageset_id)}
+            signed_urls = {}
+            if not all(known_ids):
+                signed_urls = http.post_json(session, create_url, id_set)
     except Exception as ex:
-        log.error("Could not get signed urls for image uploads: {}".format(ex))
+        log.error("Could not get signed urls for image uploads: {ex}", ex=ex)
+        if progress is not None:
+            progress.fail(len(paths))
+        for position in range(len(paths)):
+            fail(position, ex, known_ids[position])
+        finish()
         return
 
     index = 0
 
     for fpath in paths:
+        if claim.taken:
+            # the other copy completed the chunk, the rest is left to it
+            break
         try:
             file_name = os.path.basename(fpath)
-            file_ext = os.path.splitext(fpath)[-1]
-            if mime is not None:
-                file_mime = mime
-            else:
-                file_mime = MIMES.get(file_ext, MIMES['.jpg'])
+            file_mime = blobs.file_mime(fpath, mime)
         except Exception as ex:
-            log.error("issue with file info: {}".format(ex))
+            log.error("issue with file info: {ex}", ex=ex)
+
+        position = index
+        index = index + 1
+        slot = workload_info["start"] + position
+        if known_ids[position] is not None:
+            try:
+                results[position] = {
+                    "blob_id": known_ids[position],
+                    "name": file_name,
+                    "size": os.path.getsize(fpath),
+                    "mimetype": file_mime
+                }
+            except OSError as ex:
+                log.error("File upload failed: {ex}", ex=ex)
+                if progress is not None:
+                    progress.fail()
+                fail(position, ex, known_ids[position])
+            else:
+                if progress is not None:
+                    progress.skip(results[position]["size"])
+            continue
 
-        with open(fpath, 'rb') as f:
-            blob_id = id_set["ids"][index]
+        if progress is not None:
+            progress.start()
+        try:
+            source = open(fpath, 'rb')
+        except OSError as ex:
+            log.error("File upload failed: {ex}", ex=ex)
+            if progress is not None:
+                progress.finish(False)
+            fail(position, ex)
+            continue
+        cancelled = False
+        with source:
+            # bytes are counted as the upload reads them
+            f = progress.reader(source) if progress is not None else source
+            f = http.throttle(session, claim.reader(f))
+            blob_id = id_set["ids"][position]
             info = {
                 "image": {
                     "blob_id": blob_id,
@@ -148,46 +366,183 @@ def _upload_image_chunked(paths, session, create_url, complete_url, log, workloa
                     "mimetype": file_mime
                 }
             }
-            index = index + 1
+            started = time.monotonic()
             try:
                 # Post file to storage location
                 url = signed_urls[blob_id]
 
                 if use_azure_client:
-                    url_object = urlparse(url)
-                    # get SAS token from url
-                    sas_token = url_object.query
-                    account_url = url_object.scheme + '://' + url_object.netloc
-                    container_name = url_object.path.split('/')[1]
-
-                    # upload blob using client
-                    blob_client = ContainerClient(account_url, container_name, credential=sas_token)
+                    account_url, container_name, sas_token = (
+                        blobs.parse_sas_url(url))
+
+                    # upload blob using client, shared while the token holds
+                    if containers is None:
+                        blob_client = ContainerClient(
+                            account_url, container_name, credential=sas_token,
+                            **azure_blobs.timeout_kwargs(
+                                http.get_timeouts(session)))
+                    else:
+                        blob_client = containers.get(
+                            account_url, container_name, sas_token)
+                    upload_kwargs = {}
+                    block_policy = getattr(containers, 'blocks', None)
+                    if block_policy is not None:
+                        upload_kwargs = block_policy.upload_kwargs(
+                            info["image"]["size"])
+                    http.pace(session, account_url, info["image"]["size"])
                     blob_client.upload_blob(
                         blob_id,
                         f,
-                        content_settings=ContentSettings(content_type=file_mime)
+                        content_settings=ContentSettings(
+                            content_type=file_mime),
+                        validate_content=True,
+                        **upload_kwargs
                     )
 
-                    results.append(info["image"])
+                    results[position] = info["image"]
+                elif resumable is not None and blobs.is_gcp_storage(url):
+                    resumable.put_file(
+                        session, blobs.storage_url(url), f,
+                        info["image"]["size"], file_mime)
+                    results[position] = info["image"]
                 else:
-                    # TODO fetch project storage location to decide this
-                    is_gcp_storage = url.startswith("/")
-                    if is_gcp_storage:
-                        url = 'https://storage.googleapis.com{}'.format(url)
-                    http.put_file(session, url, f, file_mime)
+                    http.put_file(
+                        session, blobs.storage_url(url), f, file_mime)
                     # pop the info into a temp array, upload only once later
-                    results.append(info["image"])
+                    results[position] = info["image"]
 
+                if limiter is not None:
+                    limiter.success(
+                        time.monotonic() - started, info["image"]["size"])
+                uploaded.append((slot, blob_id))
             except Exception as ex:
-                log.error("File upload failed: {}".format(ex))
+                if claim.taken:
+                    # stopped, or failed after the other copy won
+                    cancelled = True
+                    if progress is not None:
+                        progress.sent(
+                            max(0, info["image"]["size"] - source.tell()))
+                else:
+                    if limiter is not None:
+                        limiter.failure(ex)
+                    log.error("File upload failed: {ex}", ex=ex)
+                    fail(position, ex)
+        if progress is not None:
+            progress.finish(cancelled or results[position] is not None)
+        if cancelled:
+            break
+
+    if claim.taken and progress is not None:
+        # files left to the other copy, which counts none, are done
+        for size in sizes[index:]:
+            progress.skip(size)
+
+    if not finish():
+        log.debug(
+            "Chunk at {start} was completed by another copy",
+            start=workload_info["start"])
+        return
+    if journal is not None and uploaded:
+        journal.uploaded(uploaded)
+    if committer is not None:
+        start = workload_info["start"]
+        committer.add(start, results, [
+            workloads.WorkItem(start + position, path, None, size)
+            for position, (path, size) in enumerate(zip(paths, sizes))
+        ])
+    else:
+        _complete_workload(
+            session, complete_url, log, workload_info["start"], results,
+            journal)
 
-    # send the chunk of images as a bulk operation rather than per image
+
+def _complete_workload(session, complete_url, log, start, results, journal):
+    """Send the chunk of images as bulk operations rather than per image.
+
+    Failed uploads leave a gap in results, each consecutive run of images
+    is completed with its own start so no image lands in the wrong slot.
+    """
+    for run_start, images in completions.completion_runs(results):
+        try:
+            url = complete_url + "?start={}".format(start + run_start)
+            log.debug("POSTING TO: {url}", url=url)
+            http.post_json(session, url, {'images': images})
+        except Exception as ex:
+            log.error("Failed to complete workload: {ex}", ex=ex)
+        else:
+            if journal is not None:
+                journal.complete(
+                    range(start + run_start, start + run_start + len(images)))
+
+
+def _imageset_exists(log, session, configuration, imageset_id):
+    """Check an imageset is still there, giving None when unsure."""
+    url = "{}imagesets/{}".format(
+        http.get_api_url(configuration["url"], configuration["project"]),
+        imageset_id)
     try:
-        url = complete_url + "?start={}".format(workload_info["start"])
-        log.debug("POSTING TO: {}".format(url))
-        http.post_json(session, url, {'images': results})
+        http.get(session, url)
     except Exception as ex:
-        log.error("Failed to complete workload: {}".format(ex))
+        if isinstance(ex, http.ClientError) and ex.code == 404:
+            return False
+        log.warn(
+            "Could not check imageset {id} for known blobs: {ex}",
+            id=imageset_id, ex=ex)
+        return None
+    return True
+
+
+def _plan_work(log, session, extend_url, batches, journal, resume):
+    """Reserve imageset slots for batches of files, yielding work for each.
+
+    Each batch of (path, size) becomes a workloads.WorkTable of work
+    ordered by slot, the imageset is extended once per batch as files are
+    discovered rather than once for the whole upload.
+
+    When resuming, paths the journal already holds keep their slot and
+    completed files are skipped, only unseen paths extend the imageset.
+    """
+    if resume:
+        if not len(journal):
+            log.warn("No interrupted upload to resume, uploading all images.")
+    else:
+        journal.clear()
+
+    skipped = 0
+    for batch in batches:
+        # looked up a batch at a time, memory does not grow with the imageset
+        entries = {}
+        if resume:
+            entries = journal.entries(path for path, size in batch)
+        resumed = []
+        new_files = path_tables.PathTable()
+        for path, size in batch:
+            if path not in entries:
+                new_files.append(path, size)
+                continue
+            slot, blob_id, state = entries[path]
+            if state == journals.COMPLETE:
+                skipped += 1
+            else:
+                resumed.append(workloads.WorkItem(slot, path, blob_id, size))
+
+        new_work = []
+        if new_files:
+            extend_response = http.post_json(
+                session, extend_url, {'delta': len(new_files)}
+            )
+            add_offset = extend_response['new_size'] - len(new_files)
+            journal.reserve(add_offset, (path for path, size in new_files))
+            new_work = (
+                workloads.WorkItem(add_offset + i, path, None, size)
+                for i, (path, size) in enumerate(new_files)
+            )
+
+        # new files are already in slot order
+        yield workloads.WorkTable(heapq.merge(sorted(resumed), new_work))
+
+    if skipped:
+        log("Skipped {count} images uploaded previously.", count=skipped)
 
 
 def _update_file_imageset(log, session, configuration):
@@ -208,6 +563,28 @@ def _update_file_imageset(log, session, configuration):
     log.debug('POST: {}'.format(complete_url))
     log.debug('POST: {}'.format(replace_empty_url))
 
+    # api calls, storage requests and upload bytes are paced, shared by
+    # every worker
+    try:
+        rate_limits = limits.rate_limits(configuration)
+        bandwidth = limits.bandwidth(configuration)
+    except ValueError as ex:
+        log.error('Invalid rate limit or bandwidth: {ex}', ex=ex)
+        sys.exit(1)
+    if rate_limits is not None:
+        session.rate_limits = rate_limits
+    if bandwidth is not None:
+        session.bandwidth = bandwidth
+
+    # files which failed before go back into the slots kept for them
+    replay = configuration.get('replay')
+    if replay:
+        try:
+            replayed = failures.read_manifest(replay, configuration["id"])
+        except (OSError, ValueError) as ex:
+            log.error('Could not replay failed files: {ex}', ex=ex)
+            sys.exit(1)
+
     # get image paths
     file_config = configuration['file_config']
     # check colleciton id, dataset and join column name
@@ -220,54 +597,322 @@ def _update_file_imageset(log, session, configuration):
     if 'mime_type' in file_config:
         mime_type = file_config["mime_type"]
 
-    # first extend the imageset by the number of items we have to upload
-    paths = _resolve_paths(
-        file_config['paths'], recursive, mime_type is not None, log
+    # directory listings can be reused from previous scans of the same roots
+    file_inventory = None
+    if configuration.get('inventory_cache', False):
+        file_inventory = inventory.Inventory(
+            configuration.get('inventory_path') or inventory.default_path())
+        log.debug('File inventory: {path}', path=file_inventory.path)
+
+    # upload files as they are found, extending the imageset in batches
+    files = _iter_files(
+        file_config['paths'], recursive, mime_type is not None, log,
+        file_config.get('include'), file_config.get('exclude'),
+        file_inventory,
     )
 
-    if len(paths) == 0:
-        log.warn("No images detected, no images will be uploaded.")
+    # files with the same content can be uploaded only once, or not at all
+    # when an earlier run stored it in the project
+    index = None
+    dedupe_mode = configuration.get('dedupe')
+    if configuration.get('blob_index', False):
+        if dedupe_mode == dedupe.SKIP:
+            log.warn("The blob index is not used when skipping duplicates.")
+        else:
+            dedupe_mode = dedupe.REFERENCE
+            index = blob_index.BlobIndex(
+                configuration.get('blob_index_path')
+                or blob_index.default_path(),
+                lambda imageset_id: _imageset_exists(
+                    log, session, configuration, imageset_id),
+            )
+            log.debug('Blob index: {path}', path=index.path)
+    duplicates = None
+    if dedupe_mode:
+        duplicates = dedupe.Deduplicator(
+            dedupe_mode, log, index=index, project=configuration["project"],
+            imageset=configuration["id"])
+
+    journal = journals.UploadJournal(
+        configuration.get('journal_path') or journals.default_path(),
+        configuration["id"],
+    )
+    log.debug('Upload journal: {path}', path=journal.path)
+    manifest_path = replay or failures.default_path(configuration["id"])
+    try:
+        if replay:
+            segments = [replayed]
+        else:
+            batches = _discover(files)
+            if duplicates is not None and duplicates.mode == dedupe.SKIP:
+                batches = duplicates.unique(batches)
+            segments = _plan_work(
+                log, session, extend_url, batches, journal,
+                configuration.get('resume', False),
+            )
+        failed = failures.FailedFiles()
+        count = _upload_work(
+            log, session, configuration, segments, bulk_create_url,
+            complete_url, mime_type, journal, duplicates, failed=failed,
+        )
+        if failed:
+            failed = _retry_failed(
+                log, session, configuration, failed, bulk_create_url,
+                complete_url, mime_type, journal, duplicates,
+            )
+        if duplicates is not None:
+            for item in duplicates.waiting():
+                failed.add(item, "Same content as a file which failed")
+    finally:
+        journal.close()
+        if file_inventory is not None:
+            file_inventory.close()
+        if index is not None:
+            index.close()
+
+    # a resumed upload may have nothing left but still needs finishing
+    if duplicates is not None and duplicates.duplicates:
+        log("{} duplicate files ({}) were {}.".format(
+            duplicates.duplicates, format_bytes(duplicates.duplicate_bytes),
+            "skipped" if duplicates.mode == dedupe.SKIP else "uploaded once"))
+    if duplicates is not None and duplicates.reused:
+        log("{} files ({}) were already stored by earlier uploads.".format(
+            duplicates.reused, format_bytes(duplicates.reused_bytes)))
+
+    if failed:
+        failures.write_manifest(manifest_path, configuration["id"], failed)
+        log.error(
+            "{count} files could not be uploaded, they are listed in {path}."
+            " Rerun with --replay {path} to upload them.",
+            count=len(failed), path=manifest_path)
+    elif replay:
+        os.remove(replay)
+
+    if count == 0 and not configuration.get('resume', False):
         return
 
-    extend_response = http.post_json(
-        session, extend_url, {'delta': len(paths)}
-    )
-    add_offset = extend_response['new_size'] - len(paths)
+    _finish_replace_empty_imageset(session, replace_empty_url)
+
+
+def _discover(files, batch_size=DISCOVERY_BATCH, wait=DISCOVERY_WAIT):
+    """Scan files in the background, yielding them in batches.
+
+    Scanning runs ahead of the uploads by at most DISCOVERY_QUEUE files. A
+    batch is yielded once batch_size files are found, or wait seconds after
+    its first file, so uploads start soon after the scan does.
+    """
+    found = queue.Queue(DISCOVERY_QUEUE)
+    done = object()
+
+    def scan():
+        try:
+            for entry in files:
+                found.put(entry)
+        except Exception as ex:
+            found.put(ex)
+        finally:
+            found.put(done)
+
+    threading.Thread(target=scan, daemon=True).start()
+
+    finished = False
+    while not finished:
+        # batches are path tables, a batch costs little beyond its names
+        batch = path_tables.PathTable()
+        entry = found.get()
+        deadline = time.monotonic() + wait
+        while True:
+            if entry is done:
+                finished = True
+                break
+            if isinstance(entry, Exception):
+                raise entry
+            batch.append(*entry)
+            if len(batch) >= batch_size:
+                break
+            try:
+                entry = found.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+        if batch:
+            yield batch
 
-    workload_size = optimal_workload_size(len(paths))
 
-    # When chunking work, futures could contain as much as 100 images at once.
-    # If the number of images does not divide cleanly into 10 or 100 (optimal)
-    # The total may be larger than reality and the image/s speed less accurate.
-    if workload_size != 1:
-        log.warn("The progress bar may have reduced accuracy when uploading larger imagesets.")  # noqa: E501
+def _upload_work(
+    log, session, configuration, segments, bulk_create_url, complete_url,
+    mime_type, journal, duplicates=None, upload_metrics=None, failed=None
+):
+    """Upload segments of work as they arrive, giving the number of images.
 
+    In reference mode duplicates are taken out of the work and completed
+    with the blob of the first copy. Progress is counted in upload_metrics,
+    a metrics.UploadMetrics showing a bar when not given. Files which fail
+    are recorded in failed, a failures.FailedFiles, if given.
+    """
     use_azure_client = configuration.get('use_wsi', False)
+    is_async = configuration.get('engine') == 'async'
+    if is_async and not aio.have_aiohttp:
+        log.error('The async engine requires aiohttp, is it installed?')
+        sys.exit(1)
+
+    # a fixed concurrency can be requested, otherwise adapt to the link
+    concurrency = configuration.get('concurrency')
+    limiter = limits.AdaptiveConcurrency(
+        concurrency or http.CONCURRENCY,
+        maximum=concurrency or (
+            aio.CONCURRENCY if is_async else http.MAX_CONCURRENCY),
+        adaptive=concurrency is None,
+    )
+    # chunks are capped by count to give every worker something to do and
+    # by bytes so huge files do not all end up in the same chunk
+    sizer = workloads.WorkloadSizer(optimal_workload_size(0))
+    # huge files are split into blocks sent in parallel
+    blocks = azure_blobs.BlockPolicy(
+        UPLOAD_WARNING_LIMIT,
+        block_size=MB * (
+            configuration.get('block_size') or azure_blobs.BLOCK_SIZE // MB),
+        concurrency=(
+            configuration.get('block_concurrency')
+            or azure_blobs.BLOCK_CONCURRENCY),
+    )
+
+    kwargs = {
+        'total': 0,
+        'unit': 'B',
+        'unit_scale': True,
+        'unit_divisor': 1024,
+        'leave': True,
+        'disable': upload_metrics is not None,
+    }
+    # images_bulk calls are batched across chunks away from the uploads
+    if duplicates is not None and duplicates.mode == dedupe.REFERENCE:
+        committer = completions.Committer(
+            session, complete_url, log, journal, duplicates=duplicates,
+            failed=failed)
+        segments = duplicates.reference(segments, committer)
+    else:
+        committer = completions.Committer(
+            session, complete_url, log, journal, failed=failed)
+
+    with tqdm(**kwargs) as bar:
+        if upload_metrics is None:
+            upload_metrics = metrics.UploadMetrics(bar)
+
+        def work():
+            # the total grows as the scan finds more files
+            for segment in segments:
+                upload_metrics.add(
+                    len(segment), sum(item.size for item in segment))
+                sizer.max_count = optimal_workload_size(
+                    upload_metrics.files_total)
+                yield from segment
+
+        chunks = workloads.chunk_work(work(), sizer)
+        try:
+            if is_async:
+                aio.upload_chunks(
+                    log, session, chunks, bulk_create_url, complete_url,
+                    mime_type, use_azure_client, configuration["id"], journal,
+                    limiter=limiter, sizer=sizer, progress=upload_metrics,
+                    blocks=blocks, committer=committer, failed=failed,
+                )
+            else:
+                _upload_threaded(
+                    log, session, chunks, bulk_create_url, mime_type,
+                    use_azure_client, configuration["id"], journal, limiter,
+                    sizer, blocks, committer, upload_metrics, failed,
+                    warm=configuration.get('warm_connections', False),
+                )
+        finally:
+            committer.close()
+        return upload_metrics.files_total
+
+
+def _retry_failed(
+    log, session, configuration, failed, bulk_create_url, complete_url,
+    mime_type, journal, duplicates
+):
+    """Upload failed files again into their slots, giving those still failing.
 
-    with concurrent.futures.ThreadPoolExecutor(http.CONCURRENCY) as executor:
-        futures = _get_chunk_upload_futures(
+    The second pass runs at a low fixed concurrency with longer timeouts so
+    files which failed under load get the link to themselves.
+    """
+    log.warn(
+        "Retrying {count} files which failed to upload.", count=len(failed))
+    retry_configuration = dict(configuration, concurrency=RETRY_CONCURRENCY)
+    still_failed = failures.FailedFiles()
+    timeouts = http.get_timeouts(session)
+    session.timeouts = timeouts.scaled(RETRY_TIMEOUT_SCALE)
+    try:
+        _upload_work(
+            log, session, retry_configuration, [failed.items()],
+            bulk_create_url, complete_url, mime_type, journal, duplicates,
+            failed=still_failed,
+        )
+    finally:
+        session.timeouts = timeouts
+    return still_failed
+
+
+def _upload_threaded(
+    log, session, chunks, bulk_create_url, mime_type, use_azure_client,
+    imageset_id, journal, limiter, sizer, blocks, committer, progress,
+    failed=None, warm=False
+):
+    # each worker keeps its own connections, the shared session is left to
+    # fetching signed urls and completing images
+    workers = sessions.SessionPool(session)
+    # storage clients are kept for reuse by every worker
+    containers = None
+    if use_azure_client:
+        containers = azure_blobs.ContainerClients(
+            blocks=blocks, timeouts=http.get_timeouts(session))
+    # large files to google storage can pick up where they broke off
+    resumable = gcs.ResumableUploads()
+    prefetcher = signing.Prefetcher(session, bulk_create_url)
+    executor = concurrent.futures.ThreadPoolExecutor(limiter.maximum)
+    try:
+        if warm:
+            # connect the first workers before any upload needs to, the
+            # storage host is only known from the signed urls so its
+            # connections are left to the first uploads
+            workers.warm(executor, [bulk_create_url], int(limiter.limit))
+        finished = _upload_chunks(
             executor,
-            paths,
-            session,
+            chunks,
+            workers,
             bulk_create_url,
-            complete_url,
+            committer.complete_url,
             log,
-            workload_size,
-            add_offset,
             mime_type,
             use_azure_client,
-            configuration["id"],
+            imageset_id,
+            journal,
+            limiter,
+            sizer,
+            containers,
+            resumable,
+            prefetcher,
+            committer,
+            progress,
+            failed,
         )
-        kwargs = {
-            'total': len(futures),
-            'unit': 'image',
-            'unit_scale': workload_size,
-            'leave': True
-        }
-        for f in tqdm(concurrent.futures.as_completed(futures), **kwargs):
+        # progress is counted by the uploads, only wait for them here
+        for count in finished:
             pass
-
-    _finish_replace_empty_imageset(session, replace_empty_url)
+    except BaseException:
+        # uploads already under way finish before giving up
+        executor.shutdown()
+        raise
+    finally:
+        # losing copies of chunks sent twice are not waited for, they stop
+        # at their next read or once their request times out
+        executor.shutdown(wait=False)
+        prefetcher.close()
+        workers.close()
+        if containers is not None:
+            containers.close()
 
 
 def optimal_workload_size(count):
@@ -413,40 +1058,44 @@ def delete(log, session, args):
     log.warn('delete imageset command coming soon.')
 
 
-def _resolve_paths(paths, should_recursive, ignore_mime, log):
-    """Resolve all paths to a list of files."""
-    allowed_ext = tuple(MIMES.keys())
-    blacklist_ext = BLACKLIST
-
-    resolved = []
-    for path in paths:
-        whitelisted = (path.lower().endswith(allowed_ext) or ignore_mime)
-        if os.path.isdir(path):
-            if should_recursive:
-                resolved.extend(
-                    _scan_directory_tree(path, allowed_ext, blacklist_ext, ignore_mime, log)
-                )
-            else:
-                resolved.extend(
-                    entry.path for entry in os.scandir(path)
-                    if entry.is_file() and (
-                        entry.name.lower().endswith(allowed_ext) or
-                        (ignore_mime and not entry.name.lower().endswith(blacklist_ext))
-                    )
-                )
-        elif os.path.isfile(path) and whitelisted:
-            resolved.append(path)
+def _iter_files(
+    paths, should_recursive, ignore_mime, log, include=None, exclude=None,
+    inventory=None
+):
+    """Yield (path, size) for each file to upload as it is found."""
+    file_filter = scanner.FileFilter(
+        tuple(MIMES.keys()), BLACKLIST, ignore_mime, include, exclude)
 
+    count = 0
     total_size = 0
     warned = False
-    for path in resolved:
-        size = os.path.getsize(path)
+    found = _iter_paths(
+        paths, should_recursive, file_filter, log, inventory)
+    for path, size in found:
         total_size += size
         if size > UPLOAD_WARNING_LIMIT and not warned:
-            log.warn("One or more files exceeds 256MB, collection processing may be unreliable.")
+            log.warn(
+                "One or more files exceeds 256MB, collection processing may"
+                " be unreliable.")
             warned = True
+        count += 1
+        yield path, size
+    if count == 0:
+        log.warn("No images detected, no images will be uploaded.")
     log.debug("Total upload size: {}".format(format_bytes(total_size)))
-    return resolved
+
+
+def _iter_paths(paths, should_recursive, file_filter, log, inventory=None):
+    for path in paths:
+        whitelisted = (
+            path.lower().endswith(file_filter.allowed_ext)
+            or file_filter.ignore_mime)
+        if os.path.isdir(path):
+            yield from scanner.walk(
+                path, file_filter, log, recursive=should_recursive,
+                inventory=inventory)
+        elif os.path.isfile(path) and whitelisted:
+            yield path, os.path.getsize(path)
 
 
 def format_bytes(size):
@@ -459,23 +1108,6 @@ def format_bytes(size):
     return "{}{}B".format(round(size, 2), power_labels[n])
 
 
-def _scan_directory_tree(path, allowed_ext, blacklist_ext, ignore_mime, log):
-    files = []
-    for entry in os.scandir(path):
-        whitelisted = entry.name.lower().endswith(allowed_ext)
-        if ignore_mime and not whitelisted:
-            whitelisted = True
-        # Some files should not be uploaded even if we are forcing mime type.
-        if entry.name.lower().endswith(blacklist_ext):
-            whitelisted = False
-            log.debug("Ignoring file due to disallowed extension: {}".format(entry.name))
-        if entry.is_file() and whitelisted:
-            files.append(entry.path)
-        if entry.is_dir():
-            files.extend(_scan_directory_tree(entry.path, allowed_ext, blacklist_ext, ignore_mime, log))
-    return files
-
-
 def _upload_image(path, session, create_url, complete_url, log, mime):
     file_name = os.path.basename(path)
     file_ext = os.path.splitext(path)[-1]
@@ -504,4 +1136,4 @@ def _upload_image(path, session, create_url, complete_url, log, mime):
             # confirm
             http.post_json(session, complete_url, info)
         except Exception as ex:
-            log.error("Upload failed: {}".format(ex))
+            log.error("Upload failed: {ex}", ex=ex)
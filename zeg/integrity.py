@@ -0,0 +1,65 @@
+# Copyright 2021 Zegami Ltd
+
+"""Checking uploaded content against what storage says it received."""
+
+import base64
+import hashlib
+import os
+
+
+class IntegrityError(Exception):
+    """Storage holds different content from what was sent."""
+
+
+class HashingReader(object):
+    """File wrapper taking the md5 of everything read through it.
+
+    Hashing happens as the upload reads the file, so checking costs no
+    second pass over the disk.
+    """
+
+    def __init__(self, f):
+        """Initialise reader."""
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.md5.update(data)
+        return data
+
+    def __len__(self):
+        # bytes left to send, for the Content-Length
+        position = self.f.tell()
+        end = self.f.seek(0, os.SEEK_END)
+        self.f.seek(position)
+        return end - position
+
+
+def stored_md5(headers):
+    """Get the md5 digest storage reports for an upload, if any.
+
+    Google storage sends x-goog-hash and azure sends Content-MD5, both
+    base64 encoded.
+    """
+    for part in headers.get('x-goog-hash', '').split(','):
+        part = part.strip()
+        if part.startswith('md5='):
+            return base64.b64decode(part[len('md5='):])
+    if headers.get('Content-MD5'):
+        return base64.b64decode(headers['Content-MD5'])
+    return None
+
+
+def check(headers, md5):
+    """Raise IntegrityError unless the stored md5 is the one sent.
+
+    Storage which reports no md5 is trusted.
+    """
+    stored = stored_md5(headers)
+    if stored is not None and stored != md5.digest():
+        raise IntegrityError(
+            'Uploaded content md5 {} does not match {}'.format(
+                base64.b64encode(stored).decode('ascii'),
+                base64.b64encode(md5.digest()).decode('ascii'),
+            ))
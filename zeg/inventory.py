@@ -0,0 +1,103 @@
+# Copyright 2021 Zegami Ltd
+
+"""On disk cache of directory listings for repeat scans of image roots."""
+
+import json
+import os
+import sqlite3
+import threading
+
+from . import auth
+
+INVENTORY_NAME = 'inventory.sqlite'
+
+# Listings are written in batches of this many directories.
+FLUSH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    files TEXT NOT NULL,
+    subdirs TEXT NOT NULL
+)
+"""
+
+
+def default_path():
+    """Get the inventory location in the users data directory."""
+    return os.path.join(auth._init_conf_location(), INVENTORY_NAME)
+
+
+class Inventory(object):
+    """Listings of directories keyed by path and modification time.
+
+    A directory's mtime changes whenever entries are added, removed or
+    renamed in it, so a listing stored under the same mtime still holds.
+    Files rewritten in place keep their directory mtime, the scanner checks
+    the size and mtime stored for each file it uses against the file.
+
+    Each listing is the (name, size, mtime_ns) of every regular file and the
+    names of subdirectories, unfiltered so any filter can be applied later.
+    """
+
+    def __init__(self, path):
+        """Open or create the inventory."""
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._pending = {}
+        with self._conn:
+            self._conn.execute(SCHEMA)
+
+    def lookup(self, path, mtime_ns):
+        """Get (files, subdirs) for a directory if unchanged, else None."""
+        with self._lock:
+            if path in self._pending:
+                row = self._pending[path]
+            else:
+                row = self._conn.execute(
+                    'SELECT mtime_ns, files, subdirs FROM directories'
+                    ' WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != mtime_ns:
+            return None
+        files = [tuple(entry) for entry in json.loads(row[1])]
+        return files, json.loads(row[2])
+
+    def store(self, path, mtime_ns, files, subdirs):
+        """Record a directory listing, forgetting subdirectories now gone."""
+        row = (mtime_ns, json.dumps(files), json.dumps(subdirs))
+        with self._lock:
+            previous = self._conn.execute(
+                'SELECT subdirs FROM directories WHERE path = ?',
+                (path,)).fetchone()
+            if previous is not None:
+                for name in set(json.loads(previous[0])) - set(subdirs):
+                    self._forget(os.path.join(path, name))
+            self._pending[path] = row
+            if len(self._pending) >= FLUSH_SIZE:
+                self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+    def _forget(self, path):
+        prefix = os.path.join(path, '')
+        self._pending = {
+            key: value for key, value in self._pending.items()
+            if key != path and not key.startswith(prefix)
+        }
+        with self._conn:
+            self._conn.execute(
+                'DELETE FROM directories WHERE path = ? OR'
+                ' substr(path, 1, ?) = ?', (path, len(prefix), prefix))
+
+    def _flush(self):
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO directories'
+                ' (path, mtime_ns, files, subdirs) VALUES (?, ?, ?, ?)',
+                [(path,) + row for path, row in self._pending.items()])
+        self._pending = {}
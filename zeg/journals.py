@@ -0,0 +1,141 @@
+# Copyright 2021 Zegami Ltd
+
+"""Local journal of imageset uploads so interrupted runs can resume."""
+
+import os
+import sqlite3
+import threading
+
+from . import auth
+
+# Slot reserved on the imageset by extend, file not yet in storage.
+RESERVED = 0
+# File is in storage under a known blob id, images_bulk not yet called.
+UPLOADED = 1
+# File has been recorded against the imageset by images_bulk.
+COMPLETE = 2
+
+JOURNAL_NAME = 'uploads.sqlite'
+
+# Paths looked up per query, under sqlite's limit on parameters.
+LOOKUP_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    imageset_id TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    blob_id TEXT,
+    state INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (imageset_id, slot)
+);
+CREATE INDEX IF NOT EXISTS uploads_path ON uploads (imageset_id, path);
+"""
+
+
+def default_path():
+    """Get the journal location in the users data directory."""
+    return os.path.join(auth._init_conf_location(), JOURNAL_NAME)
+
+
+class UploadJournal(object):
+    """Record of reserved imageset slots and their upload state.
+
+    A single sqlite connection is shared between the upload threads and
+    guarded by a lock. Writes are committed straight away so the journal
+    survives the process being killed, a chunk of files at a time so the
+    workers do not queue behind a sync to disk for every file. The journal
+    is write-ahead logged and only synced at checkpoints, losing at most
+    the last few chunks to a power cut, which are then uploaded again.
+    """
+
+    def __init__(self, path, imageset_id):
+        """Open or create the journal for an imageset."""
+        self.path = path
+        self.imageset_id = imageset_id
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def entries(self, paths=None):
+        """Get journalled files as a dict of path to (slot, blob, state).
+
+        Only the given paths are looked up if any are, so a resume need not
+        hold the whole journal in memory.
+        """
+        if paths is None:
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT path, slot, blob_id, state FROM uploads'
+                    ' WHERE imageset_id = ? ORDER BY slot',
+                    (self.imageset_id,),
+                ).fetchall()
+            return {row[0]: tuple(row[1:]) for row in rows}
+
+        paths = list(paths)
+        found = {}
+        for i in range(0, len(paths), LOOKUP_SIZE):
+            group = paths[i:i + LOOKUP_SIZE]
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT path, slot, blob_id, state FROM uploads'
+                    ' WHERE imageset_id = ? AND path IN ({})'
+                    ' ORDER BY slot'.format(', '.join('?' * len(group))),
+                    [self.imageset_id] + group,
+                ).fetchall()
+            found.update((row[0], tuple(row[1:])) for row in rows)
+        return found
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM uploads WHERE imageset_id = ?',
+                (self.imageset_id,),
+            ).fetchone()[0]
+
+    def reserve(self, start, paths):
+        """Record paths as occupying consecutive slots from start."""
+        rows = [
+            (self.imageset_id, start + i, path)
+            for i, path in enumerate(paths)
+        ]
+        self._write(
+            'INSERT OR REPLACE INTO uploads (imageset_id, slot, path)'
+            ' VALUES (?, ?, ?)', rows)
+
+    def uploaded(self, uploads):
+        """Mark slots as having their files in storage, from (slot, blob).
+
+        A slot already complete stays so, when a late second copy of its
+        upload finishes.
+        """
+        self._write(
+            'UPDATE uploads SET blob_id = ?, state = ?'
+            ' WHERE imageset_id = ? AND slot = ? AND state != ?',
+            [
+                (blob_id, UPLOADED, self.imageset_id, slot, COMPLETE)
+                for slot, blob_id in uploads
+            ])
+
+    def complete(self, slots):
+        """Mark slots as recorded against the imageset."""
+        self._write(
+            'UPDATE uploads SET state = ? WHERE imageset_id = ? AND slot = ?',
+            [(COMPLETE, self.imageset_id, slot) for slot in slots])
+
+    def clear(self):
+        """Forget every entry for the imageset."""
+        self._write(
+            'DELETE FROM uploads WHERE imageset_id = ?',
+            [(self.imageset_id,)])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _write(self, statement, rows):
+        with self._lock, self._conn:
+            self._conn.executemany(statement, rows)
@@ -0,0 +1,350 @@
+# Copyright 2021 Zegami Ltd
+
+"""Limits on how hard uploads push the network and the api."""
+
+import asyncio
+import math
+import os
+import threading
+import time
+
+import requests
+
+# Status codes that mean the server or a proxy wants us to slow down.
+THROTTLE_STATUSES = (408, 429, 502, 503, 504)
+
+THROTTLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+
+def is_throttle(ex):
+    """Check whether an upload failure is a sign of overloading."""
+    code = getattr(ex, 'code', None) or getattr(ex, 'status_code', None)
+    if code in THROTTLE_STATUSES:
+        return True
+    if isinstance(ex, THROTTLE_ERRORS):
+        return True
+    # azure and aiohttp timeouts do not share a common base class
+    return 'timeout' in type(ex).__name__.lower()
+
+
+class AdaptiveConcurrency(object):
+    """Additive increase, multiplicative decrease limit on uploads in flight.
+
+    Completed uploads are measured in windows of roughly limit uploads. The
+    limit doubles after each window while throughput keeps rising, then
+    grows by one after each window unless throughput fell, and is cut
+    by the backoff factor when a window's latency rises well above the best
+    seen or an upload is throttled. Cuts happen at most once per window so a
+    burst of failures from the same congestion only counts once.
+
+    Threads take a slot with acquire and hand it back with release, each
+    upload reports its outcome with success or failure.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=256, backoff=0.5,
+                 latency_tolerance=2.0, adaptive=True):
+        """Initialise limit, adaptive False keeps it fixed at initial."""
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.adaptive = adaptive
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._best_latency = None
+        self._throughput = None
+        self._slow_start = adaptive
+        self._new_window(time.monotonic())
+        self._last_decrease = None
+
+    def acquire(self):
+        """Block until the number in flight is under the limit."""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def success(self, elapsed, size=None):
+        """Record an upload of size bytes which took elapsed seconds."""
+        with self._cond:
+            self._count += 1
+            self._bytes += size or 1
+            self._elapsed += elapsed
+            if self._count >= int(self.limit):
+                self._end_window(time.monotonic())
+            self._cond.notify_all()
+
+    def failure(self, ex):
+        """Record a failed upload."""
+        with self._cond:
+            if is_throttle(ex):
+                self._decrease(time.monotonic())
+
+    def _new_window(self, now):
+        self._window_start = now
+        self._count = 0
+        self._bytes = 0
+        self._elapsed = 0.0
+
+    def _end_window(self, now):
+        latency = self._elapsed / self._count
+        throughput = self._bytes / max(now - self._window_start, 1e-6)
+        if self._best_latency is None or latency < self._best_latency:
+            self._best_latency = latency
+        if latency > self._best_latency * self.latency_tolerance:
+            self._decrease(now)
+            # let the baseline drift up in case the link itself changed
+            self._best_latency *= 1.1
+        elif self._slow_start:
+            last = self._throughput
+            if last is not None and throughput < 1.1 * last:
+                self._slow_start = False
+            self.limit = min(self.maximum, self.limit * 2)
+        elif self._throughput is None or throughput >= 0.9 * self._throughput:
+            if self.adaptive:
+                self.limit = min(self.maximum, self.limit + 1)
+        self._throughput = throughput
+        self._new_window(now)
+
+    def _decrease(self, now):
+        if not self.adaptive:
+            return
+        last = self._last_decrease
+        if last is not None and last >= self._window_start:
+            return
+        self._last_decrease = now
+        self._slow_start = False
+        self.limit = max(self.minimum, self.limit * self.backoff)
+        self._new_window(now)
+
+
+class TokenBucket(object):
+    """Paces takers to rate tokens a second, allowing bursts of up to burst.
+
+    Tokens are reserved rather than waited for under a lock, taking more
+    than there are leaves the bucket in debt and the taker is told how long
+    to wait for it to clear, so one bucket can pace threads and coroutines.
+    """
+
+    def __init__(self, rate, burst=None):
+        """Initialise bucket, full, burst defaulting to a second of tokens."""
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        """Take amount tokens, giving the seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            refill = (now - self._updated) * self.rate
+            self.tokens = min(self.burst, self.tokens + refill)
+            self._updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+# Names of the rate limits for api calls without one of their own, and for
+# bytes sent to storage.
+API = 'api'
+STORAGE = 'storage'
+
+# Suffixes of rates given as strings, like 20M for storage.
+RATE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(value):
+    """Get a rate from a number or a string with a K, M or G suffix."""
+    number, unit = value, 1
+    if isinstance(value, str):
+        number = value.strip()
+        unit = RATE_UNITS.get(number[-1:].upper())
+        if unit is None:
+            unit = 1
+        else:
+            number = number[:-1]
+    rate = float(number) * unit
+    if not (rate > 0 and math.isfinite(rate)):
+        raise ValueError('Rate must be more than zero: {}'.format(value))
+    return rate
+
+
+class RateLimits(object):
+    """Request rates for api endpoints and a byte rate for storage.
+
+    An api call is paced by the limit named after one of its path parts,
+    like signed_blob_url or images_bulk, or otherwise by the api limit.
+    Requests elsewhere are storage uploads, paced by the bytes they send.
+    Calls without a limit are not paced. The buckets are shared by every
+    thread using the session.
+    """
+
+    def __init__(self, api_prefix, rates):
+        """Initialise limits from a dict of rates by name."""
+        self.api_prefix = api_prefix
+        self.buckets = {
+            name: TokenBucket(parse_rate(rate))
+            for name, rate in rates.items()
+        }
+
+    def bucket(self, url):
+        """Get the bucket pacing requests to url, or None."""
+        if not url.startswith(self.api_prefix):
+            return self.buckets.get(STORAGE)
+        parts = url.split('?')[0][len(self.api_prefix):].split('/')
+        for part in parts:
+            if part in self.buckets and part not in (API, STORAGE):
+                return self.buckets[part]
+        return self.buckets.get(API)
+
+    def delay(self, url, size=0):
+        """Reserve a request to url sending size bytes, giving the wait."""
+        bucket = self.bucket(url)
+        if bucket is None:
+            return 0.0
+        if bucket is self.buckets.get(STORAGE):
+            return bucket.reserve(size) if size else 0.0
+        return bucket.reserve()
+
+
+def rate_limits(configuration):
+    """Get RateLimits for an upload configuration, None if it has none.
+
+    Rates are given as rate_limits, either a mapping of names to rates or
+    a list of name=rate strings from the command line.
+    """
+    rates = configuration.get('rate_limits')
+    if not rates:
+        return None
+    if not isinstance(rates, dict):
+        pairs = [rate.split('=', 1) for rate in rates]
+        if any(len(pair) != 2 for pair in pairs):
+            raise ValueError(
+                'Rate limits are given as name=rate: {}'.format(rates))
+        rates = dict(pairs)
+    return RateLimits(configuration['url'].rstrip('/') + '/api/', rates)
+
+
+# Seconds between looks at a bandwidth control file.
+CONTROL_CHECK = 1.0
+
+
+class Bandwidth(object):
+    """A cap on bytes a second uploaded, shared by every upload of a run.
+
+    Uploads read their files through reader, which waits as needed after
+    each read so the bytes go out no faster than the cap. The cap can be
+    changed while running with set_rate, or by writing a new rate to the
+    control file, which is looked at every CONTROL_CHECK seconds. A rate
+    of 0, or an empty file, lifts the cap.
+    """
+
+    def __init__(self, rate=None, control=None):
+        """Initialise bandwidth, rate None for no cap to start with."""
+        self.control = control
+        self.rate = None
+        self._bucket = None
+        self._checked = None
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Change the cap, None or 0 for none."""
+        rate = parse_rate(rate) if rate not in (None, 0, '0', '') else None
+        with self._lock:
+            self.rate = rate
+            self._bucket = TokenBucket(rate) if rate else None
+
+    def reserve(self, size):
+        """Take size bytes, giving the seconds to wait before sending them."""
+        self._check()
+        bucket = self._bucket
+        return bucket.reserve(size) if bucket is not None and size else 0.0
+
+    def reader(self, f, awaitable=False):
+        """Wrap an open file so reading it keeps to the cap.
+
+        With awaitable, reads give awaitables for asyncio uploads.
+        """
+        return ThrottledReader(f, self, awaitable)
+
+    def _check(self):
+        if self.control is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked
+            if checked is not None and now - checked < CONTROL_CHECK:
+                return
+            self._checked = now
+        try:
+            mtime = os.stat(self.control).st_mtime
+            if mtime == self._mtime:
+                return
+            with open(self.control) as f:
+                rate = f.read().strip()
+            self.set_rate(rate)
+        except (OSError, ValueError):
+            # keep the cap until the file can be read again
+            return
+        self._mtime = mtime
+
+
+class ThrottledReader(object):
+    """File wrapper holding back reads to keep to a Bandwidth cap.
+
+    Reads sleep the thread for the wait. Asyncio uploads use aread, which
+    reads the file off the event loop and awaits the wait instead. With
+    awaitable, read gives aread's awaitable for clients which await reads
+    that give one, like the async azure storage client.
+    """
+
+    def __init__(self, f, bandwidth, awaitable=False):
+        """Initialise reader."""
+        self.f = f
+        self.bandwidth = bandwidth
+        self.awaitable = awaitable
+
+    def read(self, size=-1):
+        if self.awaitable:
+            return self.aread(size)
+        data = self.f.read(size)
+        delay = self.bandwidth.reserve(len(data))
+        if delay:
+            time.sleep(delay)
+        return data
+
+    async def aread(self, size=-1):
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(None, self.f.read, size)
+        delay = self.bandwidth.reserve(len(data))
+        if delay:
+            await asyncio.sleep(delay)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def bandwidth(configuration):
+    """Get the Bandwidth for an upload configuration, None if uncapped.
+
+    The cap is given as max_bandwidth in bytes a second, like 5M, and can
+    be changed while running through the file at bandwidth_control.
+    """
+    rate = configuration.get('max_bandwidth')
+    control = configuration.get('bandwidth_control')
+    if not rate and not control:
+        return None
+    return Bandwidth(rate, control)
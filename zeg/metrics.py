@@ -0,0 +1,144 @@
+# Copyright 2021 Zegami Ltd
+
+"""Counters of an upload run, driven by the bytes read from each file."""
+
+import threading
+import time
+
+
+class UploadMetrics(object):
+    """Files and bytes found, sent and in flight during an upload.
+
+    Bytes are counted as the upload reads them from the files, so large
+    files move the counts while they are being sent rather than once the
+    chunk holding them finishes. Files already in storage from an
+    interrupted run are counted as done but left out of the byte totals
+    and rates. All methods are safe to call from any thread, and the
+    counters can be read directly or with snapshot.
+
+    A tqdm bar given as bar is kept in step, counting bytes with the file
+    counts and rate after it.
+    """
+
+    def __init__(self, bar=None):
+        """Initialise metrics."""
+        self.bar = bar
+        self.files_total = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.bytes_total = 0
+        self.bytes_sent = 0
+        self.in_flight = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, files, size):
+        """Count files of size bytes in total found to upload."""
+        with self._lock:
+            self.files_total += files
+            self.bytes_total += size
+            if self.bar is not None:
+                self.bar.total = self.bytes_total
+                self._show()
+                self.bar.refresh()
+
+    def skip(self, size):
+        """Count a file which needed no upload as done."""
+        with self._lock:
+            self.files_done += 1
+            self.bytes_total -= size
+            if self.bar is not None:
+                self.bar.total = self.bytes_total
+                self._show()
+
+    def start(self):
+        """Count a file as being uploaded."""
+        with self._lock:
+            self.in_flight += 1
+
+    def finish(self, ok=True):
+        """Count a file as no longer being uploaded."""
+        with self._lock:
+            self.in_flight -= 1
+        if ok:
+            self.done()
+        else:
+            self.fail()
+
+    def done(self, files=1):
+        """Count files as uploaded."""
+        with self._lock:
+            self.files_done += files
+            if self.bar is not None:
+                self._show()
+
+    def fail(self, files=1):
+        """Count files which could not be uploaded as done."""
+        with self._lock:
+            self.files_done += files
+            self.files_failed += files
+            if self.bar is not None:
+                self._show()
+
+    def sent(self, size):
+        """Count size more bytes read for upload."""
+        with self._lock:
+            self.bytes_sent += size
+            if self.bar is not None:
+                self.bar.update(size)
+
+    def reader(self, f):
+        """Wrap an open file so bytes read from it are counted."""
+        return CountingReader(f, self)
+
+    def snapshot(self):
+        """Get the counters and rates so far as a dict."""
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-6)
+            return {
+                'files_total': self.files_total,
+                'files_done': self.files_done,
+                'files_failed': self.files_failed,
+                'bytes_total': self.bytes_total,
+                'bytes_sent': self.bytes_sent,
+                'in_flight': self.in_flight,
+                'elapsed': elapsed,
+                'files_per_second': self.files_done / elapsed,
+                'bytes_per_second': self.bytes_sent / elapsed,
+            }
+
+    def _show(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        failed = ''
+        if self.files_failed:
+            failed = ', {} failed'.format(self.files_failed)
+        self.bar.set_postfix_str(
+            '{}/{} files{}, {:.1f} files/s, {} in flight'.format(
+                self.files_done, self.files_total, failed,
+                self.files_done / elapsed, self.in_flight),
+            refresh=False)
+
+
+class CountingReader(object):
+    """File wrapper counting bytes read into upload metrics.
+
+    Bytes read again after seeking back, as a retried upload does, are
+    only counted once.
+    """
+
+    def __init__(self, f, metrics):
+        """Initialise reader."""
+        self.f = f
+        self.metrics = metrics
+        self._furthest = f.tell()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        position = self.f.tell()
+        if position > self._furthest:
+            self.metrics.sent(position - self._furthest)
+            self._furthest = position
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
@@ -0,0 +1,63 @@
+# Copyright 2021 Zegami Ltd
+
+"""Compact storage for the paths of very many files."""
+
+import array
+import os
+
+
+class PathTable(object):
+    """Sequence of (path, size) for files, stored with shared prefixes.
+
+    Each directory is kept once, each file only costs its directory number,
+    its name's bytes and its size in flat arrays rather than a string and a
+    tuple of its own. Millions of files under deep directories fit in a
+    fraction of the memory of a list of full paths.
+    """
+
+    def __init__(self, files=()):
+        """Initialise table, adding any (path, size) given."""
+        self._directories = []
+        self._directory_numbers = {}
+        self._file_directories = array.array('I')
+        self._names = bytearray()
+        self._name_ends = array.array('Q')
+        self._sizes = array.array('Q')
+        self.extend(files)
+
+    def append(self, path, size):
+        directory, name = os.path.split(path)
+        number = self._directory_numbers.get(directory)
+        if number is None:
+            number = len(self._directories)
+            self._directories.append(directory)
+            self._directory_numbers[directory] = number
+        self._file_directories.append(number)
+        self._names += os.fsencode(name)
+        self._name_ends.append(len(self._names))
+        self._sizes.append(size)
+
+    def extend(self, files):
+        for path, size in files:
+            self.append(path, size)
+
+    def path(self, index):
+        """Get the full path of the file at index."""
+        start = self._name_ends[index - 1] if index > 0 else 0
+        name = os.fsdecode(bytes(self._names[start:self._name_ends[index]]))
+        return os.path.join(
+            self._directories[self._file_directories[index]], name)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('path table index out of range')
+        return self.path(index), self._sizes[index]
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.path(index), self._sizes[index]
@@ -0,0 +1,243 @@
+# Copyright 2021 Zegami Ltd
+
+"""Retrying failed requests without piling load onto a struggling server."""
+
+import email.utils
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests.adapters
+import urllib3.util.retry
+
+from . import integrity
+
+# Statuses meaning the request may well work if sent again later.
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# Failures to send a request, worth sending it again.
+RETRY_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    integrity.IntegrityError,
+)
+
+# Api posts safe to send again once they may have reached the server, by
+# the last part of their path. Other posts create or change something each
+# time they are made.
+RESENDABLE_POSTS = ('signed_blob_url', 'images_bulk')
+
+# Statuses which, with a Retry-After, mean a request was not acted on.
+REFUSED_STATUSES = (429, 503)
+
+# Longest wait between attempts, whatever the backoff or server asks for.
+MAX_BACKOFF = 60.0
+
+# Retries a budget holds in reserve, and the fraction of requests made that
+# are added to it, so retries stay a small share of the traffic.
+BUDGET_RESERVE = 20
+BUDGET_RATIO = 0.2
+
+
+def full_jitter(attempt, base, cap=MAX_BACKOFF):
+    """Get a random wait before retry number attempt, counting from zero.
+
+    Spreading waits over the whole backoff keeps the workers that failed
+    together from retrying together.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after(headers, now=None):
+    """Get the seconds a Retry-After header asks to wait, or None."""
+    value = (headers or {}).get('Retry-After')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        seconds = date.timestamp() - (time.time() if now is None else now)
+    return min(MAX_BACKOFF, max(0.0, seconds))
+
+
+class RetryBudget(object):
+    """Retries shared by all the requests of a run.
+
+    Every request adds ratio to the budget, up to reserve, and every retry
+    takes one. A burst of failures can use the reserve, a server failing
+    most requests only sees ratio retries per request however many workers
+    are sending them.
+    """
+
+    def __init__(self, reserve=BUDGET_RESERVE, ratio=BUDGET_RATIO):
+        """Initialise budget, starting full."""
+        self.reserve = reserve
+        self.ratio = ratio
+        self.balance = float(reserve)
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """Count a request made."""
+        with self._lock:
+            self.balance = min(self.reserve, self.balance + self.ratio)
+
+    def withdraw(self):
+        """Take a retry from the budget, giving whether there was one."""
+        with self._lock:
+            if self.balance < 1:
+                self.exhausted += 1
+                return False
+            self.balance -= 1
+            return True
+
+
+class BackoffRetry(urllib3.util.retry.Retry):
+    """Retry for urllib3 waiting with full jitter and drawing on a budget.
+
+    Retry-After is honoured up to MAX_BACKOFF. When the budget is spent the
+    last response is given back rather than retried.
+
+    With resendable, a tuple of path endings, other posts are only sent
+    again when they cannot have been acted on, after failing to connect or
+    being refused with a Retry-After.
+    """
+
+    def __init__(self, *args, budget=None, resendable=None, **kwargs):
+        super(BackoffRetry, self).__init__(*args, **kwargs)
+        self.budget = budget
+        self.resendable = resendable
+
+    def new(self, **kwargs):
+        retry = super(BackoffRetry, self).new(**kwargs)
+        retry.budget = self.budget
+        retry.resendable = self.resendable
+        return retry
+
+    def get_backoff_time(self):
+        if not self.history:
+            return 0
+        return full_jitter(len(self.history) - 1, self.backoff_factor)
+
+    def parse_retry_after(self, value):
+        return min(
+            MAX_BACKOFF, super(BackoffRetry, self).parse_retry_after(value))
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if not self._may_resend(method, url, response, error):
+            if error is not None:
+                raise error
+            raise urllib3.exceptions.MaxRetryError(
+                _pool, url, urllib3.exceptions.ResponseError(
+                    'not safe to send again'))
+        retry = super(BackoffRetry, self).increment(
+            method, url, response, error, _pool, _stacktrace)
+        is_redirect = response is not None and response.get_redirect_location()
+        budgeted = self.budget is not None and not is_redirect
+        if budgeted and not self.budget.withdraw():
+            raise urllib3.exceptions.MaxRetryError(
+                _pool, url, error or urllib3.exceptions.ResponseError(
+                    'retry budget spent'))
+        return retry
+
+    def _may_resend(self, method, url, response, error):
+        if self.resendable is None or (method or '').upper() != 'POST':
+            return True
+        if urlsplit(url or '').path.rsplit('/', 1)[-1] in self.resendable:
+            return True
+        if error is not None:
+            return self._is_connection_error(error)
+        return (
+            response is not None
+            and response.status in REFUSED_STATUSES
+            and 'Retry-After' in response.headers
+        )
+
+
+class RetryAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter adding each request made to the retry budget."""
+
+    def send(self, request, **kwargs):
+        budget = getattr(self.max_retries, 'budget', None)
+        if budget is not None:
+            budget.deposit()
+        return super(RetryAdapter, self).send(request, **kwargs)
+
+
+def api_retry(budget=None):
+    """Policy for api calls, small json bodies.
+
+    Posts are only sent again where that is safe, see BackoffRetry.
+    """
+    return BackoffRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUSES,
+        # post and put as well as the usual methods
+        allowed_methods=(
+            urllib3.util.retry.Retry.DEFAULT_ALLOWED_METHODS
+            | {'POST', 'PUT'}),
+        raise_on_status=False,
+        budget=budget,
+        resendable=RESENDABLE_POSTS,
+    )
+
+
+def storage_retry(budget=None):
+    """Policy for storage requests, only retried before the body is sent.
+
+    A file body cannot be sent again from here once read, RetryPolicy
+    retries uploads which fail after that.
+    """
+    return BackoffRetry(
+        total=3,
+        connect=3,
+        read=0,
+        status=0,
+        backoff_factor=0.5,
+        raise_on_status=False,
+        budget=budget,
+    )
+
+
+class RetryPolicy(object):
+    """When to retry a whole upload, and how long to wait first.
+
+    Used around requests whose body has to be read again from the file,
+    which the transport cannot do itself.
+    """
+
+    def __init__(self, attempts=5, backoff=1.0, statuses=RETRY_STATUSES,
+                 errors=RETRY_ERRORS, budget=None):
+        """Initialise policy, attempts counting the first."""
+        self.attempts = attempts
+        self.backoff = backoff
+        self.statuses = statuses
+        self.errors = errors
+        self.budget = budget
+
+    def delay(self, attempt, ex):
+        """Get the wait before retrying after attempt failed with ex, or None.
+
+        Attempts count from zero, None means give up.
+        """
+        if attempt + 1 >= self.attempts or not self.is_retryable(ex):
+            return None
+        if self.budget is not None and not self.budget.withdraw():
+            return None
+        wait = retry_after(getattr(ex, 'headers', None))
+        if wait is None:
+            wait = full_jitter(attempt, self.backoff)
+        return wait
+
+    def is_retryable(self, ex):
+        code = getattr(ex, 'code', None)
+        if code is not None:
+            return code in self.statuses
+        return isinstance(ex, self.errors)
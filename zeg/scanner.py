@@ -0,0 +1,152 @@
+# Copyright 2021 Zegami Ltd
+
+"""Find the files to upload under directory trees."""
+
+import concurrent.futures
+import fnmatch
+import os
+import re
+
+# Directories listed at once, listing is latency bound on network mounts.
+SCAN_WORKERS = 16
+
+
+class FileFilter(object):
+    """Decide which files in a directory are uploaded.
+
+    Extensions are matched against the lower cased name, include and exclude
+    are glob patterns matched against the path relative to the scanned
+    directory with / separators. All patterns are compiled once up front.
+    """
+
+    def __init__(self, allowed_ext, blacklist_ext, ignore_mime,
+                 include=None, exclude=None):
+        """Initialise filter."""
+        self.allowed_ext = allowed_ext
+        self.blacklist_ext = blacklist_ext
+        self.ignore_mime = ignore_mime
+        self.include = _compile_globs(include)
+        self.exclude = _compile_globs(exclude)
+
+    def __call__(self, name, relpath, log):
+        lower_name = name.lower()
+        # Some files should not be uploaded even if we are forcing mime type.
+        if lower_name.endswith(self.blacklist_ext):
+            log.debug(
+                "Ignoring file due to disallowed extension: {name}",
+                name=name)
+            return False
+        if not (self.ignore_mime or lower_name.endswith(self.allowed_ext)):
+            return False
+        if self.include is not None and not self.include.match(relpath):
+            return False
+        if self.exclude is not None and self.exclude.match(relpath):
+            return False
+        return True
+
+    @property
+    def uses_paths(self):
+        """Whether relative paths are needed, or names are enough."""
+        return self.include is not None or self.exclude is not None
+
+
+def _compile_globs(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join(
+        '(?:{})'.format(fnmatch.translate(pattern)) for pattern in patterns
+    ))
+
+
+def walk(root, file_filter, log, recursive=True, workers=SCAN_WORKERS,
+         inventory=None):
+    """Yield (path, size) for files under root as directories are listed.
+
+    Subdirectories are listed in parallel and without recursion, so deep
+    trees cannot hit the interpreter's recursion limit. Sizes come from the
+    directory entries, no file is looked at twice. With an inventory,
+    directories unchanged since they were stored are not listed again.
+    """
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(
+            _list_directory, root, '', file_filter, log, inventory)}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                yield from files
+                if recursive:
+                    pending.update(
+                        executor.submit(
+                            _list_directory, path, relpath, file_filter, log,
+                            inventory)
+                        for path, relpath in subdirs
+                    )
+
+
+def _list_directory(path, relpath, file_filter, log, inventory=None):
+    """List a directory, giving matching (path, size) and subdirectories."""
+    if inventory is not None:
+        return _list_directory_cached(
+            path, relpath, file_filter, log, inventory)
+    files = []
+    subdirs = []
+    uses_paths = file_filter.uses_paths
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # is_dir and is_file come from the listing on most platforms,
+            # only matching files need a stat call for their size
+            if entry.is_dir():
+                subdirs.append((entry.path, relpath + entry.name + '/'))
+            elif entry.is_file():
+                entry_relpath = relpath + entry.name if uses_paths else None
+                if file_filter(entry.name, entry_relpath, log):
+                    files.append((entry.path, entry.stat().st_size))
+    return files, subdirs
+
+
+def _list_directory_cached(path, relpath, file_filter, log, inventory):
+    # the mtime is taken before listing so a change made during the listing
+    # shows up as a different mtime next time
+    mtime_ns = os.stat(path).st_mtime_ns
+    listing = inventory.lookup(path, mtime_ns)
+    cached = listing is not None
+    if not cached:
+        listing = ([], [])
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    listing[1].append(entry.name)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    listing[0].append(
+                        (entry.name, stat.st_size, stat.st_mtime_ns))
+        inventory.store(path, mtime_ns, *listing)
+
+    all_files, subdir_names = listing
+    files = []
+    changed = False
+    for i, (name, size, file_mtime_ns) in enumerate(all_files):
+        if not file_filter(name, relpath + name, log):
+            continue
+        file_path = os.path.join(path, name)
+        if cached:
+            # files rewritten in place keep their directory's mtime, so
+            # each one to upload is looked at again, as a listing would
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, file_mtime_ns):
+                size = stat.st_size
+                all_files[i] = (name, size, stat.st_mtime_ns)
+                changed = True
+        files.append((file_path, size))
+    if changed:
+        inventory.store(path, mtime_ns, all_files, subdir_names)
+    subdirs = [
+        (os.path.join(path, name), relpath + name + '/')
+        for name in subdir_names
+    ]
+    return files, subdirs
@@ -0,0 +1,152 @@
+# Copyright 2021 Zegami Ltd
+
+"""A requests session for each upload worker, with its own connections."""
+
+import concurrent.futures
+import contextlib
+import threading
+
+import requests
+
+from . import http
+
+# Connections each worker keeps open per host, a worker only makes one
+# request at a time but a connection may still be draining.
+WORKER_POOL_SIZE = 2
+
+# Hosts each worker keeps connections to, the api and storage.
+WORKER_HOSTS = 4
+
+# Session settings copied to each worker's session.
+COPIED = (
+    'auth', 'proxies', 'verify', 'cert', 'trust_env', 'retry_policy',
+    'timeouts', 'rate_limits', 'bandwidth',
+)
+
+# Seconds to wait for all workers to be warming connections at once.
+WARM_WAIT = 10
+
+
+class SessionPool(object):
+    """Stands in for a session, giving each worker its own copy of it.
+
+    Sharing one session between every worker means sharing its connection
+    pool, which discards connections whenever more workers than its size
+    finish a request at once, and each is set up again with a new TLS
+    handshake. Copies keep their own keep-alive connections to the api and
+    storage hosts, mounted like the template's with the same retries, and
+    share its retry budget, rate limits, bandwidth, auth and timeouts.
+    Adapters which are not HTTPAdapters, like http2.Http2Adapter, already
+    share their connections between requests and are used by every copy.
+
+    A worker checks a copy out for each chunk and uses the pool as its
+    session meanwhile. Copies are handed back for the next chunk, so there
+    are only as many as chunks have run at once.
+    """
+
+    def __init__(self, template, pool_size=WORKER_POOL_SIZE,
+                 hosts=WORKER_HOSTS):
+        """Initialise pool."""
+        self.template = template
+        self.pool_size = pool_size
+        self.hosts = hosts
+        self.sessions = []
+        self._free = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.session(), name)
+
+    def session(self):
+        """Get the session checked out by the calling thread.
+
+        A thread without one checks one out until the pool is closed.
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._take()
+            self._local.session = session
+        return session
+
+    @contextlib.contextmanager
+    def checkout(self):
+        """Check out a session for the calling thread while in the block."""
+        session = self._take()
+        self._local.session = session
+        try:
+            yield session
+        finally:
+            self._local.session = None
+            with self._lock:
+                # the last used first, its connections are the freshest
+                self._free.append(session)
+
+    def warm(self, executor, urls, count):
+        """Open connections to urls from count sessions at once.
+
+        Each session sends a HEAD request to every url, whatever the answer
+        the connection is kept for later requests. The threads wait for
+        each other so count different sessions are warmed.
+        """
+        barrier = threading.Barrier(count)
+
+        def warm():
+            with self.checkout() as session:
+                for url in urls:
+                    try:
+                        timeout = http.get_timeouts(session)()
+                        with session.head(url, timeout=timeout):
+                            pass
+                    except requests.RequestException:
+                        pass
+                try:
+                    barrier.wait(WARM_WAIT)
+                except threading.BrokenBarrierError:
+                    pass
+
+        concurrent.futures.wait([executor.submit(warm) for _ in range(count)])
+
+    def close(self):
+        with self._lock:
+            for session in self.sessions:
+                session.close()
+            self.sessions = []
+            self._free = []
+
+    def _take(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        session = self._copy()
+        with self._lock:
+            self.sessions.append(session)
+        return session
+
+    def _copy(self):
+        session = requests.Session()
+        for attr in COPIED:
+            if hasattr(self.template, attr):
+                setattr(session, attr, getattr(self.template, attr))
+        session.headers = self.template.headers.copy()
+        for prefix, adapter in self.template.adapters.items():
+            if isinstance(adapter, requests.adapters.HTTPAdapter):
+                adapter = type(adapter)(
+                    max_retries=adapter.max_retries,
+                    pool_connections=self.hosts,
+                    pool_maxsize=self.pool_size,
+                )
+            session.mount(prefix, adapter)
+        return session
+
+
+def checkout(session):
+    """Check out a worker session when session is a SessionPool."""
+    if isinstance(session, SessionPool):
+        return session.checkout()
+    return _unpooled(session)
+
+
+@contextlib.contextmanager
+def _unpooled(session):
+    yield session
@@ -0,0 +1,106 @@
+# Copyright 2021 Zegami Ltd
+
+"""Fetching signed storage urls ahead of the uploads that need them."""
+
+import calendar
+import concurrent.futures
+import time
+from urllib.parse import parse_qs, urlparse
+
+from . import (
+    hedging,
+    http,
+)
+
+# Signed url requests to have in flight at once.
+PREFETCH_WORKERS = 4
+
+# Urls expiring sooner than this are fetched again rather than used, a chunk
+# must be able to start all its uploads before they expire.
+EXPIRY_MARGIN = 300
+
+# How long urls are assumed to last when they do not say.
+DEFAULT_LIFETIME = 3600
+
+
+class Prefetcher(object):
+    """Request signed urls in the background for chunks not yet started.
+
+    Requests slower than most are sent again through a hedging.Hedger.
+    """
+
+    def __init__(self, session, create_url, workers=PREFETCH_WORKERS,
+                 margin=EXPIRY_MARGIN):
+        """Initialise prefetcher."""
+        self.session = session
+        self.create_url = create_url
+        self.margin = margin
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.hedger = hedging.Hedger(workers=2 * workers)
+
+    def fetch(self, blob_ids):
+        """Start fetching urls for blob_ids, giving a Prefetch to wait on."""
+        future = self._executor.submit(self.request, blob_ids)
+        return Prefetch(self, blob_ids, future)
+
+    def request(self, blob_ids):
+        """Get (signed urls by blob id, expiry time) for blob_ids now."""
+        signed_urls = self.hedger.call(
+            http.post_json, self.session, self.create_url, {"ids": blob_ids})
+        return signed_urls, url_expiry(signed_urls.values(), time.time())
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.hedger.close()
+
+
+class Prefetch(object):
+    """Signed urls being fetched for one chunk."""
+
+    def __init__(self, prefetcher, blob_ids, future):
+        """Initialise prefetch."""
+        self.prefetcher = prefetcher
+        self.blob_ids = blob_ids
+        self.future = future
+
+    def result(self):
+        """Wait for the signed urls, fetching again if they are stale."""
+        signed_urls, expiry = self.future.result()
+        if expiry - time.time() < self.prefetcher.margin:
+            signed_urls, expiry = self.prefetcher.request(self.blob_ids)
+        return signed_urls
+
+
+def url_expiry(urls, fetched_at):
+    """Get the earliest time any of the signed urls stops working.
+
+    Understands azure SAS tokens and google v2 and v4 signatures, other
+    urls are taken to last DEFAULT_LIFETIME from when they were fetched.
+    """
+    expiry = fetched_at + DEFAULT_LIFETIME
+    for url in urls:
+        url_expires = _parse_expiry(url)
+        if url_expires is not None:
+            expiry = min(expiry, url_expires)
+    return expiry
+
+
+def _parse_expiry(url):
+    query = parse_qs(urlparse(url).query)
+    try:
+        if 'se' in query:
+            return _timestamp(query['se'][0], '%Y-%m-%dT%H:%M:%SZ')
+        if 'X-Goog-Expires' in query:
+            return (
+                _timestamp(query['X-Goog-Date'][0], '%Y%m%dT%H%M%SZ') +
+                int(query['X-Goog-Expires'][0])
+            )
+        if 'Expires' in query:
+            return int(query['Expires'][0])
+    except (KeyError, ValueError):
+        pass
+    return None
+
+
+def _timestamp(value, fmt):
+    return calendar.timegm(time.strptime(value, fmt))
@@ -1,8 +1,10 @@
 # Copyright 2018 Zegami Ltd
 """Test implementation of the python requests interface."""
 
+from http.server import HTTPServer
 import io
 import json
+import socketserver
 import unittest
 
 import requests.adapters
@@ -74,3 +76,12 @@ class FakeLogger(log.Logger):
 
     def __call__(self, format_string, **kwargs):
         self.entries.append(format_string.format(**kwargs))
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Local server answering each request in a thread.
+
+    As http.server.ThreadingHTTPServer, which is only in python 3.7 on.
+    """
+
+    daemon_threads = True
@@ -0,0 +1,143 @@
+# Copyright 2021 Zegami Ltd
+
+"""Async upload engine tests."""
+
+from http.server import BaseHTTPRequestHandler
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from . import FakeLogger, ThreadingHTTPServer
+from .. import (
+    aio,
+    failures,
+    imagesets,
+    workloads,
+)
+
+
+def _start_server(completed):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(
+                int(self.headers['Content-Length'])))
+            if 'signed_blob_url' in self.path:
+                reply = {
+                    i: '{}/storage/{}'.format(base, i) for i in body['ids']
+                }
+            else:
+                completed.append((self.path, body))
+                reply = {}
+            self.reply(json.dumps(reply).encode('utf-8'))
+
+        def do_PUT(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.reply(b'')
+
+        def reply(self, data):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, base
+
+
+@unittest.skipUnless(aio.have_aiohttp, 'aiohttp is not installed')
+class AsyncEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.work = []
+        for i in range(25):
+            path = os.path.join(self.tmp_dir, '{}.png'.format(i))
+            with open(path, 'wb') as f:
+                f.write(b'x' * (i + 1))
+            # leave a gap in slots as a resumed upload would
+            self.work.append(workloads.WorkItem(
+                i + 10 + (i > 12), path, None, i + 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _upload(self, engine):
+        completed = []
+        server, base = _start_server(completed)
+        try:
+            imagesets._upload_work(
+                FakeLogger(), requests.Session(),
+                {'id': 'ims', 'engine': engine},
+                [self.work], base + '/signed_blob_url', base + '/images_bulk',
+                None, None,
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+        # calls may be batched differently, compare the image in each slot
+        slots = {}
+        for path, body in completed:
+            start = int(path.rsplit('=', 1)[1])
+            for i, image in enumerate(body['images']):
+                blob_id = image.pop('blob_id')
+                self.assertTrue(blob_id.startswith('imagesets/ims/'))
+                slots[start + i] = image
+        return slots
+
+    def test_same_completions_as_threaded(self):
+        threaded = self._upload('thread')
+        self.assertEqual(len(threaded), 25)
+        self.assertEqual(self._upload('async'), threaded)
+
+    def test_chunk_error_kept_as_failures(self):
+        async def broken(engine, chunk):
+            raise RuntimeError('{broken}')
+
+        failed = failures.FailedFiles()
+        chunks = iter([(self.work[:2], 2), (self.work[2:3], 1)])
+        with mock.patch.object(aio._Engine, '_upload_chunk', broken):
+            aio.upload_chunks(
+                FakeLogger(), requests.Session(), chunks, 'http://create',
+                'http://complete', None, False, 'ims', failed=failed)
+        self.assertEqual(failed.items(), self.work[:3])
+
+    def test_chunk_source_error_stops_uploads(self):
+        started = []
+        cancelled = []
+
+        async def stuck(engine, chunk):
+            started.append(chunk)
+            try:
+                await aio.asyncio.sleep(60)
+            except aio.asyncio.CancelledError:
+                cancelled.append(chunk)
+                raise
+
+        def chunks():
+            yield self.work[:2], 2
+            while not started:
+                time.sleep(0.01)
+            raise OSError('scan failed')
+
+        with mock.patch.object(aio._Engine, '_upload_chunk', stuck), \
+                mock.patch.object(aio._Engine, 'close') as close:
+            close.side_effect = lambda: aio.asyncio.sleep(0)
+            with self.assertRaises(OSError):
+                aio.upload_chunks(
+                    FakeLogger(), requests.Session(), chunks(),
+                    'http://create', 'http://complete', None, False, 'ims')
+        self.assertEqual(cancelled, [self.work[:2]])
+        close.assert_called_once_with()
@@ -0,0 +1,54 @@
+# Copyright 2021 Zegami Ltd
+
+"""Azure blob helper tests."""
+
+import unittest
+
+from .. import azure_blobs
+
+ACCOUNT_URL = 'https://account.blob.core.windows.net'
+
+
+class ContainerClientsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.containers = azure_blobs.ContainerClients(max_clients=2)
+
+    def tearDown(self):
+        self.containers.close()
+
+    def test_reused_while_token_holds(self):
+        client = self.containers.get(ACCOUNT_URL, 'images', 'sig=a')
+        self.assertIs(
+            self.containers.get(ACCOUNT_URL, 'images', 'sig=a'), client)
+        self.assertEqual(client.container_name, 'images')
+
+    def test_new_token_shares_session(self):
+        first = self.containers.get(ACCOUNT_URL, 'images', 'sig=a')
+        second = self.containers.get(ACCOUNT_URL, 'images', 'sig=b')
+        self.assertIsNot(first, second)
+        self.assertIs(
+            first._pipeline._transport.session,
+            second._pipeline._transport.session)
+
+    def test_oldest_dropped(self):
+        first = self.containers.get(ACCOUNT_URL, 'images', 'sig=a')
+        self.containers.get(ACCOUNT_URL, 'images', 'sig=b')
+        self.containers.get(ACCOUNT_URL, 'images', 'sig=a')
+        self.containers.get(ACCOUNT_URL, 'images', 'sig=c')
+        self.assertIs(
+            self.containers.get(ACCOUNT_URL, 'images', 'sig=a'), first)
+        self.assertEqual(len(self.containers._clients), 2)
+
+
+class BlockPolicyTestCase(unittest.TestCase):
+    def test_large_files_staged_in_parallel(self):
+        blocks = azure_blobs.BlockPolicy(100, block_size=10, concurrency=4)
+        self.assertEqual(blocks.upload_kwargs(100), {})
+        self.assertEqual(blocks.upload_kwargs(101), {'max_concurrency': 4})
+
+    def test_clients_use_block_size(self):
+        blocks = azure_blobs.BlockPolicy(100, block_size=10)
+        containers = azure_blobs.ContainerClients(blocks=blocks)
+        client = containers.get(ACCOUNT_URL, 'images', 'sig=a')
+        self.assertEqual(client._config.max_block_size, 10)
+        containers.close()
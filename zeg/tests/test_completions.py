@@ -0,0 +1,105 @@
+# Copyright 2021 Zegami Ltd
+
+"""Image completion tests."""
+
+import requests
+
+from . import FakeLogger, HTTPBaseTestCase, ResolverAdapter
+from .. import (
+    completions,
+    failures,
+    workloads,
+)
+
+
+class FakeJournal(object):
+    def __init__(self):
+        self.completed = []
+
+    def complete(self, slots):
+        self.completed.extend(slots)
+
+
+class CommitterTestCase(HTTPBaseTestCase):
+    def _commit(self, adds, batch_size=completions.BATCH_SIZE):
+        session = self.make_session(200, {})
+        journal = FakeJournal()
+        committer = completions.Committer(
+            session, 'test:complete', FakeLogger(), journal,
+            batch_size=batch_size, flush_wait=60)
+        for start, results in adds:
+            committer.add(start, results)
+        committer.close()
+        log = session.adapters['test:'].log
+        calls = [
+            (url, [image['blob_id'] for image in body['images']])
+            for method, url, body, content_type in log
+        ]
+        return calls, sorted(journal.completed)
+
+    def test_joins_chunks_finished_out_of_order(self):
+        calls, completed = self._commit([
+            (12, [{'blob_id': 'c'}, {'blob_id': 'd'}]),
+            (10, [{'blob_id': 'a'}, {'blob_id': 'b'}]),
+            (14, [{'blob_id': 'e'}]),
+        ])
+        self.assertEqual(
+            calls, [('test:complete?start=10', ['a', 'b', 'c', 'd', 'e'])])
+        self.assertEqual(completed, [10, 11, 12, 13, 14])
+
+    def test_gaps_split_calls(self):
+        calls, completed = self._commit([
+            (0, [{'blob_id': 'a'}, None]),
+            (2, [{'blob_id': 'c'}]),
+            (5, [{'blob_id': 'f'}]),
+        ])
+        self.assertEqual(calls, [
+            ('test:complete?start=0', ['a']),
+            ('test:complete?start=2', ['c']),
+            ('test:complete?start=5', ['f']),
+        ])
+        self.assertEqual(completed, [0, 2, 5])
+
+    def test_batch_size_limits_calls(self):
+        calls, completed = self._commit(
+            [(0, [{'blob_id': str(i)} for i in range(5)])], batch_size=2)
+        self.assertEqual([url for url, blob_ids in calls], [
+            'test:complete?start=0',
+            'test:complete?start=2',
+            'test:complete?start=4',
+        ])
+        self.assertEqual(completed, [0, 1, 2, 3, 4])
+
+    def test_failed_call_not_journaled(self):
+        session = self.make_session(500, {})
+        journal = FakeJournal()
+        committer = completions.Committer(
+            session, 'test:complete', FakeLogger(), journal, flush_wait=60)
+        committer.add(0, [{'blob_id': 'a'}])
+        committer.close()
+        self.assertEqual(journal.completed, [])
+
+    def test_calls_after_failure_still_posted(self):
+        session = requests.Session()
+        adapter = ResolverAdapter(lambda url: (
+            url, 500 if url.endswith('start=0') else 200, {'error': 'down'}))
+        session.mount('test:', adapter)
+        journal = FakeJournal()
+        failed = failures.FailedFiles()
+        log = FakeLogger()
+        committer = completions.Committer(
+            session, 'test:complete', log, journal, batch_size=1,
+            flush_wait=60, failed=failed)
+        committer.add(0, [{'blob_id': 'a'}, {'blob_id': 'b'}], [
+            workloads.WorkItem(0, 'a.png', None, 1),
+            workloads.WorkItem(1, 'b.png', None, 2),
+        ])
+        committer.close()
+        self.assertEqual(
+            [url for method, url, body, content_type in adapter.log],
+            ['test:complete?start=0', 'test:complete?start=1'])
+        self.assertEqual(journal.completed, [1])
+        # kept with its blob, to be completed when tried again
+        self.assertEqual(
+            failed.items(), [workloads.WorkItem(0, 'a.png', 'a', 1)])
+        self.assertIn('down', failed.error(0))
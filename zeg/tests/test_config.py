@@ -2,12 +2,14 @@
 
 """Config tests."""
 
+from argparse import ArgumentParser
 import unittest
 from unittest.mock import patch, mock_open, MagicMock, ANY
 
 from jsonschema import exceptions as jx
 
 from .. import (
+    __main__,
     config,
     log,
 )
@@ -503,3 +505,34 @@ class TestValidateConfig(unittest.TestCase):
             ANY,
             err="123 is not of type 'string'",
         )
+
+
+class TestParseArgs(unittest.TestCase):
+
+    def _parse(self, argv, configuration):
+        parser = ArgumentParser()
+        parser.add_argument('--config')
+        __main__._add_upload_args(parser)
+        args = parser.parse_args(['--config', 'foo'] + argv)
+        with patch.object(config, 'parse_config', return_value=configuration):
+            return config.parse_args(args, logger)
+
+    def test_flags_not_given_keep_configuration(self):
+        configuration = self._parse([], {
+            'resume': True,
+            'warm_connections': True,
+            'blob_index': True,
+            'inventory_cache': True,
+        })
+        self.assertEqual(configuration, {
+            'resume': True,
+            'warm_connections': True,
+            'blob_index': True,
+            'inventory_cache': True,
+        })
+
+    def test_flags_given_override_configuration(self):
+        configuration = self._parse(
+            ['--resume', '--warm-connections'], {'resume': False})
+        self.assertEqual(
+            configuration, {'resume': True, 'warm_connections': True})
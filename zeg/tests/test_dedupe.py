@@ -0,0 +1,177 @@
+# Copyright 2021 Zegami Ltd
+
+"""Duplicate file tests."""
+
+import os
+import shutil
+import tempfile
+
+from . import FakeLogger, HTTPBaseTestCase
+from .. import (
+    blob_index,
+    completions,
+    dedupe,
+    workloads,
+)
+
+
+class DeduplicatorTestCase(HTTPBaseTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files = []
+        contents = [('a.png', b'one'), ('b.png', b'two'), ('c.png', b'one')]
+        for name, content in contents:
+            path = os.path.join(self.tmp_dir, name)
+            with open(path, 'wb') as f:
+                f.write(content)
+            self.files.append((path, len(content)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _work(self, start=0):
+        return [
+            workloads.WorkItem(start + i, path, None, size)
+            for i, (path, size) in enumerate(self.files)
+        ]
+
+    def test_unique_skips_later_copies(self):
+        duplicates = dedupe.Deduplicator(dedupe.SKIP, FakeLogger())
+        batches = duplicates.unique([self.files[:2], self.files[2:]])
+        self.assertEqual(
+            [list(batch) for batch in batches], [self.files[:2], []])
+        self.assertEqual(
+            (duplicates.duplicates, duplicates.duplicate_bytes), (1, 3))
+
+    def test_unreadable_files_passed_on(self):
+        duplicates = dedupe.Deduplicator(dedupe.SKIP, FakeLogger())
+        missing = [('/missing/a.png', 1), ('/missing/b.png', 1)]
+        self.assertEqual(
+            [list(batch) for batch in duplicates.unique([missing])],
+            [missing])
+
+    def test_reference_completes_copies(self):
+        session = self.make_session(200, {})
+        duplicates = dedupe.Deduplicator(dedupe.REFERENCE, FakeLogger())
+        committer = completions.Committer(
+            session, 'test:complete', FakeLogger(), duplicates=duplicates,
+            flush_wait=60)
+        work = list(duplicates.reference(
+            [self._work(), self._work(3)], committer))
+        self.assertEqual([item.slot for item in work[0]], [0, 1])
+        self.assertEqual(len(work[1]), 0)
+
+        committer.add(0, [
+            {'blob_id': 'x', 'name': 'a.png', 'size': 3,
+             'mimetype': 'image/png'},
+            {'blob_id': 'y', 'name': 'b.png', 'size': 3,
+             'mimetype': 'image/png'},
+        ])
+        # a copy found after its original was completed goes straight in
+        later = os.path.join(self.tmp_dir, 'd.png')
+        shutil.copy(self.files[1][0], later)
+        list(duplicates.reference(
+            [[workloads.WorkItem(6, later, None, 3)]], committer))
+        committer.close()
+
+        calls = [
+            (url, [
+                (image['blob_id'], image['name']) for image in body['images']
+            ])
+            for method, url, body, content_type
+            in session.adapters['test:'].log
+        ]
+        self.assertEqual(calls, [(
+            'test:complete?start=0',
+            [('x', 'a.png'), ('y', 'b.png'), ('x', 'c.png'), ('x', 'a.png'),
+             ('y', 'b.png'), ('x', 'c.png'), ('y', 'd.png')],
+        )])
+
+
+class BlobIndexTestCase(HTTPBaseTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'a.png')
+        with open(self.path, 'wb') as f:
+            f.write(b'content')
+        self.index_path = os.path.join(self.tmp_dir, blob_index.INDEX_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookup(self):
+        index = blob_index.BlobIndex(self.index_path)
+        index.record('project', b'digest', 7, 'blob', 'image/png', 'imageset')
+        index.close()
+        index = blob_index.BlobIndex(self.index_path)
+        self.assertEqual(
+            index.lookup('project', b'digest', 7), ('blob', 'image/png'))
+        self.assertIsNone(index.lookup('project', b'digest', 8))
+        self.assertIsNone(index.lookup('other', b'digest', 7))
+        index.close()
+
+    def test_blobs_of_deleted_imagesets_dropped(self):
+        index = blob_index.BlobIndex(self.index_path)
+        index.record('project', b'kept', 7, 'kept', 'image/png', 'live')
+        index.record('project', b'gone', 7, 'gone', 'image/png', 'deleted')
+        index.close()
+        asked = []
+
+        def exists(imageset_id):
+            asked.append(imageset_id)
+            return imageset_id == 'live'
+        index = blob_index.BlobIndex(self.index_path, exists)
+        self.assertIsNone(index.lookup('project', b'gone', 7))
+        self.assertEqual(
+            index.lookup('project', b'kept', 7), ('kept', 'image/png'))
+        self.assertEqual(
+            index.lookup('project', b'kept', 7), ('kept', 'image/png'))
+        self.assertEqual(asked, ['deleted', 'live'])
+        index.close()
+        index = blob_index.BlobIndex(self.index_path, lambda imageset_id: True)
+        self.assertIsNone(index.lookup('project', b'gone', 7))
+        index.close()
+
+    def test_unchecked_imagesets_not_used(self):
+        index = blob_index.BlobIndex(self.index_path)
+        index.record('project', b'digest', 7, 'blob', 'image/png', 'other')
+        index.close()
+        index = blob_index.BlobIndex(
+            self.index_path, lambda imageset_id: None)
+        self.assertIsNone(index.lookup('project', b'digest', 7))
+        index.close()
+        index = blob_index.BlobIndex(self.index_path)
+        self.assertEqual(
+            index.lookup('project', b'digest', 7), ('blob', 'image/png'))
+        index.close()
+
+    def _run(self, image=None):
+        session = self.make_session(200, {})
+        index = blob_index.BlobIndex(self.index_path)
+        duplicates = dedupe.Deduplicator(
+            dedupe.REFERENCE, FakeLogger(), index=index, project='project',
+            imageset='imageset')
+        committer = completions.Committer(
+            session, 'test:complete', FakeLogger(), duplicates=duplicates,
+            flush_wait=60)
+        work = list(duplicates.reference(
+            [[workloads.WorkItem(0, self.path, None, 7)]], committer))
+        if image is not None:
+            committer.add(0, [image])
+        committer.close()
+        index.close()
+        return work, session.adapters['test:'].log
+
+    def test_later_runs_reuse_blobs(self):
+        image = {
+            'blob_id': 'x', 'name': 'a.png', 'size': 7,
+            'mimetype': 'image/png',
+        }
+        work, calls = self._run(image)
+        self.assertEqual(len(work[0]), 1)
+
+        work, calls = self._run()
+        self.assertEqual([list(segment) for segment in work], [[]])
+        self.assertEqual(
+            [body for method, url, body, content_type in calls],
+            [{'images': [image]}])
@@ -0,0 +1,39 @@
+# Copyright 2021 Zegami Ltd
+
+"""Failed file tests."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import failures, workloads
+
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'failed.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        failed = failures.FailedFiles()
+        failed.add(workloads.WorkItem(9, '/b.png', 'blob', 2), IOError('gone'))
+        failed.add(workloads.WorkItem(3, '/a.png', None, 1), ValueError('500'))
+        failures.write_manifest(self.path, 'ims', failed)
+
+        self.assertEqual(failures.read_manifest(self.path, 'ims'), [
+            workloads.WorkItem(3, '/a.png', None, 1),
+            workloads.WorkItem(9, '/b.png', 'blob', 2),
+        ])
+        with self.assertRaises(ValueError):
+            failures.read_manifest(self.path, 'other')
+
+    def test_malformed(self):
+        for content in ('{"files": []}', '[]', '{"imageset_id": "ims"', '{'):
+            with open(self.path, 'w') as f:
+                f.write(content)
+            with self.assertRaises(ValueError):
+                failures.read_manifest(self.path, 'ims')
@@ -0,0 +1,184 @@
+# Copyright 2021 Zegami Ltd
+
+"""Google cloud storage upload tests."""
+
+import base64
+import hashlib
+from http.server import BaseHTTPRequestHandler
+import io
+import threading
+import unittest
+
+import requests
+
+from . import ThreadingHTTPServer
+from .. import (
+    gcs,
+    http,
+    integrity,
+    retries,
+)
+
+
+class FakeStorage(object):
+    """Resumable session endpoint that loses part of one chunk."""
+
+    def __init__(self, resumable=True, fail_at=None, corrupt=False,
+                 throttled=0):
+        self.resumable = resumable
+        self.throttled = throttled
+        self.fail_at = fail_at
+        self.corrupt = corrupt
+        self.data = b''
+        self.puts = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        storage = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                if storage.throttled:
+                    storage.throttled -= 1
+                    self.reply(429)
+                elif (storage.resumable and
+                      self.headers['x-goog-resumable'] == 'start'):
+                    self.reply(201, {'Location': storage.base + '/session'})
+                else:
+                    self.reply(403)
+
+            def do_PUT(self):
+                body = self.rfile.read(
+                    int(self.headers.get('Content-Length', 0)))
+                content_range = self.headers.get('Content-Range')
+                storage.puts.append(content_range)
+                if content_range is None:
+                    storage.data = body
+                    return self.reply(200, storage.hash_header())
+                span, size = content_range[len('bytes '):].split('/')
+                if span != '*':
+                    start = int(span.split('-')[0])
+                    if start != len(storage.data):
+                        return self.reply(400)
+                    fail_at = storage.fail_at
+                    if fail_at is not None and start >= fail_at:
+                        # keep half the chunk then fail
+                        storage.fail_at = None
+                        storage.data += body[:len(body) // 2]
+                        return self.reply(503)
+                    storage.data += body
+                if len(storage.data) == int(size):
+                    return self.reply(200, storage.hash_header())
+                headers = {}
+                if storage.data:
+                    headers['Range'] = 'bytes=0-{}'.format(
+                        len(storage.data) - 1)
+                self.reply(308, headers)
+
+            def reply(self, status, headers=()):
+                self.send_response(status)
+                for key, value in dict(headers).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def hash_header(self):
+        data = self.data[1:] if self.corrupt else self.data
+        md5 = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+        return {'x-goog-hash': 'crc32c=AAAAAA==, md5={}'.format(md5)}
+
+
+class ResumableUploadsTestCase(unittest.TestCase):
+    content = bytes(range(256)) * 40
+
+    def _upload(self, storage, uploads, retry_policy=None):
+        with requests.Session() as session:
+            session.retry_policy = retry_policy
+            uploads.put_file(
+                session, storage.base + '/blob', io.BytesIO(self.content),
+                len(self.content), 'image/png')
+
+    def test_resumes_after_failure(self):
+        storage = FakeStorage(fail_at=4096)
+        self.addCleanup(storage.close)
+        self._upload(
+            storage, gcs.ResumableUploads(threshold=0, chunk_size=2048))
+        self.assertEqual(storage.data, self.content)
+        self.assertEqual(storage.puts, [
+            'bytes 0-2047/10240',
+            'bytes 2048-4095/10240',
+            'bytes 4096-6143/10240',
+            'bytes */10240',
+            'bytes 5120-7167/10240',
+            'bytes 7168-9215/10240',
+            'bytes 9216-10239/10240',
+        ])
+
+    def test_gives_up_after_max_resumes(self):
+        storage = FakeStorage(fail_at=0)
+        self.addCleanup(storage.close)
+        uploads = gcs.ResumableUploads(
+            threshold=0, chunk_size=2048, max_resumes=0)
+        with self.assertRaises(http.ClientError):
+            self._upload(storage, uploads)
+
+    def test_single_put_when_not_signed_for_sessions(self):
+        storage = FakeStorage(resumable=False)
+        self.addCleanup(storage.close)
+        uploads = gcs.ResumableUploads(threshold=0)
+        self._upload(storage, uploads)
+        self.assertFalse(uploads.supported)
+        self.assertEqual(storage.data, self.content)
+        self.assertEqual(storage.puts, [None])
+
+    def test_throttled_start_retried(self):
+        storage = FakeStorage(throttled=2)
+        self.addCleanup(storage.close)
+        uploads = gcs.ResumableUploads(threshold=0, chunk_size=4096)
+        self._upload(storage, uploads, retries.RetryPolicy(backoff=0))
+        self.assertTrue(uploads.supported)
+        self.assertEqual(storage.data, self.content)
+        self.assertEqual(len(storage.puts), 3)
+
+    def test_throttled_start_fails_file(self):
+        storage = FakeStorage(throttled=1)
+        self.addCleanup(storage.close)
+        uploads = gcs.ResumableUploads(threshold=0)
+        with self.assertRaises(http.ClientError):
+            self._upload(storage, uploads)
+        # throttling says nothing about how the url was signed
+        self.assertTrue(uploads.supported)
+
+    def test_small_files_single_put(self):
+        storage = FakeStorage()
+        self.addCleanup(storage.close)
+        self._upload(
+            storage, gcs.ResumableUploads(threshold=len(self.content)))
+        self.assertEqual(storage.puts, [None])
+
+    def test_corruption_detected(self):
+        storage = FakeStorage(corrupt=True)
+        self.addCleanup(storage.close)
+        with self.assertRaises(integrity.IntegrityError):
+            self._upload(
+                storage, gcs.ResumableUploads(threshold=0, chunk_size=2048))
+
+    def test_corruption_detected_single_put(self):
+        storage = FakeStorage(corrupt=True)
+        self.addCleanup(storage.close)
+        with self.assertRaises(integrity.IntegrityError):
+            self._upload(
+                storage, gcs.ResumableUploads(threshold=len(self.content)))
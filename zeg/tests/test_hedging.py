@@ -0,0 +1,67 @@
+# Copyright 2021 Zegami Ltd
+
+"""Hedged request tests."""
+
+import io
+import threading
+import time
+import unittest
+
+from .. import hedging
+
+
+class HedgerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.hedger = hedging.Hedger(workers=4, min_samples=3)
+        self.addCleanup(self.hedger.close)
+
+    def test_no_hedge_until_timed(self):
+        self.assertIsNone(self.hedger.delay())
+        for seconds in (0.01, 0.02, 0.03):
+            self.hedger.observe(seconds)
+        self.assertEqual(self.hedger.delay(), 0.03)
+
+    def test_slow_call_hedged(self):
+        for _ in range(3):
+            self.hedger.observe(0.01)
+        calls = []
+        release = threading.Event()
+
+        def fetch():
+            calls.append(None)
+            if len(calls) == 1:
+                # the first copy hangs
+                release.wait(5)
+                return 'slow'
+            return 'fast'
+
+        started = time.monotonic()
+        self.assertEqual(self.hedger.call(fetch), 'fast')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.hedger.hedged, 1)
+        release.set()
+
+    def test_error_once_both_fail(self):
+        for _ in range(3):
+            self.hedger.observe(0.001)
+
+        def fail():
+            time.sleep(0.05)
+            raise ValueError('down')
+
+        with self.assertRaises(ValueError):
+            self.hedger.call(fail)
+
+    def test_claim(self):
+        claim = hedging.Claim()
+        self.assertTrue(claim.take())
+        self.assertFalse(claim.take())
+
+    def test_claimed_reader_stops_once_taken(self):
+        claim = hedging.Claim()
+        reader = claim.reader(io.BytesIO(b'content'))
+        self.assertEqual(reader.read(3), b'con')
+        claim.take()
+        with self.assertRaises(hedging.Cancelled):
+            reader.read(3)
+        self.assertEqual(reader.tell(), 3)
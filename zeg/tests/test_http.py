@@ -43,3 +43,9 @@ class ErrorHandlingTestCase(unittest.TestCase):
         self.assertEqual(headers, {
             'x-ms-blob-type': 'BlockBlob'
         })
+
+    def test_timeouts_grow_with_size(self):
+        timeouts = http.Timeouts(connect=5, read=30, allowance=1024)
+        self.assertEqual(timeouts(), (5, 30))
+        self.assertEqual(timeouts(10240), (5, 40))
+        self.assertEqual(timeouts.scaled(2)(10240), (10, 80))
@@ -0,0 +1,95 @@
+# Copyright 2021 Zegami Ltd
+
+"""HTTP/2 transport tests."""
+
+from http.server import BaseHTTPRequestHandler
+import io
+import json
+import socket
+import threading
+import unittest
+
+import requests
+
+from . import ThreadingHTTPServer
+from .. import (
+    http,
+    http2,
+)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(
+            (self.command, self.path, self.headers, b''))
+        if self.server.failures:
+            self.server.failures -= 1
+            self.reply(503, {'error': 'busy'})
+        else:
+            self.reply(200, {'path': self.path})
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(
+            (self.command, self.path, self.headers, body))
+        self.reply(201, None)
+
+    def reply(self, code, obj):
+        body = json.dumps(obj).encode() if obj is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        if body:
+            self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipUnless(http2.have_httpx, 'httpx is not installed')
+class Http2AdapterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.server.failures = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.session = http.make_session(
+            self.base, 'token', transport=http.HTTP2)
+        self.session.retry_policy.backoff = 0
+        self.addCleanup(self.session.close)
+
+    def test_get_json(self):
+        out = http.get(self.session, self.base + '/api/v0/thing')
+        self.assertEqual(out, {'path': '/api/v0/thing'})
+        headers = self.server.requests[0][2]
+        self.assertEqual(headers['Authorization'], 'Bearer token')
+
+    def test_put_file(self):
+        http.put_file(
+            self.session, self.base + '/blob', io.BytesIO(b'x' * 100000),
+            'image/png')
+        method, path, headers, body = self.server.requests[0]
+        self.assertEqual(body, b'x' * 100000)
+        self.assertEqual(headers['Content-Type'], 'image/png')
+
+    def test_api_retried(self):
+        self.server.failures = 2
+        adapter = self.session.get_adapter(self.base + '/api/')
+        adapter.max_retries.backoff_factor = 0
+        out = http.get(self.session, self.base + '/api/v0/thing')
+        self.assertEqual(out, {'path': '/api/v0/thing'})
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_connection_error(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            url = 'http://127.0.0.1:{}/blob'.format(s.getsockname()[1])
+        self.session.get_adapter(url).max_retries.backoff_factor = 0
+        with self.assertRaises(requests.ConnectionError):
+            http.get(self.session, url)
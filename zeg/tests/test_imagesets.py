@@ -2,8 +2,31 @@
 
 """Imageset tests."""
 
-from . import HTTPBaseTestCase
-from .. import imagesets
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from . import FakeLogger, HTTPBaseTestCase, ResolverAdapter
+from .. import (
+    failures,
+    hedging,
+    imagesets,
+    journals,
+    limits,
+    metrics,
+    workloads,
+)
+
+
+def _segments(tables):
+    return [list(table) for table in tables]
 
 
 class ImagesetTestCase(HTTPBaseTestCase):
@@ -44,3 +67,291 @@ class ImagesetTestCase(HTTPBaseTestCase):
               exp_imageset,
               'application/json')]
         )
+
+    def test_complete_workload_splits_on_failures(self):
+        session = self.make_session(200, {})
+        images = [{'blob_id': 'a'}, None, {'blob_id': 'c'}, {'blob_id': 'd'}]
+
+        imagesets._complete_workload(
+            session, "test:complete", FakeLogger(), 10, images, None)
+
+        self.assertEqual(
+            session.adapters["test:"].log,
+            [('POST', 'test:complete?start=10',
+              {'images': [{'blob_id': 'a'}]}, 'application/json'),
+             ('POST', 'test:complete?start=12',
+              {'images': [{'blob_id': 'c'}, {'blob_id': 'd'}]},
+              'application/json')]
+        )
+
+    def test_failed_files_kept_with_slots(self):
+        session = self.make_session(200, {})
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'a.png')
+        with open(path, 'wb') as f:
+            f.write(b'content')
+        paths = [path, os.path.join(tmp_dir, 'missing.png')]
+        workload_info = {
+            'start': 5, 'count': 2, 'blob_ids': [None, None], 'sizes': [7, 1]}
+        failed = failures.FailedFiles()
+
+        # no signed url comes back for the first, the second is gone
+        imagesets._upload_image_chunked(
+            paths, session, 'test:create', 'test:complete', FakeLogger(),
+            workload_info, None, imageset_id='ims', failed=failed)
+
+        self.assertEqual(failed.items(), [
+            workloads.WorkItem(5, paths[0], None, 7),
+            workloads.WorkItem(6, paths[1], None, 1),
+        ])
+
+    def test_losing_copy_stops(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        paths = []
+        for name in ('a.png', 'b.png'):
+            paths.append(os.path.join(tmp_dir, name))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'content')
+        claim = hedging.Claim()
+        session = requests.Session()
+        adapter = ResolverAdapter(
+            # the other copy completes the chunk during the first upload
+            lambda url: (url, 200, {}) if claim.take() else None)
+        session.mount('test:', adapter)
+        prefetch = mock.Mock(blob_ids=['x', 'y'])
+        prefetch.result.return_value = {'x': 'test:x', 'y': 'test:y'}
+        workload_info = {
+            'start': 0, 'count': 2, 'blob_ids': [None, None],
+            'sizes': [7, 7], 'claim': claim, 'prefetch': prefetch}
+        journal = mock.Mock()
+        committer = mock.Mock()
+        progress = metrics.UploadMetrics()
+        progress.add(2, 14)
+
+        imagesets._upload_image_chunked(
+            paths, session, 'test:create', 'test:complete', FakeLogger(),
+            workload_info, None, imageset_id='ims', journal=journal,
+            committer=committer, progress=progress)
+
+        self.assertEqual(
+            [url for method, url, body, content_type in adapter.log],
+            ['test:x'])
+        journal.uploaded.assert_not_called()
+        committer.add.assert_not_called()
+        self.assertEqual(progress.files_done, 2)
+        self.assertEqual(progress.files_failed, 0)
+
+    def test_chunk_journalled_once(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        paths = []
+        for name in ('a.png', 'b.png'):
+            paths.append(os.path.join(tmp_dir, name))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'content')
+        session = requests.Session()
+        session.mount('test:', ResolverAdapter(lambda url: (url, 200, {})))
+        prefetch = mock.Mock(blob_ids=['x', 'y'])
+        prefetch.result.return_value = {'x': 'test:x', 'y': 'test:y'}
+        workload_info = {
+            'start': 3, 'count': 2, 'blob_ids': [None, None],
+            'sizes': [7, 7], 'prefetch': prefetch}
+        journal = mock.Mock()
+
+        imagesets._upload_image_chunked(
+            paths, session, 'test:create', 'test:complete', FakeLogger(),
+            workload_info, None, imageset_id='ims', journal=journal,
+            committer=mock.Mock())
+
+        journal.uploaded.assert_called_once_with([(3, 'x'), (4, 'y')])
+
+    def test_signed_url_error_kept_as_failure(self):
+        # the error body holds braces, which must not be formatted again
+        session = self.make_session(500, {'error': 'unavailable'})
+        workload_info = {
+            'start': 0, 'count': 1, 'blob_ids': [None], 'sizes': [1]}
+        failed = failures.FailedFiles()
+        log = FakeLogger()
+
+        imagesets._upload_image_chunked(
+            ['a.png'], session, 'test:create', 'test:complete', log,
+            workload_info, None, imageset_id='ims', failed=failed)
+
+        self.assertEqual(
+            failed.items(), [workloads.WorkItem(0, 'a.png', None, 1)])
+        self.assertIn("{'error': 'unavailable'}", log.entries[0])
+
+    def test_replay_of_other_imageset_refused(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'failed.json')
+        failures.write_manifest(path, 'other', failures.FailedFiles())
+        configuration = {
+            'url': 'test:', 'project': 'p', 'id': 'ims', 'replay': path,
+            'file_config': {'paths': []},
+        }
+        log = FakeLogger()
+
+        with self.assertRaises(SystemExit):
+            imagesets._update_file_imageset(
+                log, self.make_session(200, {}), configuration)
+        self.assertIn('is for imageset other, not ims', log.entries[-1])
+
+    def test_imageset_exists(self):
+        configuration = {'url': 'test:', 'project': 'p'}
+        for code, exists in ((200, True), (404, False), (500, None)):
+            session = self.make_session(code, {})
+            self.assertIs(imagesets._imageset_exists(
+                FakeLogger(), session, configuration, 'other'), exists)
+            self.assertEqual(
+                session.adapters['test:'].log[0][1],
+                'test:/api/v0/project/p/imagesets/other')
+
+
+class ImagesetResumeTestCase(HTTPBaseTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.journal = journals.UploadJournal(
+            os.path.join(self.tmp_dir, journals.JOURNAL_NAME), 'ims')
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_plan_work_fresh(self):
+        session = self.make_session(200, {'new_size': 12})
+
+        work = _segments(imagesets._plan_work(
+            FakeLogger(), session, 'test:extend', [[('a', 1), ('b', 2)]],
+            self.journal, False))
+
+        self.assertEqual(work, [[(10, 'a', None, 1), (11, 'b', None, 2)]])
+        self.assertEqual(
+            session.adapters["test:"].log,
+            [('POST', 'test:extend', {'delta': 2}, 'application/json')])
+
+    def test_plan_work_extends_per_batch(self):
+        session = self.make_session(200, {'new_size': 12})
+
+        work = _segments(imagesets._plan_work(
+            FakeLogger(), session, 'test:extend',
+            [[('a', 1), ('b', 2)], [('c', 3)]], self.journal, False))
+
+        self.assertEqual(work, [
+            [(10, 'a', None, 1), (11, 'b', None, 2)],
+            [(11, 'c', None, 3)],
+        ])
+        self.assertEqual(
+            session.adapters["test:"].log,
+            [('POST', 'test:extend', {'delta': 2}, 'application/json'),
+             ('POST', 'test:extend', {'delta': 1}, 'application/json')])
+
+    def test_plan_work_resume(self):
+        self.journal.reserve(10, ['a', 'b', 'c'])
+        self.journal.uploaded([(11, 'blob-b')])
+        self.journal.complete([10])
+        session = self.make_session(200, {'new_size': 21})
+        files = [('d', 4), ('c', 3), ('b', 2), ('a', 1)]
+
+        work = _segments(imagesets._plan_work(
+            FakeLogger(), session, 'test:extend', [files],
+            self.journal, True))
+
+        self.assertEqual(work, [[
+            (11, 'b', 'blob-b', 2), (12, 'c', None, 3), (20, 'd', None, 4),
+        ]])
+        self.assertEqual(
+            session.adapters["test:"].log,
+            [('POST', 'test:extend', {'delta': 1}, 'application/json')])
+
+
+class DiscoverTestCase(unittest.TestCase):
+    def test_batches(self):
+        files = iter([('a', 1), ('b', 2), ('c', 3)])
+        self.assertEqual(
+            _segments(imagesets._discover(files, batch_size=2)),
+            [[('a', 1), ('b', 2)], [('c', 3)]])
+
+    def test_scan_error_raised(self):
+        def files():
+            yield ('a', 1)
+            raise OSError('gone')
+
+        with self.assertRaises(OSError):
+            list(imagesets._discover(files(), batch_size=2))
+
+
+class UploadChunksTestCase(unittest.TestCase):
+    def test_bounded_submission(self):
+        taken = []
+
+        def chunks():
+            for i in range(1000):
+                taken.append(i)
+                yield [workloads.WorkItem(i, 'p', None, 1)], 1
+
+        limiter = limits.AdaptiveConcurrency(4, adaptive=False)
+        with mock.patch.object(imagesets, '_upload_image_chunked'), \
+                concurrent.futures.ThreadPoolExecutor(4) as executor:
+            finished = imagesets._upload_chunks(
+                executor, chunks(), None, None, None, FakeLogger(), None,
+                False, 'ims', limiter=limiter)
+            first = next(finished)
+            # no more than the window is taken before work finishes
+            self.assertLessEqual(len(taken), 2 * 4 + 1)
+            self.assertEqual(first + sum(finished), 1000)
+
+    def test_chunk_error_kept_as_failures(self):
+        chunks = [([workloads.WorkItem(i, 'p', None, 1)], 1) for i in range(3)]
+
+        def upload(paths, session, create_url, complete_url, log,
+                   workload_info, *args):
+            if workload_info["start"] == 1:
+                raise RuntimeError('{broken}')
+
+        failed = failures.FailedFiles()
+        with mock.patch.object(imagesets, '_upload_image_chunked', upload), \
+                concurrent.futures.ThreadPoolExecutor(2) as executor:
+            finished = imagesets._upload_chunks(
+                executor, iter(chunks), None, None, None, FakeLogger(), None,
+                False, 'ims', failed=failed)
+            self.assertEqual(sum(finished), 2)
+        self.assertEqual(failed.items(), [workloads.WorkItem(1, 'p', None, 1)])
+
+    def test_straggler_sent_again(self):
+        chunks = [([workloads.WorkItem(i, 'p', None, 1)], 1) for i in range(3)]
+        starts = []
+        claimed = []
+        stopped = threading.Event()
+
+        def upload(paths, session, create_url, complete_url, log,
+                   workload_info, *args):
+            claim = workload_info["claim"]
+            starts.append(workload_info["start"])
+            if starts.count(0) == 1 and workload_info["start"] == 0:
+                # the first copy of the first chunk hangs until it loses
+                deadline = time.monotonic() + 5
+                while not claim.taken and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                claimed.append((workload_info["start"], claim.take()))
+                stopped.set()
+                return
+            claimed.append((workload_info["start"], claim.take()))
+
+        limiter = limits.AdaptiveConcurrency(4, adaptive=False)
+        sizer = workloads.WorkloadSizer(1, target_seconds=0.01)
+        with mock.patch.object(imagesets, '_upload_image_chunked', upload), \
+                mock.patch.object(hedging, 'STRAGGLER_CHECK', 0.02), \
+                concurrent.futures.ThreadPoolExecutor(4) as executor:
+            finished = imagesets._upload_chunks(
+                executor, iter(chunks), None, None, None, FakeLogger(), None,
+                False, 'ims', limiter=limiter, sizer=sizer)
+            # the run does not wait for the losing copy
+            self.assertEqual(sum(finished), 3)
+            self.assertTrue(stopped.wait(5))
+        self.assertEqual(sorted(starts), [0, 0, 1, 2])
+        # only one copy of the slow chunk completes it
+        self.assertEqual(
+            sorted(claimed), [(0, False), (0, True), (1, True), (2, True)])
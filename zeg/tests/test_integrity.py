@@ -0,0 +1,39 @@
+# Copyright 2021 Zegami Ltd
+
+"""Upload integrity tests."""
+
+import base64
+import hashlib
+import io
+import unittest
+
+from .. import integrity
+
+MD5 = hashlib.md5(b'content')
+ENCODED = base64.b64encode(MD5.digest()).decode('ascii')
+
+
+class IntegrityTestCase(unittest.TestCase):
+    def test_stored_md5(self):
+        self.assertEqual(
+            integrity.stored_md5(
+                {'x-goog-hash': 'crc32c=n03x6A==,md5=' + ENCODED}),
+            MD5.digest())
+        self.assertEqual(
+            integrity.stored_md5({'Content-MD5': ENCODED}), MD5.digest())
+        self.assertIsNone(integrity.stored_md5({'ETag': '"abc"'}))
+
+    def test_check(self):
+        integrity.check({'Content-MD5': ENCODED}, MD5)
+        integrity.check({}, hashlib.md5(b'other'))
+        with self.assertRaises(integrity.IntegrityError):
+            integrity.check({'Content-MD5': ENCODED}, hashlib.md5(b'other'))
+
+    def test_hashing_reader(self):
+        f = io.BytesIO(b'skip content')
+        f.seek(5)
+        reader = integrity.HashingReader(f)
+        self.assertEqual(len(reader), 7)
+        while reader.read(3):
+            pass
+        self.assertEqual(reader.md5.digest(), MD5.digest())
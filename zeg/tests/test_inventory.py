@@ -0,0 +1,126 @@
+# Copyright 2021 Zegami Ltd
+
+"""File inventory tests."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from . import FakeLogger
+from .. import (
+    imagesets,
+    inventory,
+    scanner,
+)
+
+
+class InventoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, inventory.INVENTORY_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookup_by_mtime(self):
+        files = inventory.Inventory(self.path)
+        files.store('/a', 5, [('x.jpg', 10, 3)], ['b'])
+        files.close()
+        files = inventory.Inventory(self.path)
+        self.assertEqual(files.lookup('/a', 5), ([('x.jpg', 10, 3)], ['b']))
+        self.assertIsNone(files.lookup('/a', 6))
+        self.assertIsNone(files.lookup('/c', 5))
+        files.close()
+
+    def test_forgets_removed_subdirectories(self):
+        files = inventory.Inventory(self.path)
+        files.store('/a', 1, [], ['b', 'c'])
+        files.store('/a/b', 1, [], ['d'])
+        files.store('/a/b/d', 1, [], [])
+        files.store('/a/bb', 1, [], [])
+        files.close()
+        files = inventory.Inventory(self.path)
+        files.store('/a', 2, [], ['c'])
+        self.assertIsNone(files.lookup('/a/b', 1))
+        self.assertIsNone(files.lookup('/a/b/d', 1))
+        self.assertEqual(files.lookup('/a/bb', 1), ([], []))
+        files.close()
+
+
+class CachedWalkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.inventory_dir = tempfile.mkdtemp()
+        self.inventory_path = os.path.join(
+            self.inventory_dir, 'inventory.sqlite')
+        relpaths = ['a.jpg', 'sub/b.jpg', 'sub/deeper/c.jpg', 'other/d.txt']
+        for relpath in relpaths:
+            self._write(relpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.inventory_dir)
+
+    def _write(self, relpath):
+        path = os.path.join(self.root, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * len(relpath))
+        directory = os.path.dirname(path)
+        os.utime(directory, ns=(0, len(os.listdir(directory))))
+
+    def _walk(self):
+        file_filter = scanner.FileFilter(
+            tuple(imagesets.MIMES.keys()), imagesets.BLACKLIST, False)
+        listed = []
+        scandir = os.scandir
+
+        def counting_scandir(path):
+            listed.append(os.path.relpath(path, self.root))
+            return scandir(path)
+
+        files = inventory.Inventory(self.inventory_path)
+        with mock.patch('os.scandir', counting_scandir):
+            found = sorted(
+                (os.path.relpath(path, self.root), size)
+                for path, size in scanner.walk(
+                    self.root, file_filter, FakeLogger(), inventory=files)
+            )
+        files.close()
+        return found, sorted(listed)
+
+    def test_only_changed_directories_listed(self):
+        found, listed = self._walk()
+        self.assertEqual(found, [
+            ('a.jpg', 5), ('sub/b.jpg', 9), ('sub/deeper/c.jpg', 16)])
+        self.assertEqual(listed, ['.', 'other', 'sub', 'sub/deeper'])
+
+        found_again, listed = self._walk()
+        self.assertEqual(found_again, found)
+        self.assertEqual(listed, [])
+
+        self._write('sub/deeper/e.png')
+        found, listed = self._walk()
+        self.assertIn(('sub/deeper/e.png', 16), found)
+        self.assertEqual(listed, ['sub/deeper'])
+
+    def test_file_rewritten_in_place(self):
+        self._walk()
+        path = os.path.join(self.root, 'sub', 'b.jpg')
+        directory_mtime = os.stat(os.path.dirname(path)).st_mtime_ns
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        os.utime(path, ns=(0, 1))
+        os.utime(os.path.dirname(path), ns=(0, directory_mtime))
+
+        found, listed = self._walk()
+        self.assertIn(('sub/b.jpg', 100), found)
+        self.assertEqual(listed, [])
+        # and the new size is stored for the next scan
+        files = inventory.Inventory(self.inventory_path)
+        self.assertIn(
+            ('b.jpg', 100, 1),
+            files.lookup(os.path.dirname(path), directory_mtime)[0])
+        files.close()
@@ -0,0 +1,70 @@
+# Copyright 2021 Zegami Ltd
+
+"""Upload journal tests."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import journals
+
+
+class UploadJournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, journals.JOURNAL_NAME)
+        self.journal = journals.UploadJournal(self.path, 'ims')
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reserve_and_complete(self):
+        self.journal.reserve(10, ['a.jpg', 'b.jpg', 'c.jpg'])
+        self.journal.uploaded([(11, 'blob-b')])
+        self.journal.complete([10])
+        self.assertEqual(self.journal.entries(), {
+            'a.jpg': (10, None, journals.COMPLETE),
+            'b.jpg': (11, 'blob-b', journals.UPLOADED),
+            'c.jpg': (12, None, journals.RESERVED),
+        })
+        self.journal.complete([11])
+        self.assertEqual(
+            self.journal.entries()['b.jpg'],
+            (11, 'blob-b', journals.COMPLETE))
+
+    def test_late_upload_keeps_complete(self):
+        self.journal.reserve(0, ['a.jpg'])
+        self.journal.uploaded([(0, 'blob-a')])
+        self.journal.complete([0])
+        # the losing copy of a chunk sent twice finishes afterwards
+        self.journal.uploaded([(0, 'blob-b')])
+        self.assertEqual(
+            self.journal.entries()['a.jpg'], (0, 'blob-a', journals.COMPLETE))
+
+    def test_survives_reopen(self):
+        self.journal.reserve(0, ['a.jpg'])
+        self.journal.close()
+        self.journal = journals.UploadJournal(self.path, 'ims')
+        self.assertEqual(
+            self.journal.entries(), {'a.jpg': (0, None, journals.RESERVED)})
+
+    def test_scoped_to_imageset(self):
+        other = journals.UploadJournal(self.path, 'other')
+        other.reserve(0, ['a.jpg'])
+        self.journal.reserve(5, ['b.jpg'])
+        other.clear()
+        other.close()
+        self.assertEqual(
+            self.journal.entries(), {'b.jpg': (5, None, journals.RESERVED)})
+
+    def test_lookup_paths(self):
+        paths = ['{}.jpg'.format(i) for i in range(journals.LOOKUP_SIZE * 2)]
+        self.journal.reserve(0, paths)
+        self.assertEqual(len(self.journal), len(paths))
+        found = self.journal.entries(paths[-3:] + ['missing.jpg'])
+        self.assertEqual(sorted(found), sorted(paths[-3:]))
+        self.assertEqual(
+            found[paths[-1]], (len(paths) - 1, None, journals.RESERVED))
+        self.assertEqual(len(self.journal.entries(paths)), len(paths))
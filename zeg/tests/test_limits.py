@@ -0,0 +1,187 @@
+# Copyright 2021 Zegami Ltd
+
+"""Upload limit tests."""
+
+import asyncio
+import io
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from .. import (
+    http,
+    limits,
+)
+
+
+class FakeResponse(object):
+    status_code = 503
+    content = b''
+
+    def json(self):
+        raise ValueError('No JSON')
+
+
+class AdaptiveConcurrencyTestCase(unittest.TestCase):
+    def _window(self, limiter, elapsed=1.0, size=100):
+        for i in range(int(limiter.limit)):
+            limiter.success(elapsed, size)
+
+    def test_slow_start_then_additive(self):
+        limiter = limits.AdaptiveConcurrency(4, maximum=64)
+        self._window(limiter)
+        self.assertEqual(limiter.limit, 8)
+        # throughput no longer rising ends slow start
+        limiter._throughput = float('inf')
+        self._window(limiter)
+        self.assertEqual(limiter.limit, 16)
+        limiter._throughput = 0
+        self._window(limiter)
+        self.assertEqual(limiter.limit, 17)
+
+    def test_throttle_halves_once_per_window(self):
+        limiter = limits.AdaptiveConcurrency(16)
+        error = http.ClientError(FakeResponse())
+        limiter.failure(error)
+        limiter.failure(error)
+        self.assertEqual(limiter.limit, 8)
+        self._window(limiter)
+        limiter.failure(error)
+        self.assertEqual(limiter.limit, 4.5)
+
+    def test_rising_latency_backs_off(self):
+        limiter = limits.AdaptiveConcurrency(16)
+        self._window(limiter, elapsed=1.0)
+        self.assertEqual(limiter.limit, 32)
+        self._window(limiter, elapsed=5.0)
+        self.assertEqual(limiter.limit, 16)
+
+    def test_ignores_other_failures(self):
+        limiter = limits.AdaptiveConcurrency(16)
+        limiter.failure(KeyError('blob'))
+        self.assertEqual(limiter.limit, 16)
+
+    def test_fixed(self):
+        limiter = limits.AdaptiveConcurrency(16, adaptive=False)
+        self._window(limiter)
+        limiter.failure(http.ClientError(FakeResponse()))
+        self.assertEqual(limiter.limit, 16)
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_burst_then_paced(self):
+        bucket = limits.TokenBucket(10, burst=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        # further takers queue up behind each other
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+
+    def test_large_take_waits_for_debt(self):
+        bucket = limits.TokenBucket(100)
+        self.assertAlmostEqual(bucket.reserve(300), 2, places=2)
+
+
+class RateLimitsTestCase(unittest.TestCase):
+    api = 'https://zegami.com/api/'
+
+    def test_parse_rate(self):
+        self.assertEqual(limits.parse_rate('2.5'), 2.5)
+        self.assertEqual(limits.parse_rate('20M'), 20 * 1024 * 1024)
+        self.assertEqual(limits.parse_rate(4), 4)
+        for value in ('0', '0K', '-5M', '-1', 'nan', 'inf', 'M'):
+            with self.assertRaises(ValueError):
+                limits.parse_rate(value)
+
+    def test_bucket_by_endpoint(self):
+        rate_limits = limits.RateLimits(
+            self.api, {'images_bulk': 5, 'api': 20, 'storage': '1M'})
+        bulk = self.api + 'v0/project/p/imagesets/i/images_bulk'
+        signed = self.api + 'v1/project/p/signed_blob_url'
+        self.assertIs(
+            rate_limits.bucket(bulk), rate_limits.buckets['images_bulk'])
+        self.assertIs(rate_limits.bucket(signed), rate_limits.buckets['api'])
+        storage = 'https://storage.googleapis.com/bucket/blob?sig=images_bulk'
+        self.assertIs(
+            rate_limits.bucket(storage), rate_limits.buckets['storage'])
+
+    def test_storage_paced_by_bytes(self):
+        rate_limits = limits.RateLimits(self.api, {'storage': 1000})
+        self.assertEqual(rate_limits.delay(self.api + 'v0/project/p'), 0)
+        self.assertEqual(rate_limits.delay('https://storage/blob', 1000), 0)
+        self.assertAlmostEqual(
+            rate_limits.delay('https://storage/blob', 500), 0.5, places=2)
+
+    def test_from_configuration(self):
+        configuration = {
+            'url': 'https://zegami.com',
+            'rate_limits': ['images_bulk=5', 'storage=10M'],
+        }
+        rate_limits = limits.rate_limits(configuration)
+        self.assertEqual(rate_limits.api_prefix, self.api)
+        self.assertEqual(rate_limits.buckets['storage'].rate, 10 * 1024 * 1024)
+        self.assertIsNone(limits.rate_limits({'url': 'https://zegami.com'}))
+        with self.assertRaises(ValueError):
+            limits.rate_limits(
+                dict(configuration, rate_limits=['images_bulk']))
+
+
+class BandwidthTestCase(unittest.TestCase):
+    def test_reader_kept_to_cap(self):
+        bandwidth = limits.Bandwidth('10K')
+        f = bandwidth.reader(io.BytesIO(b'x' * 15 * 1024))
+        self.assertEqual(len(f.read(10 * 1024)), 10 * 1024)
+        # the next read is only given once the cap allows
+        started = time.monotonic()
+        f.read(1024)
+        self.assertGreater(time.monotonic() - started, 0.05)
+        self.assertAlmostEqual(bandwidth.reserve(1024), 0.1, places=1)
+        self.assertEqual(f.tell(), 11 * 1024)
+
+    def test_awaitable_reads_wait_for_cap(self):
+        waits = []
+
+        async def sleep(delay):
+            waits.append(delay)
+
+        def run(awaitable):
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(awaitable)
+            finally:
+                loop.close()
+
+        bandwidth = limits.Bandwidth(1000)
+        f = bandwidth.reader(io.BytesIO(b'x' * 2000), awaitable=True)
+        with mock.patch.object(limits.asyncio, 'sleep', sleep):
+            self.assertEqual(run(f.read(1000)), b'x' * 1000)
+            self.assertEqual(run(f.aread()), b'x' * 1000)
+        # only the read going over the cap waits
+        self.assertEqual(len(waits), 1)
+        self.assertGreater(waits[0], 0.5)
+        self.assertEqual(f.tell(), 2000)
+
+    def test_uncapped(self):
+        bandwidth = limits.Bandwidth()
+        self.assertEqual(bandwidth.reserve(10 ** 9), 0)
+
+    def test_control_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            control = os.path.join(directory, 'bandwidth')
+            bandwidth = limits.Bandwidth(1000, control)
+            # missing file keeps the cap
+            bandwidth.reserve(0)
+            self.assertEqual(bandwidth.rate, 1000)
+            with open(control, 'w') as f:
+                f.write('2M\n')
+            bandwidth._checked = None
+            bandwidth.reserve(0)
+            self.assertEqual(bandwidth.rate, 2 * 1024 * 1024)
+            with open(control, 'w') as f:
+                f.write('')
+            os.utime(control, (0, 0))
+            bandwidth._checked = None
+            self.assertEqual(bandwidth.reserve(10 ** 9), 0)
+            self.assertIsNone(bandwidth.rate)
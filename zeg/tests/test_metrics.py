@@ -0,0 +1,36 @@
+# Copyright 2021 Zegami Ltd
+
+"""Upload metrics tests."""
+
+import io
+import unittest
+
+from .. import metrics
+
+
+class UploadMetricsTestCase(unittest.TestCase):
+    def test_counts(self):
+        progress = metrics.UploadMetrics()
+        progress.add(4, 100)
+        progress.skip(10)
+        progress.start()
+        progress.start()
+        self.assertEqual(progress.in_flight, 2)
+        progress.finish()
+        progress.finish(ok=False)
+        progress.fail()
+        snapshot = progress.snapshot()
+        self.assertEqual(snapshot['files_total'], 4)
+        self.assertEqual(snapshot['files_done'], 4)
+        self.assertEqual(snapshot['files_failed'], 2)
+        self.assertEqual(snapshot['bytes_total'], 90)
+        self.assertEqual(snapshot['in_flight'], 0)
+
+    def test_reader_counts_bytes_once(self):
+        progress = metrics.UploadMetrics()
+        reader = progress.reader(io.BytesIO(b'0123456789'))
+        reader.read(6)
+        # a retry reads the start again
+        reader.seek(0)
+        self.assertEqual(reader.read(), b'0123456789')
+        self.assertEqual(progress.bytes_sent, 10)
@@ -0,0 +1,37 @@
+# Copyright 2021 Zegami Ltd
+
+"""Path table tests."""
+
+import os
+import unittest
+
+from .. import paths
+
+
+class PathTableTestCase(unittest.TestCase):
+    files = [
+        ('/data/study/a.png', 10),
+        ('/data/study/b.png', 0),
+        ('/data/other/éè.jpg', 2 ** 40),
+        ('c.jpg', 3),
+        (os.fsdecode(b'/data/study/bad\xff.png'), 7),
+    ]
+
+    def test_round_trip(self):
+        table = paths.PathTable(self.files)
+        self.assertEqual(len(table), len(self.files))
+        self.assertEqual(list(table), self.files)
+        self.assertEqual(table[2], self.files[2])
+        self.assertEqual(table[-1], self.files[-1])
+        self.assertEqual(table.path(3), 'c.jpg')
+
+    def test_index_out_of_range(self):
+        table = paths.PathTable(self.files[:1])
+        with self.assertRaises(IndexError):
+            table[1]
+        with self.assertRaises(IndexError):
+            table[-2]
+
+    def test_directories_shared(self):
+        table = paths.PathTable(self.files)
+        self.assertEqual(len(table._directories), 3)
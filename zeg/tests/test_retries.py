@@ -0,0 +1,144 @@
+# Copyright 2021 Zegami Ltd
+
+"""Retry tests."""
+
+from http.server import BaseHTTPRequestHandler
+import io
+import json
+import threading
+import unittest
+
+from . import ThreadingHTTPServer
+from .. import (
+    http,
+    retries,
+)
+
+
+class FakeServer(object):
+    """Server answering each request with the next of statuses."""
+
+    def __init__(self, statuses, retry_after=True):
+        self.statuses = list(statuses)
+        self.retry_after = retry_after
+        self.bodies = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.do_PUT()
+
+            def do_PUT(self):
+                length = int(self.headers.get('Content-Length', 0))
+                server.bodies.append(self.rfile.read(length))
+                status = server.statuses.pop(0) if server.statuses else 200
+                body = b''
+                if status == 200:
+                    body = json.dumps({'ok': True}).encode('utf-8')
+                self.send_response(status)
+                if status == 503 and server.retry_after:
+                    self.send_header('Retry-After', '0')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class FakeError(Exception):
+    def __init__(self, code, headers=None):
+        self.code = code
+        self.headers = headers or {}
+
+
+class RetryTestCase(unittest.TestCase):
+    def test_retry_after(self):
+        self.assertEqual(retries.retry_after({'Retry-After': '3'}), 3)
+        self.assertEqual(
+            retries.retry_after({'Retry-After': '9999'}), retries.MAX_BACKOFF)
+        date = 'Thu, 01 Jan 1970 00:00:10 GMT'
+        self.assertEqual(retries.retry_after({'Retry-After': date}, now=4), 6)
+        self.assertIsNone(retries.retry_after({}))
+
+    def test_policy_delay(self):
+        policy = retries.RetryPolicy(attempts=3, backoff=1.0)
+        self.assertLessEqual(policy.delay(1, FakeError(503)), 2.0)
+        self.assertEqual(
+            policy.delay(0, FakeError(429, {'Retry-After': '5'})), 5)
+        self.assertIsNone(policy.delay(0, FakeError(404)))
+        self.assertIsNone(policy.delay(2, FakeError(503)))
+        self.assertIsNone(policy.delay(0, ValueError()))
+
+    def test_budget_limits_retries(self):
+        budget = retries.RetryBudget(reserve=2, ratio=0.5)
+        policy = retries.RetryPolicy(budget=budget)
+        self.assertIsNotNone(policy.delay(0, FakeError(503)))
+        self.assertIsNotNone(policy.delay(0, FakeError(503)))
+        self.assertIsNone(policy.delay(0, FakeError(503)))
+        # two more requests earn another retry
+        budget.deposit()
+        budget.deposit()
+        self.assertIsNotNone(policy.delay(0, FakeError(503)))
+        self.assertEqual(budget.exhausted, 1)
+
+
+class SessionRetryTestCase(unittest.TestCase):
+    def test_api_server_errors_retried(self):
+        server = FakeServer([502, 503])
+        self.addCleanup(server.close)
+        session = http.make_session(server.base, None)
+        url = server.base + '/api/imagesets/x/images_bulk?start=0'
+        self.assertEqual(http.post_json(session, url, {}), {'ok': True})
+        self.assertEqual(len(server.bodies), 3)
+
+    def test_api_posts_not_sent_twice(self):
+        server = FakeServer([502, 503], retry_after=False)
+        self.addCleanup(server.close)
+        session = http.make_session(server.base, None)
+        with self.assertRaises(http.ClientError):
+            http.post_json(
+                session, server.base + '/api/imagesets/x/extend', {})
+        self.assertEqual(len(server.bodies), 1)
+        # unless the server asks for it to be sent later
+        server.statuses = [503]
+        server.retry_after = True
+        self.assertEqual(
+            http.post_json(session, server.base + '/api/collections/', {}),
+            {'ok': True})
+        self.assertEqual(len(server.bodies), 3)
+
+    def test_storage_errors_not_retried_by_transport(self):
+        server = FakeServer([500, 500, 500, 500, 500])
+        self.addCleanup(server.close)
+        session = http.make_session(server.base, None)
+        session.retry_policy.attempts = 2
+        session.retry_policy.backoff = 0
+        with self.assertRaises(http.ClientError):
+            http.put_file(
+                session, server.base + '/blob', io.BytesIO(b'content'),
+                'image/png')
+        self.assertEqual(len(server.bodies), 2)
+
+    def test_put_file_sent_again_whole(self):
+        server = FakeServer([503])
+        self.addCleanup(server.close)
+        session = http.make_session(server.base, None)
+        f = io.BytesIO(b'skip content')
+        f.seek(5)
+        http.put_file(session, server.base + '/blob', f, 'image/png')
+        self.assertEqual(server.bodies, [b'content', b'content'])
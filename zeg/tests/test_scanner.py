@@ -0,0 +1,77 @@
+# Copyright 2021 Zegami Ltd
+
+"""Directory scanner tests."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from . import FakeLogger
+from .. import (
+    imagesets,
+    scanner,
+)
+
+
+class WalkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for relpath in ['a.jpg', 'b.PNG', 'notes.txt', 'raw.dat',
+                        'sub/c.jpg', 'sub/thumbs/d.jpg', 'other/e.tif']:
+            path = os.path.join(self.root, relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'x' * len(relpath))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _walk(self, recursive=True, ignore_mime=False, **kwargs):
+        file_filter = scanner.FileFilter(
+            tuple(imagesets.MIMES.keys()), imagesets.BLACKLIST, ignore_mime,
+            **kwargs)
+        return sorted(
+            (os.path.relpath(path, self.root), size)
+            for path, size in scanner.walk(
+                self.root, file_filter, FakeLogger(), recursive=recursive)
+        )
+
+    def test_recursive(self):
+        self.assertEqual(self._walk(), [
+            ('a.jpg', 5), ('b.PNG', 5), ('other/e.tif', 11),
+            ('sub/c.jpg', 9), ('sub/thumbs/d.jpg', 16)])
+
+    def test_not_recursive(self):
+        self.assertEqual(self._walk(recursive=False), [
+            ('a.jpg', 5), ('b.PNG', 5)])
+
+    def test_ignore_mime_keeps_blacklist(self):
+        self.assertEqual(
+            [
+                path for path, size
+                in self._walk(recursive=False, ignore_mime=True)
+            ],
+            ['a.jpg', 'b.PNG', 'raw.dat'])
+
+    def test_include_exclude(self):
+        self.assertEqual(
+            self._walk(include=['sub/*', 'a.*'], exclude=['*/thumbs/*']),
+            [('a.jpg', 5), ('sub/c.jpg', 9)])
+
+    def test_deeper_than_recursion_limit(self):
+        path = self.root
+        for i in range(200):
+            path = os.path.join(path, 'd')
+            os.mkdir(path)
+        with open(os.path.join(path, 'deep.jpg'), 'wb') as f:
+            f.write(b'x')
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(150)
+        try:
+            found = self._walk()
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertIn(
+            'deep.jpg', [os.path.basename(path) for path, size in found])
@@ -0,0 +1,76 @@
+# Copyright 2021 Zegami Ltd
+
+"""Worker session tests."""
+
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler
+import threading
+import unittest
+
+from . import ThreadingHTTPServer
+from .. import (
+    http,
+    sessions,
+)
+
+
+class SessionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.template = http.make_session('https://example.com', 'token')
+        self.pool = sessions.SessionPool(self.template)
+        self.addCleanup(self.pool.close)
+
+    def test_checkout(self):
+        with self.pool.checkout() as first:
+            # the pool stands in for the checked out session
+            self.assertIs(self.pool.session(), first)
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                second = executor.submit(
+                    lambda: self.pool.checkout().__enter__()).result()
+            self.assertIsNot(first, second)
+        # handed back sessions are reused
+        with self.pool.checkout() as again:
+            self.assertIs(again, first)
+        self.assertEqual(len(self.pool.sessions), 2)
+
+    def test_checkout_plain_session(self):
+        with sessions.checkout(self.template) as session:
+            self.assertIs(session, self.template)
+
+    def test_copies_settings(self):
+        session = self.pool.session()
+        self.assertIs(session.auth, self.template.auth)
+        self.assertIs(session.retry_policy, self.template.retry_policy)
+        # the pool stands in for the thread's session
+        self.assertIs(self.pool.timeouts, self.template.timeouts)
+        for prefix, adapter in self.template.adapters.items():
+            copy = session.adapters[prefix]
+            self.assertIsNot(copy, adapter)
+            self.assertIs(copy.max_retries.budget, adapter.max_retries.budget)
+            self.assertEqual(copy._pool_maxsize, sessions.WORKER_POOL_SIZE)
+
+    def test_warm(self):
+        heads = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_HEAD(self):
+                heads.append(threading.get_ident())
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            self.pool.warm(executor, [url], 3)
+        self.assertEqual(len(heads), 3)
+        self.assertEqual(len(self.pool.sessions), 3)
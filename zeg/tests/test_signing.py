@@ -0,0 +1,72 @@
+# Copyright 2021 Zegami Ltd
+
+"""Signed url prefetching tests."""
+
+import time
+import unittest
+from unittest import mock
+
+from .. import signing
+
+# 2021-05-01T12:00:00Z
+EXPIRY = 1619870400
+
+
+class UrlExpiryTestCase(unittest.TestCase):
+    def test_azure_sas(self):
+        url = (
+            'https://a.blob.core.windows.net/c/b'
+            '?sv=2020&se=2021-05-01T12:00:00Z&sig=x')
+        self.assertEqual(signing.url_expiry([url], EXPIRY - 10), EXPIRY)
+
+    def test_google_v4(self):
+        url = (
+            '/bucket/b?X-Goog-Date=20210501T115000Z&X-Goog-Expires=600'
+            '&X-Goog-Signature=x')
+        self.assertEqual(signing.url_expiry([url], EXPIRY - 10), EXPIRY)
+
+    def test_google_v2(self):
+        url = '/bucket/b?Expires={}&Signature=x'.format(EXPIRY)
+        self.assertEqual(signing.url_expiry([url], EXPIRY - 10), EXPIRY)
+
+    def test_earliest_of_urls(self):
+        urls = [
+            '/bucket/a?Expires={}'.format(EXPIRY + 60),
+            '/bucket/b?Expires={}'.format(EXPIRY),
+        ]
+        self.assertEqual(signing.url_expiry(urls, EXPIRY - 10), EXPIRY)
+
+    def test_unknown_lasts_default(self):
+        urls = ['http://localhost/storage/a', '/bucket/b?se=tomorrow']
+        self.assertEqual(
+            signing.url_expiry(urls, EXPIRY),
+            EXPIRY + signing.DEFAULT_LIFETIME)
+
+
+class PrefetcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prefetcher = signing.Prefetcher(
+            None, 'http://api/signed_blob_url')
+        self.addCleanup(self.prefetcher.close)
+
+    def _signed(self, session, url, body):
+        expires = int(time.time()) + self.lifetime
+        return {
+            i: '/bucket/{}?Expires={}'.format(i, expires) for i in body['ids']
+        }
+
+    def test_fresh_urls_used(self):
+        self.lifetime = 3600
+        with mock.patch(
+                'zeg.http.post_json', side_effect=self._signed) as post:
+            prefetch = self.prefetcher.fetch(['a', 'b'])
+            self.assertEqual(sorted(prefetch.result()), ['a', 'b'])
+        self.assertEqual(post.call_count, 1)
+
+    def test_stale_urls_fetched_again(self):
+        self.lifetime = signing.EXPIRY_MARGIN - 10
+        with mock.patch(
+                'zeg.http.post_json', side_effect=self._signed) as post:
+            prefetch = self.prefetcher.fetch(['a'])
+            self.assertEqual(list(prefetch.result()), ['a'])
+        self.assertEqual(post.call_count, 2)
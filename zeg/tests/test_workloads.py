@@ -0,0 +1,72 @@
+# Copyright 2021 Zegami Ltd
+
+"""Workload chunking tests."""
+
+import unittest
+
+from .. import workloads
+
+
+def _work(sizes, start=0):
+    return [
+        workloads.WorkItem(start + i, str(i), None, size)
+        for i, size in enumerate(sizes)
+    ]
+
+
+def _chunks(work, sizer):
+    return [
+        ([item.slot for item in chunk], size)
+        for chunk, size in workloads.chunk_work(work, sizer)
+    ]
+
+
+class ChunkWorkTestCase(unittest.TestCase):
+    def test_count_limit(self):
+        sizer = workloads.WorkloadSizer(2)
+        self.assertEqual(
+            _chunks(_work([1, 1, 1, 1, 1]), sizer),
+            [([0, 1], 2), ([2, 3], 2), ([4], 1)])
+
+    def test_byte_limit(self):
+        sizer = workloads.WorkloadSizer(100, target_bytes=10)
+        self.assertEqual(
+            _chunks(_work([4, 4, 4, 30, 2]), sizer),
+            [([0, 1], 8), ([2], 4), ([3], 30), ([4], 2)])
+
+    def test_breaks_on_slot_gap(self):
+        sizer = workloads.WorkloadSizer(100)
+        work = _work([1, 1]) + _work([1], start=5)
+        self.assertEqual(
+            _chunks(work, sizer), [([0, 1], 2), ([5], 1)])
+
+
+class WorkloadSizerTestCase(unittest.TestCase):
+    def test_budget_follows_rate(self):
+        sizer = workloads.WorkloadSizer(100, target_seconds=10)
+        sizer.observe(50 * 1024 * 1024, 1.0)
+        self.assertEqual(sizer.target_bytes, 500 * 1024 * 1024)
+        sizer.observe(10, 100.0)
+        self.assertEqual(sizer.target_bytes, 400 * 1024 * 1024)
+
+    def test_budget_clamped(self):
+        sizer = workloads.WorkloadSizer(100)
+        sizer.observe(1, 60.0)
+        self.assertEqual(sizer.target_bytes, workloads.MIN_BYTES)
+
+
+class WorkTableTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        work = _work([3, 0, 2 ** 40], start=7)
+        work[1] = work[1]._replace(blob_id='blob')
+        table = workloads.WorkTable(work)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(list(table), work)
+        self.assertEqual(table[1], work[1])
+        self.assertEqual(table[-1], work[-1])
+
+    def test_chunked(self):
+        table = workloads.WorkTable(_work([1, 1, 1]))
+        self.assertEqual(
+            _chunks(table, workloads.WorkloadSizer(2)),
+            [([0, 1], 2), ([2], 1)])
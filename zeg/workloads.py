@@ -0,0 +1,122 @@
+# Copyright 2021 Zegami Ltd
+
+"""Splitting imageset uploads into chunks of work."""
+
+import array
+import collections
+import threading
+
+from . import paths
+
+# A file to upload into an imageset slot, blob_id is set when the file is
+# already in storage from an interrupted run and only needs completing.
+WorkItem = collections.namedtuple('WorkItem', 'slot path blob_id size')
+
+# Starting byte budget for a chunk, before any have been timed.
+TARGET_BYTES = 64 * 1024 * 1024
+
+# How long a chunk should take to upload, long enough that the signed url
+# and images_bulk calls are a small overhead, short enough that one chunk
+# does not hold back the end of the run.
+TARGET_SECONDS = 10.0
+
+MIN_BYTES = 1024 * 1024
+MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+
+class WorkTable(object):
+    """Sequence of WorkItems for a segment of an upload, stored compactly.
+
+    Paths and sizes are kept in a paths.PathTable and slots in a flat
+    array, blob ids only for the files which have one. WorkItems are made
+    as the table is read, so a segment waiting to be chunked costs little
+    beyond the names of its files.
+    """
+
+    def __init__(self, work=()):
+        """Initialise table, adding any WorkItems given."""
+        self._files = paths.PathTable()
+        self._slots = array.array('q')
+        self._blob_ids = {}
+        self.extend(work)
+
+    def append(self, item):
+        if item.blob_id is not None:
+            self._blob_ids[len(self._slots)] = item.blob_id
+        self._slots.append(item.slot)
+        self._files.append(item.path, item.size)
+
+    def extend(self, work):
+        for item in work:
+            self.append(item)
+
+    def __getitem__(self, index):
+        path, size = self._files[index]
+        if index < 0:
+            index += len(self)
+        return WorkItem(
+            self._slots[index], path, self._blob_ids.get(index), size)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __iter__(self):
+        for index, (path, size) in enumerate(self._files):
+            yield WorkItem(
+                self._slots[index], path, self._blob_ids.get(index), size)
+
+
+class WorkloadSizer(object):
+    """Size chunks by bytes, adjusted to the upload rate seen so far.
+
+    Chunks hold at most max_count files and roughly target_bytes. Each
+    finished chunk updates the per worker upload rate, and the byte budget
+    follows it so chunks keep taking about target_seconds.
+    """
+
+    def __init__(self, max_count, target_bytes=TARGET_BYTES,
+                 target_seconds=TARGET_SECONDS):
+        """Initialise sizer."""
+        self.max_count = max_count
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self._rate = None
+        self._lock = threading.Lock()
+
+    def observe(self, size, seconds):
+        """Record a chunk of size bytes taking seconds to complete."""
+        if seconds <= 0:
+            return
+        with self._lock:
+            rate = size / seconds
+            if self._rate is None:
+                self._rate = rate
+            else:
+                self._rate = 0.8 * self._rate + 0.2 * rate
+            self.target_bytes = int(min(
+                MAX_BYTES, max(MIN_BYTES, self._rate * self.target_seconds)))
+
+
+def chunk_work(work, sizer):
+    """Yield (chunk, size) for WorkItems split within the sizer's budget.
+
+    Work is ordered by slot, a chunk is only ever made of consecutive slots
+    so it can be completed with a single start offset. A file over the
+    budget gets a chunk to itself.
+    """
+    chunk = []
+    chunk_size = 0
+    for item in work:
+        is_gap = chunk and item.slot != chunk[-1].slot + 1
+        is_full = (
+            len(chunk) >= sizer.max_count or
+            chunk_size + item.size > sizer.target_bytes
+        )
+        if chunk and (is_gap or is_full):
+            yield chunk, chunk_size
+            chunk = []
+            chunk_size = 0
+        chunk.append(item)
+        chunk_size += item.size
+    if chunk:
+        yield chunk, chunk_size